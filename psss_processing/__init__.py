@@ -1 +1 @@
-from psss_processing.rest_api.client import PsssProcessingClient
+from psss_processing.rest_api.client import PsssProcessingClient, AsyncPsssProcessingClient, query_processors
@@ -0,0 +1,149 @@
+import os
+from logging import getLogger
+
+import numba
+import numpy
+
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
+
+_logger = getLogger(__name__)
+
+
+@numba.njit(parallel=True)
+def _start_numba_workers(n_threads):
+    counts = numpy.zeros(n_threads * 64)
+    for i in numba.prange(counts.shape[0]):
+        counts[i] += 1
+
+    return counts.sum()
+
+
+def parse_cpu_list(cpu_list):
+    """
+    Parse a cpu list in the taskset/cgroup format, i.e. "0-3,6".
+
+    :return: Sorted list of cpus, or None for an empty list.
+    """
+    if cpu_list is None or isinstance(cpu_list, (list, tuple, set)):
+        return sorted(cpu_list) if cpu_list else None
+
+    cpus = set()
+
+    for part in str(cpu_list).replace(" ", "").split(","):
+        if not part:
+            continue
+
+        try:
+            if "-" in part:
+                first, last = part.split("-")
+                cpus.update(range(int(first), int(last) + 1))
+            else:
+                cpus.add(int(part))
+        except ValueError:
+            raise ValueError("Invalid cpu list '%s', expected a list like '0-3,6'." % cpu_list)
+
+    return sorted(cpus) or None
+
+
+def get_thread_affinity():
+    return sorted(os.sched_getaffinity(0))
+
+
+def set_thread_affinity(cpus):
+    """
+    Pin the calling thread to the cpus. Threads started afterwards by this thread inherit the affinity.
+    """
+    # On Linux, pid 0 is the calling thread, not the whole process.
+    os.sched_setaffinity(0, cpus)
+
+
+class ThreadTopology(object):
+
+    def __init__(self, processing_cpus=None, numba_cpus=None, io_cpus=None, numba_threads=None, blas_threads=None):
+        """
+        Distribute the threads of the processing over the cpus, to avoid that they compete for the same cores.
+
+        :param processing_cpus: Cpus of the processing thread.
+        :param numba_cpus: Cpus of the numba worker threads.
+        :param io_cpus: Cpus of all other threads: zmq I/O, EPICS channel access and the REST api.
+        :param numba_threads: Number of threads used by the numba kernels, by default the number of numba_cpus.
+        :param blas_threads: Number of BLAS threads (requires threadpoolctl).
+        """
+        self.processing_cpus = parse_cpu_list(processing_cpus)
+        self.numba_cpus = parse_cpu_list(numba_cpus)
+        self.io_cpus = parse_cpu_list(io_cpus)
+
+        if numba_threads is None and self.numba_cpus:
+            numba_threads = len(self.numba_cpus)
+        self.numba_threads = numba_threads
+        self.blas_threads = blas_threads
+
+        cpus = set((self.processing_cpus or []) + (self.numba_cpus or []) + (self.io_cpus or []))
+
+        if cpus and not hasattr(os, "sched_setaffinity"):
+            raise ValueError("Setting the cpu affinity is not supported on this platform.")
+
+        if cpus:
+            available_cpus = set(get_thread_affinity())
+            if not cpus.issubset(available_cpus):
+                raise ValueError("Cpus %s are not available. Available cpus: %s." %
+                                 (sorted(cpus - available_cpus), sorted(available_cpus)))
+
+        if blas_threads is not None and threadpoolctl is None:
+            raise ValueError("Setting the number of BLAS threads requires threadpoolctl.")
+
+        self.applied = False
+
+    def apply(self):
+        """
+        Start the numba workers on their cpus, then pin the calling thread to the io cpus. Has to be called
+        from the main thread at startup, before the REST api and the processing thread are started.
+        """
+        original_cpus = get_thread_affinity()
+
+        if self.numba_cpus:
+            set_thread_affinity(self.numba_cpus)
+
+        if self.numba_threads is not None:
+            if self.numba_threads > numba.config.NUMBA_NUM_THREADS:
+                _logger.warning("Only %d numba threads available (NUMBA_NUM_THREADS), %d requested.",
+                                numba.config.NUMBA_NUM_THREADS, self.numba_threads)
+                self.numba_threads = numba.config.NUMBA_NUM_THREADS
+
+            numba.set_num_threads(self.numba_threads)
+
+        # The numba workers keep the affinity of the thread starting them. Depending on the threading layer they
+        # are started with the thread pool or on the first parallel kernel. The thread pool has to be started by
+        # the main thread, otherwise the tbb threading layer blocks at the exit.
+        _start_numba_workers(numba.get_num_threads())
+
+        if self.blas_threads is not None:
+            threadpoolctl.threadpool_limits(limits=self.blas_threads, user_api="blas")
+
+        set_thread_affinity(self.io_cpus or original_cpus)
+
+        self.applied = True
+
+        _logger.info("Thread topology applied: %s", self.get_topology())
+
+    def pin_processing_thread(self):
+        """
+        Called by the processing thread, after the I/O threads (zmq, EPICS) were started with the io cpus.
+        """
+        if self.processing_cpus:
+            set_thread_affinity(self.processing_cpus)
+
+        # The number of numba threads is a per thread setting.
+        if self.numba_threads is not None:
+            numba.set_num_threads(self.numba_threads)
+
+    def get_topology(self):
+        return {"processing_cpus": self.processing_cpus,
+                "numba_cpus": self.numba_cpus,
+                "io_cpus": self.io_cpus,
+                "numba_threads": numba.get_num_threads() if self.numba_threads is None else self.numba_threads,
+                "blas_threads": self.blas_threads,
+                "applied": self.applied}
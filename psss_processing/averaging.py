@@ -0,0 +1,76 @@
+import numpy
+
+
+class SpectrumAverager(object):
+
+    def __init__(self):
+        """
+        Running averages of the spectrum, updated in O(spectrum width) per pulse.
+        """
+        self.window = 0
+        self.ema_alpha = 0
+
+        self.reset()
+
+    def reset(self):
+        self._ring_buffer = None
+        self._sum = None
+        self._index = 0
+        self._n_spectra = 0
+
+        self._ema = None
+
+        self.n_updates = 0
+        self.fit_results = None
+
+    def update(self, spectrum, window, ema_alpha):
+        """
+        Add a spectrum to the running averages. Changing the window or the spectrum width resets the averages.
+
+        :param spectrum: Spectrum of the current pulse.
+        :param window: Number of pulses in the moving average. 0 disables it.
+        :param ema_alpha: Weight of the current pulse in the exponential moving average. 0 disables it.
+        :return: Moving average and exponential moving average (None if disabled).
+        """
+        width = spectrum.shape[0]
+
+        if window != self.window or (self._sum is not None and self._sum.shape[0] != width):
+            self.reset()
+            self.window = window
+
+        if ema_alpha != self.ema_alpha:
+            self._ema = None
+            self.ema_alpha = ema_alpha
+
+        self.n_updates += 1
+
+        moving_average = None
+        if window > 0:
+            if self._ring_buffer is None:
+                self._ring_buffer = numpy.zeros((window, width), dtype=numpy.float64)
+                self._sum = numpy.zeros(width, dtype=numpy.float64)
+
+            # Replace the oldest spectrum in the ring buffer and keep the sum up to date.
+            oldest = self._ring_buffer[self._index]
+            self._sum -= oldest
+            oldest[:] = spectrum
+            self._sum += oldest
+
+            self._index = (self._index + 1) % window
+            self._n_spectra = min(self._n_spectra + 1, window)
+
+            moving_average = self._sum / self._n_spectra
+
+        ema = None
+        if ema_alpha > 0:
+            if self._ema is None or self._ema.shape[0] != width:
+                self._ema = spectrum.astype(numpy.float64)
+            else:
+                self._ema += ema_alpha * (spectrum - self._ema)
+
+            ema = self._ema.copy()
+
+        return moving_average, ema
+
+    def get_n_spectra(self):
+        return self._n_spectra
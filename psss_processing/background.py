@@ -0,0 +1,47 @@
+import numpy
+
+from psss_processing import functions
+
+
+class BackgroundTracker(object):
+
+    def __init__(self):
+        """
+        Background estimated from dark images, kept in float32 and updated in place.
+        """
+        self.background = None
+        self.n_dark_images = 0
+
+    def reset(self):
+        self.background = None
+        self.n_dark_images = 0
+
+    def update(self, image, mode, rate):
+        """
+        Add a dark image to the background.
+
+        :param image: Dark image.
+        :param mode: "ema" for an exponential moving average or "median" for an approximate running median.
+        :param rate: Weight of the image in the exponential moving average, or maximum change of a pixel value
+                     per image for the running median.
+        """
+        if self.background is None or self.background.shape != image.shape:
+            self.background = image.astype(numpy.float32)
+            self.n_dark_images = 1
+            return
+
+        if mode == "median":
+            functions.update_background_median(self.background, image, numpy.float32(rate))
+        else:
+            functions.update_background_ema(self.background, image, numpy.float32(rate))
+
+        self.n_dark_images += 1
+
+    def get_background(self, dtype):
+        """
+        Get a copy of the current background, rounded to the given image dtype.
+        """
+        if numpy.issubdtype(dtype, numpy.integer):
+            return numpy.rint(self.background).astype(dtype)
+
+        return self.background.astype(dtype)
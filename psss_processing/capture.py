@@ -0,0 +1,179 @@
+import datetime
+import os
+from logging import getLogger
+
+import numpy
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from psss_processing import config
+from psss_processing.writer import BackgroundWriter
+
+_logger = getLogger(__name__)
+
+
+class CaptureWriter(object):
+
+    def __init__(self, filename, image_channel, image, roi_channels, axis_channel, axis, compression):
+        """
+        Write the input messages in the HDF5 file layout of the data buffer: /data/<channel>/data, with the
+        pulse ids and timestamps next to the images. Each image is a chunk, so single images can be read back.
+        """
+        self.filename = filename
+        self.file = h5py.File(filename, "w")
+
+        self.image_channel = image_channel
+        self.image_shape = image.shape
+        self.file.attrs["image_channel"] = image_channel
+
+        self.datasets = {}
+        columns = [(image_channel, "data", image.dtype, image.shape),
+                   (image_channel, "pulse_id", numpy.uint64, ()),
+                   (image_channel, "global_timestamp", numpy.int64, ()),
+                   (image_channel, "global_timestamp_offset", numpy.int64, ())]
+
+        # The values of the ROI and axis PVs used for each image, with the channel names of the PVs.
+        columns += [(channel, "data", numpy.int64, ()) for channel in roi_channels if channel]
+        if axis_channel:
+            columns.append((axis_channel, "data", numpy.float64, axis.shape))
+
+        for channel, field, dtype, shape in columns:
+            name = "data/%s/%s" % (channel, field)
+            self.datasets[name] = self.file.create_dataset(name, shape=(0,) + shape, maxshape=(None,) + shape,
+                                                           dtype=dtype, chunks=(1,) + shape,
+                                                           compression=compression if shape else None)
+
+        self.roi_channels = roi_channels
+        self.axis_channel = axis_channel
+
+        self.n_images = 0
+
+    def append(self, pulse_id, timestamp, image, roi, axis):
+        values = {"data/%s/data" % self.image_channel: image,
+                  "data/%s/pulse_id" % self.image_channel: pulse_id,
+                  "data/%s/global_timestamp" % self.image_channel: timestamp[0],
+                  "data/%s/global_timestamp_offset" % self.image_channel: timestamp[1]}
+
+        for channel, value in zip(self.roi_channels, roi):
+            if channel:
+                values["data/%s/data" % channel] = value
+        if self.axis_channel:
+            values["data/%s/data" % self.axis_channel] = axis
+
+        for name, dataset in self.datasets.items():
+            dataset.resize(self.n_images + 1, axis=0)
+            dataset[self.n_images] = values[name]
+
+        self.n_images += 1
+
+    def close(self):
+        self.file.close()
+
+
+class StreamCapture(BackgroundWriter):
+
+    name = "Capture"
+    running_status = "capturing"
+
+    def __init__(self, epics_pv_name_prefix, ymin_pv_name=None, ymax_pv_name=None, axis_pv_name=None,
+                 output_directory=config.DEFAULT_CAPTURE_DIRECTORY, queue_size=config.CAPTURE_QUEUE_SIZE):
+        """
+        Capture the raw input messages of the processing, to replay them later with psss_replay. The processing
+        only puts the images into a queue, a writer thread writes them to the file.
+
+        :param epics_pv_name_prefix: Prefix of the image channel.
+        :param ymin_pv_name: PV of the ROI start, its values are saved in a channel with the PV name.
+        :param ymax_pv_name: PV of the ROI end.
+        :param axis_pv_name: PV of the energy axis.
+        :param output_directory: Default directory for the capture files.
+        :param queue_size: Maximum number of images waiting to be written. Images are dropped when the queue is full.
+        """
+        super(StreamCapture, self).__init__(queue_size, config.CAPTURE_QUEUE_TIMEOUT)
+
+        self.image_channel = epics_pv_name_prefix + config.EPICS_PV_SUFFIX_IMAGE
+        self.roi_channels = (ymin_pv_name, ymax_pv_name)
+        self.axis_channel = axis_pv_name
+
+        self.output_directory = output_directory
+
+        self._writer = None
+
+    def start(self, output_directory=None, file_prefix=config.DEFAULT_CAPTURE_FILE_PREFIX,
+              max_images=config.DEFAULT_CAPTURE_MAX_IMAGES, compression=config.DEFAULT_CAPTURE_COMPRESSION):
+        """
+        Start a new capture. The capture stops by itself after max_images.
+
+        :param output_directory: Directory for the file, by default the one given in the constructor.
+        :param file_prefix: Prefix of the file name. The file name is suffixed with the file creation time.
+        :param max_images: Number of images to capture. 0 captures until stopped.
+        :param compression: HDF5 compression of the images ("lzf", "gzip" or None).
+        """
+        if h5py is None:
+            raise ValueError("Capturing the input stream requires h5py.")
+
+        if compression not in (None, "lzf", "gzip"):
+            raise ValueError("Invalid compression '%s'. Use 'lzf', 'gzip' or None." % compression)
+
+        output_directory = output_directory or self.output_directory
+        os.makedirs(output_directory, exist_ok=True)
+
+        file_name = "%s_%s.h5" % (file_prefix, datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f"))
+        filename = os.path.join(output_directory, file_name)
+
+        self._start(settings={"output_directory": output_directory,
+                              "file_prefix": file_prefix,
+                              "max_images": max_images,
+                              "compression": compression,
+                              "filename": filename},
+                    statistics={"capture_start_time": str(datetime.datetime.now()),
+                                "filename": filename,
+                                "n_queued": 0,
+                                "n_captured": 0,
+                                "n_dropped": 0})
+
+        _logger.info("Capture of the input stream started in %s.", filename)
+
+    def is_capturing(self):
+        return self.is_running()
+
+    def capture(self, pulse_id, timestamp, image, roi, axis):
+        """
+        Queue an input image with the ROI and axis used to process it. Never blocks: when the writer is
+        behind, the image is dropped.
+        """
+        if not self.is_capturing():
+            return
+
+        max_images = self.settings["max_images"]
+        if max_images and self.statistics["n_queued"] >= max_images:
+            self._running_flag.clear()
+            return
+
+        # The processing does not modify the received image and the axis is replaced, not updated.
+        if self._put((pulse_id, timestamp, image, list(roi), axis)):
+            self.statistics["n_queued"] += 1
+
+    def _write_batch(self, batch, settings):
+        for pulse_id, timestamp, image, roi, axis in batch:
+            if self._writer is None:
+                self._writer = CaptureWriter(settings["filename"], self.image_channel, image, self.roi_channels,
+                                             self.axis_channel, axis, settings["compression"])
+
+            # A replay needs a single image shape, the capture ends when the camera ROI changes.
+            if image.shape != self._writer.image_shape:
+                _logger.warning("Image shape changed from %s to %s, capture stopped.",
+                                self._writer.image_shape, image.shape)
+                return False
+
+            self._writer.append(pulse_id, timestamp, image, roi, axis)
+            self.statistics["n_captured"] += 1
+
+        return True
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
@@ -1,6 +1,10 @@
 API_PREFIX = ""
 DEFAULT_REST_API_INTERFACE = "0.0.0.0"
 DEFAULT_REST_API_PORT = 12000
+REST_API_MAX_JOBS = 100
+REST_API_KEEP_ALIVE_TIMEOUT = 60
+DEFAULT_CLIENT_TIMEOUT = 10
+QUERY_PROCESSORS_MAX_WORKERS = 32
 
 DEFAULT_LOGGING_LEVEL = "INFO"
 DEFAULT_DATA_OUTPUT_STREAM_PORT = 8889
@@ -11,12 +15,81 @@ DEFAULT_PARAMETERS = {
     "background": ""
 }
 
+DEFAULT_FULL_IMAGE_METRICS = False
+DEFAULT_SATURATION_LEVEL = 65535
+
+DEFAULT_BINNING = 2
+DEFAULT_BINNING_MODE = "sum"
+DEFAULT_PUBLISH_FULL_SPECTRUM = True
+
+DEFAULT_N_PEAKS = 1
+MULTI_PEAK_MIN_DISTANCE = 25
+MULTI_PEAK_MAX_ITERATIONS = 20
+
+DEFAULT_AVERAGE_WINDOW = 0
+DEFAULT_EMA_ALPHA = 0
+DEFAULT_AVERAGE_FIT_INTERVAL = 0
+
+DEFAULT_BACKGROUND_TRACKING = ""
+DEFAULT_BACKGROUND_TRACKING_ALPHA = 0.01
+DEFAULT_BACKGROUND_TRACKING_STEP = 1
+DEFAULT_BACKGROUND_UPDATE_INTERVAL = 100
+
+DEFAULT_LOAD_SHEDDING = False
+OVERLOAD_HIGH_LAG = 0.2
+OVERLOAD_LOW_LAG = 0.05
+OVERLOAD_ESCALATE_AFTER = 10
+OVERLOAD_RECOVER_AFTER = 200
+OVERLOAD_DECIMATION = 4
+OVERLOAD_BASELINE_WINDOW = 60
+
+DEFAULT_STATE_FILE = ""
+
+DEFAULT_RECORDING_DIRECTORY = "/tmp/psss_recording"
+DEFAULT_RECORDING_FILE_PREFIX = "psss_spectra"
+DEFAULT_RECORDING_MAX_FILE_SIZE_MB = 1024
+DEFAULT_RECORDING_MAX_FILE_DURATION_S = 3600
+DEFAULT_RECORDING_COMPRESSION = True
+RECORDING_QUEUE_SIZE = 10000
+RECORDING_BATCH_SIZE = 100
+RECORDING_QUEUE_TIMEOUT = 0.1
+
+DEFAULT_CAPTURE_DIRECTORY = "/tmp/psss_capture"
+DEFAULT_CAPTURE_FILE_PREFIX = "psss_capture"
+DEFAULT_CAPTURE_MAX_IMAGES = 1000
+DEFAULT_CAPTURE_COMPRESSION = "lzf"
+CAPTURE_QUEUE_SIZE = 100
+CAPTURE_QUEUE_TIMEOUT = 0.1
+
+DEFAULT_REPLAY_OUTPUT_STREAM_PORT = 9999
+REPLAY_OUTPUT_STREAM_QUEUE_SIZE = 100
+
+DEFAULT_REPROCESS_CHUNK_SIZE = 100
+
+DEFAULT_SHM_N_SLOTS = 16
+DEFAULT_SHM_MAX_SPECTRUM_WIDTH = 4096
+SHM_READ_TIMEOUT = 0.01
+
+DEFAULT_PROFILE_FRAMES = 100
+PROFILE_SAMPLE_INTERVAL = 0.001
+PROFILE_TIMEOUT = 60
+PROFILE_REPORT_LINES = 30
+
 PROCESSOR_START_TIMEOUT = 1
 
+# Cpu lists in the taskset format ("0-3,6"), empty to not pin the threads.
+DEFAULT_PROCESSING_CPUS = ""
+DEFAULT_NUMBA_CPUS = ""
+DEFAULT_IO_CPUS = ""
+DEFAULT_NUMBA_THREADS = None
+DEFAULT_BLAS_THREADS = None
+
 INPUT_STREAM_QUEUE_SIZE = 100
 INPUT_STREAM_RECEIVE_TIMEOUT = 1000
 OUTPUT_STREAM_SEND_TIMEOUT = 1000
 IMAGE_OUTPUT_STREAM_QUEUE_SIZE = 100
+DEFAULT_DATA_OUTPUT_STREAM_MODE = "push"
+DEFAULT_DATA_OUTPUT_STREAM_QUEUE_SIZE = 10
 
 EPICS_PV_SUFFIX_IMAGE = ":FPICTURE"
 
@@ -30,3 +103,11 @@ DEFAULT_FWHM_PV = "SARFE10-PSSS059:SPECTRUM_FWHM"
 
 DEFAULT_YMIN_PV = "SARFE10-PSSS059:SPC_ROI_YMIN"
 DEFAULT_YMAX_PV = "SARFE10-PSSS059:SPC_ROI_YMAX"
+
+DEFAULT_MERGER_REST_API_PORT = 12001
+DEFAULT_MERGER_OUTPUT_STREAM_PORT = 8891
+DEFAULT_MERGER_WINDOW_MS = 200
+MERGER_BUFFER_SIZE = 1000
+MERGER_INPUT_QUEUE_SIZE = 1000
+MERGER_RECEIVE_TIMEOUT = 0.1
+DEFAULT_MERGER_INPUT_STREAM_MODE = "push"
@@ -3,26 +3,296 @@ import numba
 import numpy
 import scipy.optimize
 
+# The gain is stored in fixed point with 14 fractional bits, gains up to 4 can be represented.
+GAIN_FRACTIONAL_BITS = 14
+GAIN_ROUNDING = 1 << (GAIN_FRACTIONAL_BITS - 1)
+GAIN_MAX = 65535 / (1 << GAIN_FRACTIONAL_BITS)
+
 
 @numba.njit(parallel=True)
-def get_spectrum(image, background):
+def get_spectra(image, background, gain, shift_index, shift_fraction, rois, saturation_level, all_rows, profiles,
+                row_profile):
+    """
+    Collapse the image in y direction for several vertical bands in a single sweep over the image.
+    The image quality metrics are calculated in the same sweep.
+
+    :param image: Image to process.
+    :param background: Background to subtract, same shape as the image. Pass an empty array to skip the subtraction.
+    :param gain: Per pixel gain (flat field) in fixed point, from get_gain_table. The background subtracted pixels
+                 are multiplied with the gain. Pass an empty array to skip the correction.
+    :param shift_index: Integer part of the x shift of each row, from get_shift_table. Pass an empty array to skip
+                        the curvature correction.
+    :param shift_fraction: Fractional part of the x shift of each row, from get_shift_table. The profiles must have
+                           a floating point dtype if the correction is applied.
+    :param rois: Array of shape (n_bands, 2) with [ymin, ymax) of each band.
+    :param saturation_level: Pixel value at which a pixel is considered saturated (before background subtraction).
+    :param all_rows: Sweep all rows for the quality metrics, not only the rows in the bands.
+    :param profiles: Zeroed output array of shape (n_bands, image width).
+    :param row_profile: Output array of shape (image height), filled with the background subtracted row sums.
+                        Rows that were not swept are 0.
+    :return: Number of saturated pixels, maximum pixel value and total background subtracted intensity.
+    """
     y = image.shape[0]
     x = image.shape[1]
+    n_bands = rois.shape[0]
+
+    subtract_background = background.shape[0] == y and background.shape[1] == x
+    apply_gain = gain.shape[0] == y and gain.shape[1] == x
+    correct_curvature = shift_index.shape[0] == y
+
+    # Each chunk of rows is accumulated into its own partial results, to avoid racing on the output.
+    n_chunks = max(1, min(numba.get_num_threads(), y))
+    chunk_size = (y + n_chunks - 1) // n_chunks
+    partial_profiles = numpy.zeros((n_chunks, n_bands, x), dtype=profiles.dtype)
+    partial_n_saturated = numpy.zeros(n_chunks, dtype=numpy.int64)
+    partial_max_value = numpy.zeros(n_chunks, dtype=numpy.float64)
+    partial_intensity = numpy.zeros(n_chunks, dtype=numpy.float64)
+
+    for chunk in numba.prange(n_chunks):
+        # The gain corrected pixels can exceed the range of the image dtype.
+        row = numpy.empty(x, dtype=profiles.dtype)
+
+        # Scalar accumulators keep the inner loop vectorizable.
+        n_saturated = 0
+        max_value = 0
+        intensity = 0.0
+
+        for i in range(chunk * chunk_size, min(y, (chunk + 1) * chunk_size)):
+            row_profile[i] = 0
+
+            in_band = False
+            for band in range(n_bands):
+                if rois[band, 0] <= i < rois[band, 1]:
+                    in_band = True
+
+            if not in_band and not all_rows:
+                continue
+
+            # A branch on the gain inside the loop would prevent its vectorization.
+            if apply_gain:
+                for j in range(x):
+                    v = image[i,j]
+
+                    n_saturated += v >= saturation_level
+                    max_value = max(max_value, v)
+
+                    if subtract_background:
+                        b = background[i,j]
+                        v = v - b if v > b else 0
+
+                    row[j] = (numpy.uint32(v) * gain[i,j] + numpy.uint32(GAIN_ROUNDING)) >> \
+                             numpy.uint32(GAIN_FRACTIONAL_BITS)
+            else:
+                for j in range(x):
+                    v = image[i,j]
+
+                    n_saturated += v >= saturation_level
+                    max_value = max(max_value, v)
+
+                    if subtract_background:
+                        b = background[i,j]
+                        v = v - b if v > b else 0
+
+                    row[j] = v
+
+            row_sum = row.sum()
+            row_profile[i] = row_sum
+            intensity += row_sum
+
+            # Pixel j is moved to x = j + shift, split between the 2 neighbouring pixels.
+            shift = shift_index[i] if correct_curvature else 0
+            weight_right = shift_fraction[i] if correct_curvature else 0.0
+            weight_left = 1 - weight_right
+
+            for band in range(n_bands):
+                if not rois[band, 0] <= i < rois[band, 1]:
+                    continue
+
+                if correct_curvature:
+                    # Profile pixel k gets the left part of row pixel k - shift and the right part of k - shift - 1.
+                    # The loop runs over zero based slices, shifted indexes would prevent vectorization.
+                    target = partial_profiles[chunk, band]
+                    start, end = max(0, shift + 1), min(x, x + shift)
+                    if start < end:
+                        target_slice = target[start:end]
+                        source_left = row[start - shift:end - shift]
+                        source_right = row[start - shift - 1:end - shift - 1]
+                        for j in range(target_slice.shape[0]):
+                            target_slice[j] += weight_left * source_left[j] + weight_right * source_right[j]
+
+                    # First and last row pixels have only one neighbour inside the profile.
+                    if 0 <= shift < x:
+                        target[shift] += weight_left * row[0]
+                    if 0 <= x + shift < x:
+                        target[x + shift] += weight_right * row[x - 1]
+                else:
+                    for j in range(x):
+                        partial_profiles[chunk, band, j] += row[j]
+
+        partial_n_saturated[chunk] = n_saturated
+        partial_max_value[chunk] = max_value
+        partial_intensity[chunk] = intensity
+
+    for chunk in range(n_chunks):
+        profiles += partial_profiles[chunk]
+
+    return partial_n_saturated.sum(), partial_max_value.max(), partial_intensity.sum()
+
+
+@numba.njit(parallel=True)
+def update_background_ema(background, image, alpha):
+    """
+    Exponential moving average of the background, updated in place with a dark image.
+    """
+    for i in numba.prange(image.shape[0]):
+        for j in range(image.shape[1]):
+            background[i,j] += alpha * (image[i,j] - background[i,j])
+
 
-    profile = numpy.zeros(x, dtype=numpy.uint32)
+@numba.njit(parallel=True)
+def update_background_median(background, image, step):
+    """
+    Approximate running median of the background, updated in place with a dark image: each pixel moves by
+    at most step towards the image value.
+    """
+    for i in numba.prange(image.shape[0]):
+        for j in range(image.shape[1]):
+            difference = image[i,j] - background[i,j]
+            if difference > step:
+                difference = step
+            elif difference < -step:
+                difference = -step
+
+            background[i,j] += difference
+
+
+@numba.njit(parallel=True)
+def get_stack_spectra(stack, background, gain, ymin, ymax, spectra):
+    """
+    Collapse each image of a stack in y direction, in a single compiled call parallel over the images.
+
+    :param stack: Images to process, shape (n_images, height, width).
+    :param background: Background to subtract, same shape as an image. Pass an empty array to skip the subtraction.
+    :param gain: Per pixel gain in fixed point, from get_gain_table. Pass an empty array to skip the correction.
+    :param ymin: First row of the ROI.
+    :param ymax: Row after the last row of the ROI.
+    :param spectra: Zeroed output array of shape (n_images, width).
+    """
+    x = stack.shape[2]
+    subtract_background = background.shape[0] == stack.shape[1] and background.shape[1] == x
+    apply_gain = gain.shape[0] == stack.shape[1] and gain.shape[1] == x
+
+    for n in numba.prange(stack.shape[0]):
+        spectrum = spectra[n]
+
+        for i in range(ymin, ymax):
+            if apply_gain:
+                for j in range(x):
+                    v = stack[n, i, j]
 
-    for i in numba.prange(y):
-        for j in range(x):
-            v = image[i,j]
-            b = background[i,j]
-            if v > b:
-                v -= b
+                    if subtract_background:
+                        b = background[i, j]
+                        v = v - b if v > b else 0
+
+                    spectrum[j] += (numpy.uint32(v) * gain[i, j] + numpy.uint32(GAIN_ROUNDING)) >> \
+                        numpy.uint32(GAIN_FRACTIONAL_BITS)
             else:
-                v = 0
+                for j in range(x):
+                    v = stack[n, i, j]
+
+                    if subtract_background:
+                        b = background[i, j]
+                        v = v - b if v > b else 0
+
+                    spectrum[j] += v
+
+
+def get_spectrum(image, background):
+    rois = numpy.array([[0, image.shape[0]]], dtype=numpy.int64)
+    profiles = numpy.zeros((1, image.shape[1]), dtype=numpy.uint32)
+    row_profile = numpy.empty(image.shape[0], dtype=numpy.float64)
+
+    no_shift = numpy.empty(0, dtype=numpy.int64)
+    no_gain = numpy.empty((0, 0), dtype=numpy.uint16)
+
+    get_spectra(image, background, no_gain, no_shift, no_shift.astype(numpy.float64), rois,
+                numpy.iinfo(numpy.uint16).max, False, profiles, row_profile)
+
+    return profiles[0]
+
+
+def get_gain_table(gain):
+    """
+    Convert the per pixel gain (flat field) to the fixed point representation used by get_spectra.
+
+    :param gain: Gain of each pixel, between 0 and GAIN_MAX.
+    :return: Gain in fixed point (uint16).
+    """
+    gain = numpy.asarray(gain, dtype=numpy.float64)
+
+    if gain.ndim != 2:
+        raise ValueError("Gain must be a 2D array, but an array with shape %s was given." % (gain.shape,))
+
+    if not numpy.all(numpy.isfinite(gain)) or gain.min() < 0 or gain.max() > GAIN_MAX:
+        raise ValueError("Gain values must be between 0 and %.3f." % GAIN_MAX)
+
+    return numpy.rint(gain * (1 << GAIN_FRACTIONAL_BITS)).astype(numpy.uint16)
+
+
+def get_shift_table(shift):
+    """
+    Split the x shift of each row, used to correct the curvature and tilt of the spectral lines, into the
+    integer and the fractional part used by get_spectra.
+
+    :param shift: Shift in pixels for each image row.
+    :return: shift_index (int64), shift_fraction (float64)
+    """
+    shift = numpy.asarray(shift, dtype=numpy.float64)
+
+    shift_index = numpy.floor(shift).astype(numpy.int64)
+    shift_fraction = shift - shift_index
+
+    return shift_index, shift_fraction
+
+
+def bin_spectrum(spectrum, binning, mode="sum"):
+    """
+    Sum or average the spectrum over bins of binning pixels. The last bin may contain fewer pixels.
+    A stack of spectra is binned along the last axis.
+    """
+    if binning <= 1:
+        return spectrum
 
-            profile[j] += v
+    bin_starts = numpy.arange(0, spectrum.shape[-1], binning)
+    binned_spectrum = numpy.add.reduceat(spectrum, bin_starts, axis=-1)
 
-    return profile
+    if mode == "mean":
+        bin_sizes = numpy.diff(numpy.append(bin_starts, spectrum.shape[-1]))
+        binned_spectrum = binned_spectrum / bin_sizes
+
+    return binned_spectrum
+
+
+_binned_axis_cache = {"axis": None, "binning": None, "binned_axis": None}
+
+
+def get_binned_axis(axis, binning):
+    """
+    Average the axis over bins of binning pixels, to match bin_spectrum. The result for the last axis is cached.
+    """
+    if binning <= 1:
+        return axis
+
+    if _binned_axis_cache["binning"] == binning and numpy.array_equal(_binned_axis_cache["axis"], axis):
+        return _binned_axis_cache["binned_axis"]
+
+    binned_axis = bin_spectrum(numpy.asarray(axis, dtype=numpy.float64), binning, "mean")
+
+    _binned_axis_cache["axis"] = numpy.array(axis, copy=True)
+    _binned_axis_cache["binning"] = binning
+    _binned_axis_cache["binned_axis"] = binned_axis
+
+    return binned_axis
 
 
 def _gauss_function(x, offset, amplitude, center, standard_deviation):
@@ -68,3 +338,199 @@ def gauss_fit(profile, axis, **kwargs):
         pass
 
     return offset, amplitude, center, abs(standard_deviation)
+
+
+@numba.njit
+def find_peaks(profile, n_peaks, min_distance):
+    """
+    Find the highest local maxima of the profile, at least min_distance samples apart.
+
+    :return: Array of n_peaks peak indices ordered by height, padded with -1 if fewer peaks were found.
+    """
+    peaks = numpy.full(n_peaks, -1, dtype=numpy.int64)
+    n = profile.shape[0]
+
+    for p in range(n_peaks):
+        best_index = -1
+        best_value = -numpy.inf
+
+        for i in range(1, n - 1):
+            if profile[i] <= profile[i - 1] or profile[i] < profile[i + 1] or profile[i] <= best_value:
+                continue
+
+            too_close = False
+            for q in range(p):
+                if abs(i - peaks[q]) < min_distance:
+                    too_close = True
+                    break
+
+            if not too_close:
+                best_index = i
+                best_value = profile[i]
+
+        if best_index < 0:
+            break
+
+        peaks[p] = best_index
+
+    return peaks
+
+
+@numba.njit
+def _estimate_peak_width(profile, axis, index, offset):
+    half_maximum = offset + (profile[index] - offset) / 2
+
+    left = index
+    while left > 0 and profile[left] > half_maximum:
+        left -= 1
+
+    right = index
+    while right < profile.shape[0] - 1 and profile[right] > half_maximum:
+        right += 1
+
+    return max(abs(axis[right] - axis[left]), abs(axis[1] - axis[0]))
+
+
+@numba.njit
+def _multi_gauss_evaluate(parameters, axis, profile, residuals, jacobian):
+    n_peaks = (parameters.shape[0] - 1) // 3
+    cost = 0.0
+
+    for k in range(axis.shape[0]):
+        x = axis[k]
+        value = parameters[0]
+        jacobian[k, 0] = 1.0
+
+        for p in range(n_peaks):
+            amplitude = parameters[1 + 3 * p]
+            center = parameters[2 + 3 * p]
+            standard_deviation = parameters[3 + 3 * p]
+
+            d = x - center
+            fac = math.exp(-d * d / (2 * standard_deviation * standard_deviation))
+            value += amplitude * fac
+
+            jacobian[k, 1 + 3 * p] = fac
+            jacobian[k, 2 + 3 * p] = amplitude * fac * d / (standard_deviation ** 2)
+            jacobian[k, 3 + 3 * p] = amplitude * fac * d * d / (standard_deviation ** 3)
+
+        residuals[k] = profile[k] - value
+        cost += residuals[k] * residuals[k]
+
+    return cost
+
+
+@numba.njit
+def _levenberg_marquardt(parameters, axis, profile, max_iterations):
+    n_parameters = parameters.shape[0]
+    residuals = numpy.empty(axis.shape[0])
+    jacobian = numpy.empty((axis.shape[0], n_parameters))
+    new_residuals = numpy.empty(axis.shape[0])
+    new_jacobian = numpy.empty((axis.shape[0], n_parameters))
+
+    cost = _multi_gauss_evaluate(parameters, axis, profile, residuals, jacobian)
+    damping = 1e-3
+
+    # The number of iterations is fixed, which bounds the fitting time per spectrum.
+    for _ in range(max_iterations):
+        jtj = jacobian.T @ jacobian
+        gradient = jacobian.T @ residuals
+
+        for i in range(n_parameters):
+            jtj[i, i] += damping * jtj[i, i] + 1e-12
+
+        step = numpy.linalg.solve(jtj, gradient)
+        new_parameters = parameters + step
+        new_cost = _multi_gauss_evaluate(new_parameters, axis, profile, new_residuals, new_jacobian)
+
+        if numpy.isfinite(new_cost) and new_cost < cost:
+            converged = cost - new_cost < 1e-8 * cost
+
+            parameters = new_parameters
+            cost = new_cost
+            residuals, new_residuals = new_residuals, residuals
+            jacobian, new_jacobian = new_jacobian, jacobian
+            damping = max(damping / 10, 1e-10)
+
+            if converged:
+                break
+        else:
+            damping *= 10
+
+    return parameters
+
+
+@numba.njit
+def multi_gauss_fit(profile, axis, n_peaks, min_distance, max_iterations, skip):
+    """
+    Fit the sum of n_peaks gaussians and a constant offset. Initial parameters are estimated from the
+    highest local maxima of the profile.
+
+    :return: offset, amplitudes, centers, standard_deviations. Arrays have n_peaks elements, ordered by center,
+             NaN if fewer peaks were found.
+    """
+    offset = profile.min()
+
+    peaks = find_peaks(profile, n_peaks, min_distance)
+    n_found = 0
+    while n_found < n_peaks and peaks[n_found] >= 0:
+        n_found += 1
+
+    parameters = numpy.empty(1 + 3 * n_found)
+    parameters[0] = offset
+    for p in range(n_found):
+        index = peaks[p]
+        parameters[1 + 3 * p] = profile[index] - offset
+        parameters[2 + 3 * p] = axis[index]
+        # Consider FWHM = 2.355 * sigma
+        parameters[3 + 3 * p] = _estimate_peak_width(profile, axis, index, offset) / 2.355
+
+    if n_found > 0 and not skip:
+        parameters = _levenberg_marquardt(parameters, axis, profile.astype(numpy.float64), max_iterations)
+
+    amplitudes = numpy.full(n_peaks, numpy.nan)
+    centers = numpy.full(n_peaks, numpy.nan)
+    standard_deviations = numpy.full(n_peaks, numpy.nan)
+
+    order = numpy.argsort(parameters[2::3])
+    for p in range(n_found):
+        amplitudes[p] = parameters[1 + 3 * order[p]]
+        centers[p] = parameters[2 + 3 * order[p]]
+        standard_deviations[p] = abs(parameters[3 + 3 * order[p]])
+
+    return parameters[0], amplitudes, centers, standard_deviations
+
+
+@numba.njit(parallel=True)
+def gauss_fit_stack(profiles, axis, skip, max_iterations, results):
+    """
+    Fit a gaussian to each profile of a stack, parallel over the profiles. The initial parameters are
+    estimated as in gauss_fit, the fit uses the same Levenberg-Marquardt as multi_gauss_fit.
+
+    :param profiles: Profiles to fit, shape (n_profiles, width).
+    :param axis: Common axis of the profiles.
+    :param skip: Boolean array, the estimated parameters are returned for the profiles marked.
+    :param max_iterations: Maximum number of Levenberg-Marquardt iterations.
+    :param results: Output array of shape (n_profiles, 4) with offset, amplitude, center and standard deviation.
+    """
+    for n in numba.prange(profiles.shape[0]):
+        profile = profiles[n]
+
+        offset = profile.min()
+        amplitude = profile.max() - offset
+        center = numpy.dot(axis, profile) / profile.sum()
+
+        # Consider gaussian integral is amplitude * sigma * sqrt(2*pi)
+        integral = 0.0
+        for k in range(1, axis.shape[0]):
+            integral += (axis[k] - axis[k - 1]) * (profile[k] + profile[k - 1] - 2 * offset) / 2
+        standard_deviation = integral / (amplitude * math.sqrt(2 * math.pi))
+
+        parameters = numpy.array([offset, amplitude, center, standard_deviation])
+        if not skip[n] and numpy.isfinite(parameters).all():
+            parameters = _levenberg_marquardt(parameters, axis, profile, max_iterations)
+
+        results[n, 0] = parameters[0]
+        results[n, 1] = parameters[1]
+        results[n, 2] = parameters[2]
+        results[n, 3] = abs(parameters[3])
@@ -0,0 +1,97 @@
+from logging import getLogger
+from threading import Thread, Condition
+
+import zmq
+
+_logger = getLogger(__name__)
+
+
+class LatestSender(object):
+
+    def __init__(self, output_stream):
+        """
+        Latest-only delivery of the data output stream. The processing overwrites a single slot with its latest
+        result, a sender thread sends the slot content with a blocking send. A slow consumer only gets the latest
+        result, the results replaced before being sent are dropped.
+
+        zmq conflate does not support the multipart bsread messages, the conflation is done before zmq.
+
+        :param output_stream: bsread sender, not yet opened, with block=True. The socket is only used by the
+                              sender thread after opening it.
+        """
+        self.output_stream = output_stream
+
+        self.n_sent = 0
+        self.n_dropped = 0
+        self.last_sent_pulse_id = None
+
+        self._latest = None
+        self._running = False
+        self._condition = Condition()
+        self._sender_thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self.output_stream.open()
+
+        self._running = True
+        self._sender_thread = Thread(target=self._send)
+        self._sender_thread.start()
+
+    def stop(self):
+        """
+        Stop the sender thread. The latest result is sent, if the consumer takes it within the send timeout.
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+        self._sender_thread.join()
+        self._sender_thread = None
+
+        self.output_stream.close()
+
+    def send(self, pulse_id, timestamp, data):
+        """
+        Replace the latest result. Never blocks.
+        """
+        with self._condition:
+            if self._latest is not None:
+                self.n_dropped += 1
+
+            self._latest = (pulse_id, timestamp, data)
+            self._condition.notify()
+
+    def _send(self):
+        while True:
+            with self._condition:
+                while self._latest is None and self._running:
+                    self._condition.wait()
+
+                if self._latest is None:
+                    return
+
+                pulse_id, timestamp, data = self._latest
+                self._latest = None
+
+            try:
+                self.output_stream.send(pulse_id=pulse_id, timestamp=timestamp, data=data)
+                self.n_sent += 1
+                self.last_sent_pulse_id = pulse_id
+
+            except zmq.Again:
+                # No consumer within the send timeout: the result is sent again, unless a newer one is available.
+                with self._condition:
+                    if self._latest is not None or not self._running:
+                        self.n_dropped += 1
+                    else:
+                        self._latest = (pulse_id, timestamp, data)
+
+            except Exception:
+                _logger.exception("Error while sending the latest data message.")
@@ -1,9 +1,7 @@
-from threading import Event, Thread
+from threading import Event, Thread, RLock
 
 from logging import getLogger
 
-from copy import deepcopy
-
 from psss_processing import config
 
 _logger = getLogger(__name__)
@@ -25,35 +23,40 @@ class ProcessingManager(object):
 
         self.statistics = {}
 
+        # The REST requests are handled in parallel, start and stop must not overlap.
+        self._lock = RLock()
+
         if auto_start:
             self.start()
 
     def start(self):
+        with self._lock:
 
-        if self._is_running():
-            _logger.debug("Trying to start an already running stream_processor.")
-            return
+            if self._is_running():
+                _logger.debug("Trying to start an already running stream_processor.")
+                return
 
-        self.running_flag = Event()
+            self.running_flag = Event()
 
-        self.processing_thread = Thread(target=self.stream_processor,
-                                        args=(self.running_flag, self.parameters, self.statistics))
+            self.processing_thread = Thread(target=self.stream_processor,
+                                            args=(self.running_flag, self.parameters, self.statistics))
 
-        self.processing_thread.start()
+            self.processing_thread.start()
 
-        if not self.running_flag.wait(timeout=config.PROCESSOR_START_TIMEOUT):
-            self.stop()
+            if not self.running_flag.wait(timeout=config.PROCESSOR_START_TIMEOUT):
+                self.stop()
 
-            raise RuntimeError("Cannot start processing thread in time. Please check error log for more info.")
+                raise RuntimeError("Cannot start processing thread in time. Please check error log for more info.")
 
     def stop(self):
+        with self._lock:
 
-        if self._is_running():
-            self.running_flag.clear()
-            self.processing_thread.join()
+            if self._is_running():
+                self.running_flag.clear()
+                self.processing_thread.join()
 
-        self.processing_thread = None
-        self.running_flag = None
+            self.processing_thread = None
+            self.running_flag = None
 
     def set_parameters(self, parameters):
         self.parameters.update(parameters)
@@ -62,10 +65,11 @@ class ProcessingManager(object):
         return self.parameters
 
     def get_statistics(self):
-        result = deepcopy(self.statistics)
+        # A shallow copy is taken atomically, while the processing thread keeps updating the statistics.
+        # The processing thread replaces the values or increments nested counters, which is safe to serialize.
+        result = dict(self.statistics)
 
-        if "last_calculated_spectrum" in result:
-            del result["last_calculated_spectrum"]
+        result.pop("last_calculated_spectrum", None)
 
         return result
 
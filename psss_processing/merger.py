@@ -0,0 +1,230 @@
+import datetime
+import heapq
+import logging
+import queue
+import time
+from threading import Thread
+
+import zmq
+
+from bsread import source, PULL, SUB
+from bsread.sender import sender
+
+from psss_processing import config
+
+_logger = logging.getLogger(__name__)
+
+
+class PulseReorderBuffer(object):
+
+    def __init__(self, window, max_size=config.MERGER_BUFFER_SIZE, pulse_id_step=1):
+        """
+        Buffer that releases messages ordered by pulse_id.
+
+        :param window: Time in seconds a message is held back waiting for lower pulse_ids.
+        :param max_size: Maximum number of held messages. Above this, the lowest pulse_id is released early.
+        :param pulse_id_step: Expected difference between consecutive pulse_ids, used for gap accounting.
+        """
+        self.window = window
+        self.max_size = max_size
+        self.pulse_id_step = pulse_id_step
+
+        self._heap = []
+        self._pending_pulse_ids = set()
+        self._counter = 0
+
+        self.last_pulse_id = None
+        self.n_released = 0
+        self.n_missing = 0
+        self.n_gaps = 0
+        self.n_late = 0
+        self.n_duplicated = 0
+
+    def add(self, pulse_id, message, arrival_time):
+        """
+        Add a message to the buffer. Messages arriving after a higher pulse_id was already released are dropped.
+
+        :return: True if the message was buffered, False if it was dropped.
+        """
+        if self.last_pulse_id is not None and pulse_id <= self.last_pulse_id:
+            if pulse_id == self.last_pulse_id:
+                self.n_duplicated += 1
+            else:
+                self.n_late += 1
+            return False
+
+        if pulse_id in self._pending_pulse_ids:
+            self.n_duplicated += 1
+            return False
+
+        self._pending_pulse_ids.add(pulse_id)
+        # The counter keeps the heap from comparing messages with equal pulse_id and arrival time.
+        heapq.heappush(self._heap, (pulse_id, arrival_time, self._counter, message))
+        self._counter += 1
+
+        return True
+
+    def pop_ready(self, current_time):
+        """
+        Release all messages that waited at least the window time or exceed the buffer size.
+
+        :return: List of (pulse_id, message) tuples ordered by pulse_id.
+        """
+        released = []
+
+        while self._heap:
+            pulse_id, arrival_time, _, message = self._heap[0]
+
+            if len(self._heap) <= self.max_size and current_time - arrival_time < self.window:
+                break
+
+            heapq.heappop(self._heap)
+            self._pending_pulse_ids.discard(pulse_id)
+            self._account(pulse_id)
+            released.append((pulse_id, message))
+
+        return released
+
+    def flush(self):
+        """
+        Release all buffered messages regardless of their age.
+        """
+        return self.pop_ready(float("inf"))
+
+    def _account(self, pulse_id):
+        if self.last_pulse_id is not None:
+            n_missing = (pulse_id - self.last_pulse_id) // self.pulse_id_step - 1
+            if n_missing > 0:
+                self.n_missing += n_missing
+                self.n_gaps += 1
+
+        self.last_pulse_id = pulse_id
+        self.n_released += 1
+
+    def __len__(self):
+        return len(self._heap)
+
+
+def get_stream_merger(input_stream_addresses, output_stream_port, window_ms=config.DEFAULT_MERGER_WINDOW_MS,
+                      pulse_id_step=1, input_stream_mode=config.DEFAULT_MERGER_INPUT_STREAM_MODE):
+
+    if input_stream_mode not in ("push", "pub"):
+        raise ValueError("Input stream mode must be 'push' or 'pub', but %s was given." % input_stream_mode)
+
+    # the output mode of the processing nodes: pull from push streams, subscribe to pub streams.
+    input_mode = SUB if input_stream_mode == "pub" else PULL
+
+    # without reorder window, wait for the next message instead of polling the queue.
+    receive_timeout = window_ms / 1000 if window_ms > 0 else config.MERGER_RECEIVE_TIMEOUT
+
+    def receive_stream(input_stream_host, input_stream_port, message_queue, running_flag, statistics):
+        _logger.info("Connecting to processing node %s:%s.", input_stream_host, input_stream_port)
+
+        statistics_key = "%s:%s" % (input_stream_host, input_stream_port)
+
+        with source(host=input_stream_host, port=input_stream_port, mode=input_mode,
+                    queue_size=config.INPUT_STREAM_QUEUE_SIZE,
+                    receive_timeout=config.INPUT_STREAM_RECEIVE_TIMEOUT) as input_stream:
+
+            while running_flag.is_set():
+                try:
+                    message = input_stream.receive()
+                except:
+                    _logger.exception("input stream receiving error")
+                    continue
+
+                if message is None:
+                    continue
+
+                data = {name: value.value for name, value in message.data.data.items()}
+                timestamp = (message.data.global_timestamp, message.data.global_timestamp_offset)
+
+                try:
+                    message_queue.put((message.data.pulse_id, timestamp, data), timeout=1)
+                except queue.Full:
+                    _logger.warning("Merger queue full, dropping pulse_id %s from %s.",
+                                    message.data.pulse_id, statistics_key)
+                    continue
+
+                statistics["n_received_per_node"][statistics_key] += 1
+
+    def stream_merger(running_flag, parameters, statistics):
+        try:
+            running_flag.set()
+
+            _logger.info("Merging %d processing nodes with a reorder window of %s ms.",
+                         len(input_stream_addresses), window_ms)
+            _logger.info("Sending out merged data on stream port %s.", output_stream_port)
+
+            message_queue = queue.Queue(maxsize=config.MERGER_INPUT_QUEUE_SIZE)
+            reorder_buffer = PulseReorderBuffer(window=window_ms / 1000, pulse_id_step=pulse_id_step)
+
+            statistics["processing_start_time"] = str(datetime.datetime.now())
+            statistics["last_sent_pulse_id"] = None
+            statistics["last_sent_time"] = None
+            statistics["n_dropped_output"] = 0
+            statistics["n_received_per_node"] = {"%s:%s" % address: 0 for address in input_stream_addresses}
+
+            receiving_threads = []
+            for input_stream_host, input_stream_port in input_stream_addresses:
+                receiving_thread = Thread(target=receive_stream,
+                                          args=(input_stream_host, input_stream_port, message_queue,
+                                                running_flag, statistics),
+                                          daemon=True)
+                receiving_thread.start()
+                receiving_threads.append(receiving_thread)
+
+            with sender(port=output_stream_port, send_timeout=config.OUTPUT_STREAM_SEND_TIMEOUT,
+                        block=False) as output_stream:
+
+                def send_released(released):
+                    for pulse_id, (timestamp, data) in released:
+                        try:
+                            output_stream.send(pulse_id=pulse_id, timestamp=timestamp, data=data)
+
+                            statistics["last_sent_pulse_id"] = pulse_id
+                            statistics["last_sent_time"] = str(datetime.datetime.now())
+                        except zmq.Again:
+                            # The consumer of the merged stream is too slow.
+                            statistics["n_dropped_output"] += 1
+
+                    statistics["n_buffered"] = len(reorder_buffer)
+                    statistics["n_merged"] = reorder_buffer.n_released
+                    statistics["n_missing_pulse_ids"] = reorder_buffer.n_missing
+                    statistics["n_gaps"] = reorder_buffer.n_gaps
+                    statistics["n_late"] = reorder_buffer.n_late
+                    statistics["n_duplicated"] = reorder_buffer.n_duplicated
+
+                while running_flag.is_set():
+
+                    try:
+                        pulse_id, timestamp, data = message_queue.get(timeout=receive_timeout)
+                        reorder_buffer.add(pulse_id, (timestamp, data), time.time())
+                    except queue.Empty:
+                        pass
+
+                    send_released(reorder_buffer.pop_ready(time.time()))
+
+                for receiving_thread in receiving_threads:
+                    receiving_thread.join()
+
+                # the messages already received are sent out before the output stream is closed.
+                while not message_queue.empty():
+                    pulse_id, timestamp, data = message_queue.get_nowait()
+                    reorder_buffer.add(pulse_id, (timestamp, data), time.time())
+
+                send_released(reorder_buffer.flush())
+
+        except Exception as e:
+            _logger.error("Error while merging the streams. Exiting. Error: ", e)
+            running_flag.clear()
+
+            raise
+
+        except KeyboardInterrupt:
+            _logger.warning("Terminating merging due to user request.")
+            running_flag.clear()
+
+            raise
+
+    return stream_merger
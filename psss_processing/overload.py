@@ -0,0 +1,116 @@
+from logging import getLogger
+
+from psss_processing import config
+
+_logger = getLogger(__name__)
+
+OVERLOAD_LEVEL_NORMAL = 0
+# Skip the fitting, the estimated fit parameters are sent out.
+OVERLOAD_LEVEL_NO_FIT = 1
+# Skip the fitting and the smoothing.
+OVERLOAD_LEVEL_NO_SMOOTHING = 2
+# Process only every Nth image, the other images are forwarded only on the image stream.
+OVERLOAD_LEVEL_DECIMATION = 3
+
+
+class LoadShedder(object):
+
+    def __init__(self, high_lag=config.OVERLOAD_HIGH_LAG, low_lag=config.OVERLOAD_LOW_LAG,
+                 escalate_after=config.OVERLOAD_ESCALATE_AFTER, recover_after=config.OVERLOAD_RECOVER_AFTER,
+                 decimation=config.OVERLOAD_DECIMATION, baseline_window=config.OVERLOAD_BASELINE_WINDOW):
+        """
+        Overload policy based on the processing lag: the time between the pulse timestamp and the start of
+        the processing. The lag is measured relative to the lowest lag seen in the last baseline_window seconds,
+        so an offset between the timing system and the local clock does not matter.
+
+        :param high_lag: Lag in seconds above which the overload level is increased.
+        :param low_lag: Lag in seconds below which the overload level is decreased.
+        :param escalate_after: Number of consecutive pulses above high_lag before increasing the level.
+        :param recover_after: Number of consecutive pulses below low_lag before decreasing the level.
+        :param decimation: At the highest level only every decimation-th image is processed.
+        :param baseline_window: The lowest lag is kept for one to two windows of this many seconds, so a single
+                                early low lag does not hold the shedder at a high level for the rest of the run.
+        """
+        self.high_lag = high_lag
+        self.low_lag = low_lag
+        self.escalate_after = escalate_after
+        self.recover_after = recover_after
+        self.decimation = decimation
+        self.baseline_window = baseline_window
+
+        self.n_shed_images = 0
+
+        self.reset()
+
+    def reset(self):
+        """
+        Back to the normal level, and measure the lag again from scratch.
+        """
+        self.level = OVERLOAD_LEVEL_NORMAL
+        self.lag = 0
+
+        self._window_start = None
+        self._window_min_lag = None
+        self._previous_window_min_lag = None
+        self._n_high = 0
+        self._n_low = 0
+        self._n_images = 0
+
+    def update(self, pulse_timestamp, current_time):
+        """
+        Update the overload level with the lag of the current pulse.
+
+        :param pulse_timestamp: Timestamp of the pulse in seconds.
+        :param current_time: Current time in seconds.
+        :return: The overload level to use for this pulse.
+        """
+        lag = current_time - pulse_timestamp
+
+        # Minimum over the current and the previous window.
+        if self._window_start is None or current_time - self._window_start >= self.baseline_window:
+            self._previous_window_min_lag = self._window_min_lag
+            self._window_min_lag = None
+            self._window_start = current_time
+
+        if self._window_min_lag is None or lag < self._window_min_lag:
+            self._window_min_lag = lag
+
+        baseline_lag = self._window_min_lag
+        if self._previous_window_min_lag is not None:
+            baseline_lag = min(baseline_lag, self._previous_window_min_lag)
+
+        self.lag = lag - baseline_lag
+
+        if self.lag > self.high_lag:
+            self._n_high += 1
+            self._n_low = 0
+        elif self.lag < self.low_lag:
+            self._n_low += 1
+            self._n_high = 0
+        else:
+            self._n_high = 0
+            self._n_low = 0
+
+        if self._n_high >= self.escalate_after and self.level < OVERLOAD_LEVEL_DECIMATION:
+            self.level += 1
+            self._n_high = 0
+            _logger.warning("Processing lag %.3f s, increasing overload level to %d.", self.lag, self.level)
+
+        elif self._n_low >= self.recover_after and self.level > OVERLOAD_LEVEL_NORMAL:
+            self.level -= 1
+            self._n_low = 0
+            _logger.info("Processing lag %.3f s, decreasing overload level to %d.", self.lag, self.level)
+
+        return self.level
+
+    def should_process(self):
+        """
+        Check if the current image should be processed, or only forwarded.
+        """
+        self._n_images += 1
+
+        if self.level < OVERLOAD_LEVEL_DECIMATION or self._n_images % self.decimation == 0:
+            return True
+
+        self.n_shed_images += 1
+        return False
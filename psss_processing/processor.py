@@ -8,116 +8,435 @@ import scipy.signal
 import zmq
 import epics
 
-from bsread import source, PULL
+from bsread import source, PULL, PUSH, PUB
 from bsread.sender import sender
 
-from psss_processing import config, functions
+from psss_processing import config, functions, overload
+from psss_processing.averaging import SpectrumAverager
+from psss_processing.background import BackgroundTracker
+from psss_processing.latest import LatestSender
+from psss_processing.profiler import FrameProfiler
+from psss_processing.state import ProcessingState
 
 _logger = logging.getLogger(__name__)
 
 
-def process_image(image, axis, epics_pv_name_prefix, roi, parameters):
-    processed_data = dict()
+def get_bands(roi, rois, nrows):
+    """
+    Convert the main ROI and the additional ROIs into an array of [ymin, ymax) bands clipped to the image.
+    An invalid main ROI selects the full image.
+    """
+    ymin, ymax = roi
+    if not nrows > ymax > ymin > 0:
+        ymin, ymax = 0, nrows
 
-    processed_data[epics_pv_name_prefix + ":processing_parameters"] = \
-        json.dumps({"roi": roi, "background": parameters['background']})
+    bands = [[ymin, ymax]]
+    for band_ymin, band_ymax in rois:
+        band_ymin = min(max(int(band_ymin), 0), nrows)
+        band_ymax = min(max(int(band_ymax), band_ymin), nrows)
+        bands.append([band_ymin, band_ymax])
 
-    processing_image = image
-    nrows, ncols = processing_image.shape
-    # validate background data
-    background_image = parameters.get('background_data')
-    if isinstance(background_image, numpy.ndarray):
-        if background_image.shape != processing_image.shape:
-            background_image = None
-    else:
-        background_image = None
+    return numpy.array(bands, dtype=numpy.int64)
 
-    # crop the image in y direction
-    ymin, ymax = roi
-    if nrows > ymax > ymin > 0:
-        processing_image = processing_image[ymin:ymax, :]
-        if background_image is not None:
-            background_image = background_image[ymin:ymax, :]
-
-    # remove the background and collapse in y direction to get the spectrum
-    if background_image is not None:
-        spectrum = functions.get_spectrum(processing_image, background_image)
-    else:
-        spectrum = processing_image.sum(0, 'uint32')
 
-    # smooth the spectrum with savgol filter with 51 window size and 3rd order polynomial
-    smoothed_spectrum = scipy.signal.savgol_filter(spectrum, 51, 3)
+def bin_spectrum(spectrum, axis, parameters):
+    binning = parameters.get('binning', config.DEFAULT_BINNING)
+    binning_mode = parameters.get('binning_mode', config.DEFAULT_BINNING_MODE)
+
+    return functions.bin_spectrum(spectrum, binning, binning_mode), functions.get_binned_axis(axis, binning)
+
+
+def get_smoothing_window(binning, n_bins):
+    """
+    Window of the savgol filter: 51 pixels, at least 5 bins, and at most the number of bins.
+
+    :return: Odd window length, or 0 if there are less than 5 bins to smooth.
+    """
+    window_length = max(5, (51 // binning) | 1)
+    window_length = min(window_length, n_bins if n_bins % 2 else n_bins - 1)
+
+    return window_length if window_length >= 5 else 0
+
+
+def fit_spectrum(binned_spectrum, binned_axis, nrows, parameters, overload_level=overload.OVERLOAD_LEVEL_NORMAL):
+    binning = max(parameters.get('binning', config.DEFAULT_BINNING), 1)
+    binning_mode = parameters.get('binning_mode', config.DEFAULT_BINNING_MODE)
+
+    # smooth the spectrum with savgol filter with 51 pixels window size and 3rd order polynomial
+    window_length = get_smoothing_window(binning, binned_spectrum.shape[0])
+    if window_length and overload_level < overload.OVERLOAD_LEVEL_NO_SMOOTHING:
+        smoothed_spectrum = scipy.signal.savgol_filter(binned_spectrum, window_length, 3)
+    else:
+        smoothed_spectrum = binned_spectrum.astype("float64")
 
     # check wether spectrum has only noise. the average counts per pixel at the peak
     # should be larger than 1.5 to be considered as having real signals.
     minimum, maximum = smoothed_spectrum.min(), smoothed_spectrum.max()
     amplitude = maximum - minimum
+    pixels_per_bin = binning if binning_mode == "sum" else 1
+    noise_only = amplitude <= nrows * 1.5 * pixels_per_bin
     skip = True
-    if amplitude > nrows * 1.5:
+    if not noise_only and overload_level < overload.OVERLOAD_LEVEL_NO_FIT:
         skip = False
     # gaussian fitting
-    offset, amplitude, center, sigma = functions.gauss_fit(smoothed_spectrum[::2], axis[::2],
+    offset, amplitude, center, sigma = functions.gauss_fit(smoothed_spectrum, binned_axis,
             offset=minimum, amplitude=amplitude, skip=skip)
 
+    fit_results = {"SPECTRUM_CENTER": center,
+                   "SPECTRUM_FWHM": 2.355 * sigma,
+                   "SPECTRUM_NOISE_ONLY": bool(noise_only)}
+
+    # multi gaussian fitting, i.e. for the two color mode
+    n_peaks = parameters.get('n_peaks', config.DEFAULT_N_PEAKS)
+    if n_peaks > 1:
+        _, amplitudes, centers, sigmas = functions.multi_gauss_fit(smoothed_spectrum, binned_axis, n_peaks,
+                                                                   config.MULTI_PEAK_MIN_DISTANCE,
+                                                                   config.MULTI_PEAK_MAX_ITERATIONS, skip)
+
+        fit_results["SPECTRUM_PEAK_CENTERS"] = centers
+        fit_results["SPECTRUM_PEAK_FWHMS"] = 2.355 * sigmas
+        fit_results["SPECTRUM_PEAK_AMPLITUDES"] = amplitudes
+
+    return fit_results
+
+
+def process_image(image, axis, epics_pv_name_prefix, roi, parameters, overload_level=overload.OVERLOAD_LEVEL_NORMAL):
+    processed_data = dict()
+
+    rois = parameters.get('rois') or []
+
+    processed_data[epics_pv_name_prefix + ":processing_parameters"] = \
+        json.dumps({"roi": roi, "rois": rois, "background": parameters['background'],
+                    "calibration": parameters.get('calibration', ""), "gain": parameters.get('gain', "")})
+
+    processing_image = image
+    nrows, ncols = processing_image.shape
+    # validate background data
+    background_image = parameters.get('background_data')
+    if not isinstance(background_image, numpy.ndarray) or background_image.shape != processing_image.shape:
+        background_image = numpy.empty((0, 0), dtype=processing_image.dtype)
+
+    # validate gain data, the fixed point gain is applied in the same pass as the background subtraction
+    gain_image = parameters.get('gain_data')
+    if not isinstance(gain_image, numpy.ndarray) or gain_image.shape != processing_image.shape:
+        gain_image = numpy.empty((0, 0), dtype=numpy.uint16)
+
+    # validate curvature calibration, the corrected spectrum has fractional counts
+    calibration_data = parameters.get('calibration_data')
+    if calibration_data is not None and calibration_data[0].shape[0] == nrows:
+        shift_index, shift_fraction = calibration_data
+        spectrum_dtype = numpy.float64
+    else:
+        shift_index, shift_fraction = numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.float64)
+        spectrum_dtype = numpy.uint32
+
+    # remove the background and collapse in y direction to get the spectrum of each band in a single pass
+    # the image quality metrics are calculated in the same pass, by default only on the rows inside the ROIs
+    bands = get_bands(roi, rois, nrows)
+    spectra = numpy.zeros((len(bands), ncols), dtype=spectrum_dtype)
+    row_profile = numpy.empty(nrows, dtype=numpy.float64)
+    saturation_level = parameters.get('saturation_level', config.DEFAULT_SATURATION_LEVEL)
+    full_image_metrics = parameters.get('full_image_metrics', config.DEFAULT_FULL_IMAGE_METRICS)
+
+    n_saturated, max_value, total_intensity = functions.get_spectra(processing_image, background_image, gain_image,
+                                                                    shift_index, shift_fraction, bands,
+                                                                    saturation_level, full_image_metrics,
+                                                                    spectra, row_profile)
+
+    processed_data[epics_pv_name_prefix + ":SATURATED_PIXELS"] = n_saturated
+    processed_data[epics_pv_name_prefix + ":MAX_PIXEL_VALUE"] = max_value
+    processed_data[epics_pv_name_prefix + ":TOTAL_INTENSITY"] = total_intensity
+    processed_data[epics_pv_name_prefix + ":ROW_PROFILE"] = row_profile
+
+    publish_full_spectrum = parameters.get('publish_full_spectrum', config.DEFAULT_PUBLISH_FULL_SPECTRUM)
+
     # outputs
-    processed_data[epics_pv_name_prefix + ":SPECTRUM_Y"] = spectrum
-    processed_data[epics_pv_name_prefix + ":SPECTRUM_X"] = axis
-    processed_data[epics_pv_name_prefix + ":SPECTRUM_CENTER"] = center
-    processed_data[epics_pv_name_prefix + ":SPECTRUM_FWHM"] = 2.355 * sigma
+    for index, spectrum in enumerate(spectra):
+        # the main ROI keeps the original channel names, additional ROIs are numbered starting with 1.
+        suffix = "_ROI%d" % index if index else ""
+
+        # the binned spectrum is used for smoothing and fitting
+        binned_spectrum, binned_axis = bin_spectrum(spectrum, axis, parameters)
+
+        if publish_full_spectrum:
+            processed_data[epics_pv_name_prefix + ":SPECTRUM_X"] = axis
+            processed_data[epics_pv_name_prefix + ":SPECTRUM_Y" + suffix] = spectrum
+        else:
+            processed_data[epics_pv_name_prefix + ":SPECTRUM_X"] = binned_axis
+            processed_data[epics_pv_name_prefix + ":SPECTRUM_Y" + suffix] = binned_spectrum
+
+        for name, value in fit_spectrum(binned_spectrum, binned_axis, nrows, parameters, overload_level).items():
+            processed_data[epics_pv_name_prefix + ":" + name + suffix] = value
 
     return processed_data
 
 
+def process_images(stack, axis, roi, parameters):
+    """
+    Process a stack of images at once: the spectra are collapsed in a single compiled call and fitted in one batch.
+    Only the main ROI is processed, the multi peak fitting is not done.
+
+    :param stack: Images to process, shape (n_images, height, width).
+    :param axis: Energy axis.
+    :param roi: [ymin, ymax] of the main ROI.
+    :param parameters: Processing parameters, as for process_image.
+    :return: Dictionary with the SPECTRUM_Y (n_images, width), SPECTRUM_CENTER, SPECTRUM_FWHM and
+             SPECTRUM_NOISE_ONLY arrays.
+    """
+    n_images, nrows, ncols = stack.shape
+
+    background_image = parameters.get('background_data')
+    if not isinstance(background_image, numpy.ndarray) or background_image.shape != (nrows, ncols):
+        background_image = numpy.empty((0, 0), dtype=stack.dtype)
+
+    gain_image = parameters.get('gain_data')
+    if not isinstance(gain_image, numpy.ndarray) or gain_image.shape != (nrows, ncols):
+        gain_image = numpy.empty((0, 0), dtype=numpy.uint16)
+
+    bands = get_bands(roi, [], nrows)
+
+    calibration_data = parameters.get('calibration_data')
+    if calibration_data is not None and calibration_data[0].shape[0] == nrows:
+        # the curvature correction is done image by image, with the same kernel as process_image
+        shift_index, shift_fraction = calibration_data
+        spectra = numpy.zeros((n_images, 1, ncols), dtype=numpy.float64)
+        row_profile = numpy.empty(nrows, dtype=numpy.float64)
+        saturation_level = parameters.get('saturation_level', config.DEFAULT_SATURATION_LEVEL)
+
+        for index in range(n_images):
+            functions.get_spectra(stack[index], background_image, gain_image, shift_index, shift_fraction, bands,
+                                  saturation_level, False, spectra[index], row_profile)
+        spectra = spectra[:, 0]
+    else:
+        spectra = numpy.zeros((n_images, ncols), dtype=numpy.uint32)
+        functions.get_stack_spectra(stack, background_image, gain_image, bands[0, 0], bands[0, 1], spectra)
+
+    binning = max(parameters.get('binning', config.DEFAULT_BINNING), 1)
+    binning_mode = parameters.get('binning_mode', config.DEFAULT_BINNING_MODE)
+    binned_spectra, binned_axis = bin_spectrum(spectra, axis, parameters)
+
+    # same smoothing and noise check as fit_spectrum, for all spectra at once
+    window_length = get_smoothing_window(binning, binned_spectra.shape[1])
+    if window_length:
+        smoothed_spectra = scipy.signal.savgol_filter(binned_spectra, window_length, 3, axis=-1)
+    else:
+        smoothed_spectra = binned_spectra.astype("float64")
+
+    amplitudes = smoothed_spectra.max(axis=1) - smoothed_spectra.min(axis=1)
+    pixels_per_bin = binning if binning_mode == "sum" else 1
+    noise_only = amplitudes <= nrows * 1.5 * pixels_per_bin
+
+    fit_results = numpy.empty((n_images, 4), dtype=numpy.float64)
+    functions.gauss_fit_stack(smoothed_spectra, numpy.asarray(binned_axis, dtype=numpy.float64), noise_only,
+                              config.MULTI_PEAK_MAX_ITERATIONS, fit_results)
+
+    return {"SPECTRUM_Y": spectra,
+            "SPECTRUM_CENTER": fit_results[:, 2],
+            "SPECTRUM_FWHM": 2.355 * fit_results[:, 3],
+            "SPECTRUM_NOISE_ONLY": noise_only}
+
+
+def process_averages(averager, processed_data, epics_pv_name_prefix, nrows, parameters,
+                     overload_level=overload.OVERLOAD_LEVEL_NORMAL):
+    average_window = parameters.get('average_window', config.DEFAULT_AVERAGE_WINDOW)
+    ema_alpha = parameters.get('ema_alpha', config.DEFAULT_EMA_ALPHA)
+
+    if not average_window and not ema_alpha:
+        return
+
+    moving_average, ema = averager.update(processed_data[epics_pv_name_prefix + ":SPECTRUM_Y"],
+                                          average_window, ema_alpha)
+
+    if moving_average is not None:
+        processed_data[epics_pv_name_prefix + ":SPECTRUM_Y_AVG"] = moving_average
+
+        # the averaged spectrum is fitted at a lower rate, the last results are sent out in between.
+        fit_interval = parameters.get('average_fit_interval', config.DEFAULT_AVERAGE_FIT_INTERVAL)
+        if fit_interval > 0:
+            # also fitted when the fit is enabled while processing, the first results are not available yet.
+            if averager.fit_results is None or (averager.n_updates - 1) % fit_interval == 0:
+                if parameters.get('publish_full_spectrum', config.DEFAULT_PUBLISH_FULL_SPECTRUM):
+                    binned_average, binned_axis = bin_spectrum(moving_average,
+                                                               processed_data[epics_pv_name_prefix + ":SPECTRUM_X"],
+                                                               parameters)
+                else:
+                    binned_average = moving_average
+                    binned_axis = processed_data[epics_pv_name_prefix + ":SPECTRUM_X"]
+
+                averager.fit_results = fit_spectrum(binned_average, binned_axis, nrows, parameters, overload_level)
+
+            for name, value in averager.fit_results.items():
+                processed_data[epics_pv_name_prefix + ":" + name + "_AVG"] = value
+
+    if ema is not None:
+        processed_data[epics_pv_name_prefix + ":SPECTRUM_Y_EMA"] = ema
+
+
+def check_calibration(parameters, nrows, statistics):
+    """
+    The curvature calibration is applied only to images with the same number of rows. Otherwise the processing
+    continues without calibration, the mismatch is reported in the statistics and logged once.
+    """
+    calibration_data = parameters.get('calibration_data')
+
+    calibration_error = None
+    if calibration_data is not None and calibration_data[0].shape[0] != nrows:
+        calibration_error = "Calibration '%s' has %d rows, but the image has %d rows. The calibration is not " \
+                            "applied." % (parameters.get('calibration', ""), calibration_data[0].shape[0], nrows)
+
+        if statistics.get("calibration_error") != calibration_error:
+            _logger.warning(calibration_error)
+
+    statistics["calibration_error"] = calibration_error
+
+
+def track_background(background_tracker, image, message_data, processed_data, epics_pv_name_prefix, parameters,
+                     statistics):
+    mode = parameters.get('background_tracking', config.DEFAULT_BACKGROUND_TRACKING)
+
+    if not mode:
+        if background_tracker.background is not None:
+            background_tracker.reset()
+        return
+
+    # beam off images are marked by a channel in the input stream, or recognized by a spectrum with only noise
+    beam_off_channel = parameters.get('beam_off_channel')
+    if beam_off_channel:
+        if beam_off_channel not in message_data:
+            return
+        beam_off = message_data[beam_off_channel].value == parameters.get('beam_off_value', 0)
+    else:
+        beam_off = processed_data[epics_pv_name_prefix + ":SPECTRUM_NOISE_ONLY"]
+
+    if not beam_off:
+        return
+
+    if mode == "median":
+        rate = parameters.get('background_tracking_step', config.DEFAULT_BACKGROUND_TRACKING_STEP)
+    else:
+        rate = parameters.get('background_tracking_alpha', config.DEFAULT_BACKGROUND_TRACKING_ALPHA)
+
+    background_tracker.update(image, mode, rate)
+    statistics["n_dark_images"] = background_tracker.n_dark_images
+
+    # the updated background is used by the next images, without stopping the processing
+    update_interval = parameters.get('background_update_interval', config.DEFAULT_BACKGROUND_UPDATE_INTERVAL)
+    if background_tracker.n_dark_images % update_interval == 0:
+        parameters["background_data"] = background_tracker.get_background(image.dtype)
+        parameters["background"] = "tracked_%s" % mode
+
+        statistics["last_background_update"] = str(datetime.datetime.now())
+        _logger.info("Background updated from %d dark images.", background_tracker.n_dark_images)
+
+
+def get_input_pv_value(pv, pv_name, message_channels):
+    """
+    Value of an input PV (ROI, energy axis). While the PV is not connected, a channel of the input message with
+    the PV name is used instead, as in the replay of a captured stream.
+
+    :return: The value, or None if not available.
+    """
+    if pv.connected:
+        return pv.value
+
+    channel = message_channels.get(pv_name)
+    return channel.value if channel is not None else None
+
+
 def get_stream_processor(input_stream_host, input_stream_port, data_output_stream_port, image_output_stream_port,
                          epics_pv_name_prefix, output_pv_name, center_pv_name, fwhm_pv_name, ymin_pv_name,
-                         ymax_pv_name, axis_pv_name):
+                         ymax_pv_name, axis_pv_name, recorder=None, result_ring=None, profiler=None,
+                         thread_topology=None, state_file=None, capture=None,
+                         data_output_stream_mode=config.DEFAULT_DATA_OUTPUT_STREAM_MODE,
+                         data_output_stream_queue_size=config.DEFAULT_DATA_OUTPUT_STREAM_QUEUE_SIZE,
+                         data_output_stream_conflate=False):
+
+    if data_output_stream_mode not in ("push", "pub"):
+        raise ValueError("Data output stream mode must be 'push' or 'pub', but %s was given." %
+                         data_output_stream_mode)
+
+    # with PUB each subscriber gets all messages, up to the queue size (high water mark) per subscriber.
+    # zmq conflate does not support multipart messages, with conflation a sender thread sends the latest result
+    # with a high water mark of 1, and the results replaced before being sent are dropped.
+    data_output_mode = PUB if data_output_stream_mode == "pub" else PUSH
+    if data_output_stream_conflate:
+        data_output_stream_queue_size = 1
+
+    if profiler is None:
+        profiler = FrameProfiler()
+
+    processing_state = ProcessingState(state_file)
+    processing_state.load()
+
     def stream_processor(running_flag, parameters, statistics):
+        pvs = []
+
         try:
             running_flag.set()
 
             _logger.info("Connecting to input_stream_host %s and input_stream_port %s.",
                          input_stream_host, input_stream_port)
 
-            _logger.info("Sending out data on stream port %s.", data_output_stream_port)
+            _logger.info("Sending out data on stream port %s in %s mode with queue size %s.",
+                         data_output_stream_port, data_output_stream_mode, data_output_stream_queue_size)
             _logger.info("Sending out images on stream port %s.", image_output_stream_port)
 
+            # The PVs are connected in the background, a missing IOC does not delay the processing.
+            pv_connections = {pv_name: False for pv_name in [output_pv_name, center_pv_name, fwhm_pv_name,
+                                                             ymin_pv_name, ymax_pv_name, axis_pv_name] if pv_name}
+            statistics["pv_connections"] = pv_connections
+
+            def connect_pv(pv_name):
+                def connection_callback(conn, **kwargs):
+                    pv_connections[pv_name] = conn
+                    _logger.info("EPICS PV %s %s.", pv_name, "connected" if conn else "disconnected")
+
+                pv = epics.PV(pv_name, connection_callback=connection_callback)
+                pvs.append(pv)
+
+                return pv
+
             if output_pv_name:
                 _logger.info("Sending out spectrum data on EPICS PV %s.", output_pv_name)
                 epics.ca.clear_cache()
-                output_pv = epics.PV(output_pv_name)
+                output_pv = connect_pv(output_pv_name)
             else:
                 _logger.warning("Output EPICS PV not specified. Only bsread will be sent out.")
 
             if center_pv_name:
                 _logger.info("Sending out spectrum center on EPICS PV %s.", center_pv_name)
-                center_pv = epics.PV(center_pv_name)
+                center_pv = connect_pv(center_pv_name)
             else:
                 _logger.warning("Output EPICS PV not specified. Only bsread will be sent out.")
 
             if fwhm_pv_name:
                 _logger.info("Sending out spectrum fwhm on EPICS PV %s.", fwhm_pv_name)
-                fwhm_pv = epics.PV(fwhm_pv_name)
+                fwhm_pv = connect_pv(fwhm_pv_name)
             else:
                 _logger.warning("Output EPICS PV not specified. Only bsread will be sent out.")
             # EPICS PV for vertical ROI
             if ymin_pv_name:
-                ymin_pv = epics.PV(ymin_pv_name)
-                ymin_pv.wait_for_connection()
+                ymin_pv = connect_pv(ymin_pv_name)
             if ymax_pv_name:
-                ymax_pv = epics.PV(ymax_pv_name)
-                ymax_pv.wait_for_connection()
+                ymax_pv = connect_pv(ymax_pv_name)
             if axis_pv_name:
-                axis_pv = epics.PV(axis_pv_name)
-                axis_pv.wait_for_connection()
+                axis_pv = connect_pv(axis_pv_name)
 
-            roi = [0, 0]
+            # Until the PVs are connected, the last known ROI and axis are used.
+            roi = list(processing_state.roi) if processing_state.roi else [0, 0]
 
             with source(host=input_stream_host, port=input_stream_port, mode=PULL,
                         queue_size=config.INPUT_STREAM_QUEUE_SIZE,
                         receive_timeout=config.INPUT_STREAM_RECEIVE_TIMEOUT) as input_stream:
 
-                with sender(port=data_output_stream_port, send_timeout=config.OUTPUT_STREAM_SEND_TIMEOUT,
-                            block=False) as data_output_stream:
+                data_output_stream = sender(port=data_output_stream_port, mode=data_output_mode,
+                                            send_timeout=config.OUTPUT_STREAM_SEND_TIMEOUT,
+                                            block=data_output_stream_conflate,
+                                            queue_size=data_output_stream_queue_size)
+                if data_output_stream_conflate:
+                    data_output_stream = LatestSender(data_output_stream)
+
+                with data_output_stream:
 
                     with sender(port=image_output_stream_port, send_timeout=config.OUTPUT_STREAM_SEND_TIMEOUT,
                                 block=False, queue_size=config.IMAGE_OUTPUT_STREAM_QUEUE_SIZE) as image_output_stream:
@@ -127,14 +446,24 @@ def get_stream_processor(input_stream_host, input_stream_port, data_output_strea
                         image_output_stream.stream.zmq_copy = False
                         image_output_stream.stream.zmq_track = True
 
+                        # The zmq and EPICS threads are started, only the processing thread is pinned.
+                        if thread_topology is not None:
+                            thread_topology.pin_processing_thread()
+                            statistics["thread_topology"] = thread_topology.get_topology()
+
                         statistics["processing_start_time"] = str(datetime.datetime.now())
                         statistics["last_sent_pulse_id"] = None
                         statistics["last_sent_time"] = None
                         statistics["last_calculated_spectrum"] = None
                         statistics["n_processed_images"] = 0
+                        statistics["n_dropped_data_messages"] = 0
 
                         image_property_name = epics_pv_name_prefix + config.EPICS_PV_SUFFIX_IMAGE
 
+                        averager = SpectrumAverager()
+                        load_shedder = overload.LoadShedder()
+                        background_tracker = BackgroundTracker()
+
                         _logger.info("Using image_to_process property name '%s'.", image_property_name)
 
                         while running_flag.is_set():
@@ -156,41 +485,98 @@ def get_stream_processor(input_stream_host, input_stream_port, data_output_strea
                             if image_to_process is None:
                                 continue
 
+                            profiler.frame_start()
+
                             _logger.debug("Received message with pulse_id %s", pulse_id)
 
                             image_data = {image_property_name: image_to_process}
 
-                            if ymin_pv_name and ymin_pv.connected:
-                                roi[0] = ymin_pv.value
-                            if ymax_pv_name and ymax_pv.connected:
-                                roi[1] = ymax_pv.value
-                            if axis_pv_name and axis_pv.connected:
-                                axis = axis_pv.value
+                            if parameters.get('load_shedding', config.DEFAULT_LOAD_SHEDDING):
+                                pulse_time = message.data.global_timestamp + \
+                                    message.data.global_timestamp_offset / 1e9
+                                overload_level = load_shedder.update(pulse_time, start_time)
+                                process = load_shedder.should_process()
                             else:
-                                axis = None
+                                # when enabled again, the lag is measured from scratch.
+                                load_shedder.reset()
+                                overload_level = overload.OVERLOAD_LEVEL_NORMAL
+                                process = True
+
+                            statistics["overload_level"] = overload_level
+                            statistics["processing_lag_ms"] = load_shedder.lag * 1000
+                            statistics["n_shed_images"] = load_shedder.n_shed_images
+
+                            axis_value = None
+
+                            if ymin_pv_name:
+                                ymin = get_input_pv_value(ymin_pv, ymin_pv_name, message.data.data)
+                                if ymin is not None:
+                                    roi[0] = ymin
+                            if ymax_pv_name:
+                                ymax = get_input_pv_value(ymax_pv, ymax_pv_name, message.data.data)
+                                if ymax is not None:
+                                    roi[1] = ymax
+                            if axis_pv_name:
+                                axis_value = get_input_pv_value(axis_pv, axis_pv_name, message.data.data)
+
+                            processing_state.update(roi, axis_value)
+
+                            axis = processing_state.axis
 
                             if axis is None or len(axis) != image_to_process.shape[1]:
                                 _logger.warn("Invalid energy axis")
                                 continue
 
-                            processed_data = process_image(image_to_process,
-                                                           axis,
-                                                           epics_pv_name_prefix,
-                                                           roi,
-                                                           parameters)
+                            if capture is not None:
+                                capture.capture(pulse_id, timestamp, image_to_process, roi, axis)
 
-                            try:
-                                data_output_stream.send(pulse_id=pulse_id,
-                                                        timestamp=timestamp,
-                                                        data=processed_data)
+                            check_calibration(parameters, image_to_process.shape[0], statistics)
 
-                                _logger.debug("Sent data message with pulse_id %s", pulse_id)
+                            profiler.lap("prepare")
 
-                                statistics["last_sent_pulse_id"] = pulse_id
-                                statistics["last_sent_time"] = str(datetime.datetime.now())
-                            except zmq.Again:
-                                pass
+                            if process:
+                                processed_data = process_image(image_to_process,
+                                                               axis,
+                                                               epics_pv_name_prefix,
+                                                               roi,
+                                                               parameters,
+                                                               overload_level)
+                                profiler.lap("process_image")
 
+                                process_averages(averager, processed_data, epics_pv_name_prefix,
+                                                 image_to_process.shape[0], parameters, overload_level)
+                                profiler.lap("averages")
+
+                                track_background(background_tracker, image_to_process, message.data.data,
+                                                 processed_data, epics_pv_name_prefix, parameters, statistics)
+                                profiler.lap("background")
+
+                                try:
+                                    data_output_stream.send(pulse_id=pulse_id,
+                                                            timestamp=timestamp,
+                                                            data=processed_data)
+
+                                    _logger.debug("Sent data message with pulse_id %s", pulse_id)
+
+                                    statistics["last_sent_pulse_id"] = pulse_id
+                                    statistics["last_sent_time"] = str(datetime.datetime.now())
+                                except zmq.Again:
+                                    statistics["n_dropped_data_messages"] += 1
+
+                                # The latest result is sent in the background, the sent and dropped are counted there.
+                                if data_output_stream_conflate:
+                                    statistics["last_sent_pulse_id"] = data_output_stream.last_sent_pulse_id
+                                    statistics["n_dropped_data_messages"] = data_output_stream.n_dropped
+
+                                if recorder is not None:
+                                    recorder.record(pulse_id, timestamp, processed_data, epics_pv_name_prefix)
+
+                                if result_ring is not None:
+                                    result_ring.publish(pulse_id, timestamp, processed_data, epics_pv_name_prefix)
+
+                                profiler.lap("send_data")
+
+                            # under overload, images which are not processed are still forwarded
                             try:
                                 image_output_stream.send(pulse_id=pulse_id,
                                                          timestamp=timestamp,
@@ -200,6 +586,12 @@ def get_stream_processor(input_stream_host, input_stream_port, data_output_strea
                             except zmq.Again:
                                 pass
 
+                            profiler.lap("send_image")
+
+                            if not process:
+                                profiler.frame_end()
+                                continue
+
                             statistics["last_calculated_spectrum"] = processed_data[epics_pv_name_prefix +
                                                                                     ":SPECTRUM_Y"]
                             statistics["n_processed_images"] = statistics.get("n_processed_images", 0) + 1
@@ -214,6 +606,9 @@ def get_stream_processor(input_stream_host, input_stream_port, data_output_strea
                             if fwhm_pv_name and fwhm_pv.connected:
                                 fwhm_pv.put(processed_data[epics_pv_name_prefix + ":SPECTRUM_FWHM"])
 
+                            profiler.lap("epics")
+                            profiler.frame_end()
+
                             duration = (time.time() - start_time) * 1000
                             statistics["last_processing_duration_ms"] = duration
 
@@ -229,4 +624,10 @@ def get_stream_processor(input_stream_host, input_stream_port, data_output_strea
 
             raise
 
+        finally:
+            # each start creates new PVs, the connection callbacks of this run must not update the next one.
+            # disconnect removes all the callbacks of the PV.
+            for pv in pvs:
+                pv.disconnect()
+
     return stream_processor
@@ -0,0 +1,223 @@
+import cProfile
+import io
+import pstats
+import sys
+import time
+from collections import Counter, OrderedDict
+from logging import getLogger
+from threading import Event, Thread, Lock, get_ident, enumerate as enumerate_threads
+
+import numba
+
+from psss_processing import config, functions
+
+_logger = getLogger(__name__)
+
+
+class ProfilingSession(object):
+
+    def __init__(self, n_frames, collapsed_stacks):
+        self.n_frames = n_frames
+        self.collapsed_stacks = collapsed_stacks
+
+        self.profile = cProfile.Profile()
+        self.stages = OrderedDict()
+        self.kernels = OrderedDict()
+        self.stacks = Counter()
+
+        self.n_profiled_frames = 0
+        self.started = False
+        self.cancelled = False
+        self.original_kernels = {}
+        self.start_time = None
+        self.duration = None
+        self.thread_id = None
+
+        self.done = Event()
+
+
+class FrameProfiler(object):
+
+    def __init__(self, sample_interval=config.PROFILE_SAMPLE_INTERVAL):
+        """
+        Profile the live processing loop for a number of frames, on request. When no profiling is requested,
+        the processing loop only pays an attribute check per call.
+
+        :param sample_interval: Interval in seconds between the stack samples for the collapsed stacks.
+        """
+        self.sample_interval = sample_interval
+
+        self._session = None
+        self._lock = Lock()
+        self._lap_time = 0
+
+    def profile(self, n_frames, collapsed_stacks=False, timeout=config.PROFILE_TIMEOUT):
+        """
+        Profile the next n_frames frames of the processing. Blocks until the frames are processed.
+
+        :param n_frames: Number of frames to profile.
+        :param collapsed_stacks: Sample the stack of the processing thread, in the collapsed format for flamegraphs.
+        :param timeout: Maximum time in seconds to wait for the frames.
+        :return: Profiling report (dictionary).
+        """
+        if n_frames < 1:
+            raise ValueError("Number of frames must be at least 1, but %s was given." % n_frames)
+
+        with self._lock:
+            if self._session is not None:
+                # A cancelled session is finished by the processing thread, unless the thread does not exist anymore.
+                if not self._session.cancelled or self._session.thread_id in [t.ident for t in enumerate_threads()]:
+                    raise RuntimeError("Profiling already running.")
+
+            session = ProfilingSession(n_frames, collapsed_stacks)
+            self._session = session
+
+        if not session.done.wait(timeout):
+            with self._lock:
+                if session.started:
+                    # Only the processing thread can disable the profile.
+                    session.cancelled = True
+                    self._restore_kernels(session)
+                else:
+                    self._session = None
+
+            raise RuntimeError("Only %d of %d frames processed in %s seconds." %
+                               (session.n_profiled_frames, n_frames, timeout))
+
+        return self._get_report(session)
+
+    def frame_start(self):
+        """
+        Called by the processing loop when a frame is received.
+        """
+        session = self._session
+        if session is None:
+            return
+
+        if session.cancelled:
+            self._finish(session)
+            return
+
+        if not session.started:
+            self._start(session)
+
+        self._lap_time = time.perf_counter()
+
+    def lap(self, stage):
+        """
+        Called by the processing loop after each stage of the processing of a frame.
+        """
+        session = self._session
+        if session is None or not session.started or session.cancelled:
+            return
+
+        now = time.perf_counter()
+        session.stages[stage] = session.stages.get(stage, 0) + now - self._lap_time
+        self._lap_time = now
+
+    def frame_end(self):
+        """
+        Called by the processing loop when the processing of a frame is done.
+        """
+        session = self._session
+        if session is None or not session.started:
+            return
+
+        session.n_profiled_frames += 1
+
+        if session.cancelled or session.n_profiled_frames >= session.n_frames:
+            self._finish(session)
+
+    def _start(self, session):
+        session.started = True
+        session.thread_id = get_ident()
+        session.start_time = time.perf_counter()
+
+        # The time spent in the numba kernels is not visible to cProfile, the kernels are timed by wrappers.
+        kernels = {name: kernel for name, kernel in vars(functions).items()
+                   if isinstance(kernel, numba.core.registry.CPUDispatcher)}
+
+        # Kernels called by other kernels are resolved by numba at compile time and must stay untouched.
+        called_kernels = set(name for kernel in kernels.values() for name in kernel.py_func.__code__.co_names)
+
+        for name, kernel in kernels.items():
+            if name not in called_kernels:
+                session.original_kernels[name] = kernel
+                setattr(functions, name, self._get_timed_kernel(session, name, kernel))
+
+        if session.collapsed_stacks:
+            Thread(target=self._sample_stacks, args=(session,), daemon=True).start()
+
+        session.profile.enable()
+
+    def _finish(self, session):
+        session.profile.disable()
+        session.duration = time.perf_counter() - session.start_time
+
+        with self._lock:
+            self._restore_kernels(session)
+            self._session = None
+
+        session.done.set()
+
+    @staticmethod
+    def _restore_kernels(session):
+        for name, kernel in session.original_kernels.items():
+            setattr(functions, name, kernel)
+
+        session.original_kernels = {}
+
+    @staticmethod
+    def _get_timed_kernel(session, name, kernel):
+        timer = session.kernels[name] = {"calls": 0, "time": 0.0}
+
+        def timed_kernel(*args, **kwargs):
+            start_time = time.perf_counter()
+            result = kernel(*args, **kwargs)
+            timer["time"] += time.perf_counter() - start_time
+            timer["calls"] += 1
+            return result
+
+        return timed_kernel
+
+    def _sample_stacks(self, session):
+        while session.duration is None:
+            frame = sys._current_frames().get(session.thread_id)
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s (%s:%d)" % (code.co_name, code.co_filename.rsplit("/", 1)[-1], code.co_firstlineno))
+                frame = frame.f_back
+
+            if stack:
+                session.stacks[";".join(reversed(stack))] += 1
+
+            time.sleep(self.sample_interval)
+
+    @staticmethod
+    def _get_report(session):
+        n_frames = session.n_profiled_frames
+
+        stream = io.StringIO()
+        stats = pstats.Stats(session.profile, stream=stream)
+        stats.sort_stats("cumulative").print_stats(config.PROFILE_REPORT_LINES)
+
+        report = {"n_frames": n_frames,
+                  "duration_s": session.duration,
+                  "frame_rate": n_frames / session.duration if session.duration else 0,
+                  "stages_ms_per_frame": OrderedDict((stage, duration / n_frames * 1000)
+                                                     for stage, duration in session.stages.items()),
+                  "kernels": OrderedDict((name, {"calls": timer["calls"],
+                                                 "total_ms": timer["time"] * 1000,
+                                                 "ms_per_call": timer["time"] / timer["calls"] * 1000})
+                                         for name, timer in sorted(session.kernels.items(),
+                                                                   key=lambda item: -item[1]["time"])
+                                         if timer["calls"]),
+                  "report": stream.getvalue()}
+
+        if session.collapsed_stacks:
+            report["collapsed_stacks"] = "\n".join("%s %d" % (stack, count)
+                                                   for stack, count in session.stacks.most_common())
+
+        return report
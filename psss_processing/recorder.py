@@ -0,0 +1,250 @@
+import datetime
+import os
+import time
+from logging import getLogger
+
+import numpy
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from psss_processing import config
+from psss_processing.writer import BackgroundWriter
+
+_logger = getLogger(__name__)
+
+RECORDING_FORMAT_HDF5 = "h5"
+RECORDING_FORMAT_NPY = "npy"
+
+
+class HDF5Writer(object):
+
+    def __init__(self, filename, spectrum_x, spectrum_dtype, chunk_size, compression):
+        """
+        Append rows to resizable, chunked datasets of an HDF5 file.
+        """
+        self.filename = filename
+        self.file = h5py.File(filename, "w")
+
+        self.file.create_dataset("spectrum_x", data=spectrum_x)
+
+        self.spectrum_width = spectrum_x.shape[0]
+        self.datasets = {}
+        for name, dtype, shape in [("pulse_id", numpy.uint64, ()),
+                                   ("global_timestamp", numpy.int64, ()),
+                                   ("global_timestamp_offset", numpy.int64, ()),
+                                   ("spectrum_y", spectrum_dtype, (self.spectrum_width,)),
+                                   ("spectrum_center", numpy.float64, ()),
+                                   ("spectrum_fwhm", numpy.float64, ())]:
+            self.datasets[name] = self.file.create_dataset(name, shape=(0,) + shape, maxshape=(None,) + shape,
+                                                           dtype=dtype, chunks=(chunk_size,) + shape,
+                                                           compression=compression)
+
+        self.n_rows = 0
+
+    def append(self, columns):
+        n_new_rows = len(columns["pulse_id"])
+
+        for name, dataset in self.datasets.items():
+            dataset.resize(self.n_rows + n_new_rows, axis=0)
+            dataset[self.n_rows:] = columns[name]
+
+        self.n_rows += n_new_rows
+        self.file.flush()
+
+    def get_size(self):
+        return os.path.getsize(self.filename)
+
+    def close(self):
+        self.file.close()
+
+
+class NpyWriter(object):
+
+    def __init__(self, filename, spectrum_x, spectrum_dtype, chunk_size, compression):
+        """
+        Fallback when h5py is not available: keep the rows of the segment in memory and save them as a
+        npz file when the segment is closed.
+        """
+        self.filename = filename
+        self.spectrum_x = spectrum_x
+        self.spectrum_width = spectrum_x.shape[0]
+        self.compression = compression
+
+        self.columns = {}
+        self.n_rows = 0
+        self.size = 0
+
+    def append(self, columns):
+        for name, values in columns.items():
+            self.columns.setdefault(name, []).append(values)
+            self.size += values.nbytes
+
+        self.n_rows += len(columns["pulse_id"])
+
+    def get_size(self):
+        return self.size
+
+    def close(self):
+        arrays = {name: numpy.concatenate(values) for name, values in self.columns.items()}
+
+        if self.compression:
+            numpy.savez_compressed(self.filename, spectrum_x=self.spectrum_x, **arrays)
+        else:
+            numpy.savez(self.filename, spectrum_x=self.spectrum_x, **arrays)
+
+
+class SpectrumRecorder(BackgroundWriter):
+
+    name = "Recording"
+    running_status = "recording"
+
+    def __init__(self, output_directory=config.DEFAULT_RECORDING_DIRECTORY,
+                 queue_size=config.RECORDING_QUEUE_SIZE, batch_size=config.RECORDING_BATCH_SIZE):
+        """
+        Record the processed spectra to disk. The processing only puts the values into a queue, a writer
+        thread appends them to the file in batches.
+
+        :param output_directory: Default directory for the recording files.
+        :param queue_size: Maximum number of pulses waiting to be written. Pulses are dropped when the queue is full.
+        :param batch_size: Maximum number of pulses appended to the file at once.
+        """
+        super(SpectrumRecorder, self).__init__(queue_size, config.RECORDING_QUEUE_TIMEOUT, batch_size)
+
+        self.output_directory = output_directory
+
+        self._writer = None
+        self._file_start_time = 0
+
+    def start(self, output_directory=None, file_prefix=config.DEFAULT_RECORDING_FILE_PREFIX,
+              recording_format=None, max_file_size_mb=config.DEFAULT_RECORDING_MAX_FILE_SIZE_MB,
+              max_file_duration_s=config.DEFAULT_RECORDING_MAX_FILE_DURATION_S,
+              compression=config.DEFAULT_RECORDING_COMPRESSION):
+        """
+        Start a new recording.
+
+        :param output_directory: Directory for the files, by default the one given in the constructor.
+        :param file_prefix: Prefix of the file names. The file names are suffixed with the file creation time.
+        :param recording_format: "h5" or "npy". By default HDF5 is used if h5py is available.
+        :param max_file_size_mb: Start a new file after this size. 0 disables the size rotation.
+        :param max_file_duration_s: Start a new file after this time. 0 disables the time rotation.
+        :param compression: Compress the data (gzip for HDF5).
+        """
+        if recording_format is None:
+            recording_format = RECORDING_FORMAT_HDF5 if h5py is not None else RECORDING_FORMAT_NPY
+
+        if recording_format not in (RECORDING_FORMAT_HDF5, RECORDING_FORMAT_NPY):
+            raise ValueError("Invalid recording format '%s'. Use '%s' or '%s'." %
+                             (recording_format, RECORDING_FORMAT_HDF5, RECORDING_FORMAT_NPY))
+
+        if recording_format == RECORDING_FORMAT_HDF5 and h5py is None:
+            raise ValueError("HDF5 recording requires h5py, use the '%s' format instead." % RECORDING_FORMAT_NPY)
+
+        output_directory = output_directory or self.output_directory
+        os.makedirs(output_directory, exist_ok=True)
+
+        self._start(settings={"output_directory": output_directory,
+                              "file_prefix": file_prefix,
+                              "recording_format": recording_format,
+                              "max_file_size_mb": max_file_size_mb,
+                              "max_file_duration_s": max_file_duration_s,
+                              "compression": compression},
+                    statistics={"recording_start_time": str(datetime.datetime.now()),
+                                "n_recorded": 0,
+                                "n_dropped": 0,
+                                "files": []})
+
+        _logger.info("Recording started in %s.", output_directory)
+
+    def is_recording(self):
+        return self.is_running()
+
+    def get_statistics(self):
+        statistics = super(SpectrumRecorder, self).get_statistics()
+        statistics["files"] = list(statistics.get("files", []))
+
+        return statistics
+
+    def record(self, pulse_id, timestamp, processed_data, epics_pv_name_prefix):
+        """
+        Queue the processed data of one pulse. Never blocks: when the writer is behind, the pulse is dropped.
+        """
+        if not self.is_recording():
+            return
+
+        self._put((pulse_id, timestamp,
+                   processed_data[epics_pv_name_prefix + ":SPECTRUM_X"],
+                   processed_data[epics_pv_name_prefix + ":SPECTRUM_Y"],
+                   processed_data[epics_pv_name_prefix + ":SPECTRUM_CENTER"],
+                   processed_data[epics_pv_name_prefix + ":SPECTRUM_FWHM"]))
+
+    def _write_batch(self, batch, settings):
+        max_file_size = settings["max_file_size_mb"] * 1024 * 1024
+        max_file_duration = settings["max_file_duration_s"]
+
+        # Rows with a different spectrum width (binning changed) go to a new file.
+        for rows in _split_by_width(batch):
+            spectrum_x = rows[0][2]
+
+            if self._writer is not None and \
+                    (self._writer.spectrum_width != spectrum_x.shape[0] or
+                     (max_file_size and self._writer.get_size() >= max_file_size) or
+                     (max_file_duration and time.time() - self._file_start_time >= max_file_duration)):
+                self._close()
+
+            if self._writer is None:
+                self._writer = self._open_writer(settings, rows[0])
+                self._file_start_time = time.time()
+
+            self._writer.append(_get_columns(rows))
+            self.statistics["n_recorded"] += len(rows)
+
+        return True
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def _open_writer(self, settings, first_row):
+        spectrum_x = numpy.asarray(first_row[2], dtype=numpy.float64)
+        spectrum_dtype = numpy.asarray(first_row[3]).dtype
+
+        file_name = "%s_%s" % (settings["file_prefix"], datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f"))
+
+        if settings["recording_format"] == RECORDING_FORMAT_HDF5:
+            filename = os.path.join(settings["output_directory"], file_name + ".h5")
+            writer = HDF5Writer(filename, spectrum_x, spectrum_dtype, self.batch_size,
+                                "gzip" if settings["compression"] else None)
+        else:
+            filename = os.path.join(settings["output_directory"], file_name + ".npz")
+            writer = NpyWriter(filename, spectrum_x, spectrum_dtype, self.batch_size, settings["compression"])
+
+        self.statistics["files"].append(filename)
+
+        _logger.info("Recording to file %s.", filename)
+
+        return writer
+
+
+def _split_by_width(batch):
+    rows = [batch[0]]
+
+    for row in batch[1:]:
+        if len(row[3]) != len(rows[0][3]):
+            yield rows
+            rows = []
+        rows.append(row)
+
+    yield rows
+
+
+def _get_columns(rows):
+    return {"pulse_id": numpy.array([row[0] for row in rows], dtype=numpy.uint64),
+            "global_timestamp": numpy.array([row[1][0] for row in rows], dtype=numpy.int64),
+            "global_timestamp_offset": numpy.array([row[1][1] for row in rows], dtype=numpy.int64),
+            "spectrum_y": numpy.stack([row[3] for row in rows]),
+            "spectrum_center": numpy.array([row[4] for row in rows], dtype=numpy.float64),
+            "spectrum_fwhm": numpy.array([row[5] for row in rows], dtype=numpy.float64)}
@@ -0,0 +1,117 @@
+import argparse
+import logging
+import time
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from bsread import PUSH
+from bsread.sender import sender
+
+from psss_processing import config
+
+_logger = logging.getLogger(__name__)
+
+
+def read_capture(capture_file):
+    """
+    Read the pulse ids and timestamps of a capture file of StreamCapture. The channels are returned as datasets,
+    the images are read one by one while replaying (a capture does not fit in memory).
+
+    :param capture_file: Open h5py file.
+    :return: Tuple (pulse_ids, global_timestamps, global_timestamp_offsets, channels), channels is a dict with the
+             dataset of each channel.
+    """
+    image_channel = capture_file.attrs["image_channel"]
+    image_group = capture_file["data"][image_channel]
+
+    pulse_ids = image_group["pulse_id"][()]
+    global_timestamps = image_group["global_timestamp"][()]
+    global_timestamp_offsets = image_group["global_timestamp_offset"][()]
+
+    channels = {name: group["data"] for name, group in capture_file["data"].items()}
+
+    return pulse_ids, global_timestamps, global_timestamp_offsets, channels
+
+
+def replay(filename, output_stream_port=config.DEFAULT_REPLAY_OUTPUT_STREAM_PORT, fast=False, n_loops=1):
+    """
+    Send the captured images with the ROI and axis channels as bsread stream, to be processed by psss_processing
+    with this stream as input.
+
+    :param filename: Capture file.
+    :param output_stream_port: Port of the bsread stream (PUSH).
+    :param fast: Send as fast as the processing receives, instead of with the original timing.
+    :param n_loops: Number of times the capture is sent.
+    :return: Rate of the sent images in Hz.
+    """
+    if h5py is None:
+        raise ValueError("Reading capture files requires h5py.")
+
+    with h5py.File(filename, "r") as capture_file:
+        pulse_ids, global_timestamps, global_timestamp_offsets, channels = read_capture(capture_file)
+        pulse_times = global_timestamps + global_timestamp_offsets / 1e9
+        n_images = len(pulse_ids)
+
+        _logger.info("Replaying %d images of %s on port %s %s.", n_images, filename, output_stream_port,
+                     "as fast as possible" if fast else "with the original timing")
+
+        n_sent = 0
+
+        # Blocking, in the fast mode the rate is limited by the processing and no images are lost.
+        with sender(port=output_stream_port, mode=PUSH, queue_size=config.REPLAY_OUTPUT_STREAM_QUEUE_SIZE,
+                    block=True) as output_stream:
+
+            start_time = time.time()
+
+            for _ in range(n_loops):
+                loop_start_time = time.time()
+
+                for index in range(n_images):
+                    # Each image is a chunk of the dataset, only one image is read at a time.
+                    data = {name: dataset[index] for name, dataset in channels.items()}
+
+                    if not fast:
+                        delay = (pulse_times[index] - pulse_times[0]) - (time.time() - loop_start_time)
+                        if delay > 0:
+                            time.sleep(delay)
+
+                    output_stream.send(pulse_id=int(pulse_ids[index]),
+                                       timestamp=(int(global_timestamps[index]),
+                                                  int(global_timestamp_offsets[index])),
+                                       data=data)
+                    n_sent += 1
+
+            duration = time.time() - start_time
+
+    rate = n_sent / duration if duration > 0 else 0
+    _logger.info("Sent %d images in %.3f seconds (%.1f Hz).", n_sent, duration, rate)
+
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a PSSS input stream capture.')
+    parser.add_argument('capture_file', help="Capture file, recorded with the /capture/start endpoint.")
+    parser.add_argument('-o', '--output_stream_port', type=int, default=config.DEFAULT_REPLAY_OUTPUT_STREAM_PORT,
+                        help="Output bsread stream port, the input stream of psss_processing.")
+    parser.add_argument('--fast', action="store_true",
+                        help="Send the images as fast as they are received, instead of with the original timing.")
+    parser.add_argument('-n', '--n_loops', type=int, default=1, help="Number of times the capture is sent.")
+    parser.add_argument("--log_level", default=config.DEFAULT_LOGGING_LEVEL,
+                        choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
+                        help="Log level to use.")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=arguments.log_level)
+
+    replay(filename=arguments.capture_file,
+           output_stream_port=arguments.output_stream_port,
+           fast=arguments.fast,
+           n_loops=arguments.n_loops)
+
+
+if __name__ == "__main__":
+    main()
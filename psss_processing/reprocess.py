@@ -0,0 +1,357 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from psss_processing import config, functions
+from psss_processing.processor import process_image
+from psss_processing.utils import get_calibration_shift
+
+_logger = logging.getLogger(__name__)
+
+# Channels which are the same for all images of a reprocessing.
+CONSTANT_CHANNEL_SUFFIXES = (":SPECTRUM_X", ":processing_parameters")
+
+
+def get_dataset_name(epics_pv_name_prefix, suffix, field="data"):
+    """
+    Dataset name of a channel in the HDF5 file layout of the data buffer: /data/<channel>/<field>
+    """
+    return "data/%s%s/%s" % (epics_pv_name_prefix, suffix, field)
+
+
+def read_images(filename, dataset_name, start=0, stop=None):
+    """
+    Read the images [start, stop) of an image stack. npy files are memory mapped, so only the requested
+    images are read from the disk.
+
+    :param filename: npy file with a (n_images, rows, cols) array, or HDF5 file.
+    :param dataset_name: Dataset with the images in the HDF5 file.
+    """
+    if filename.endswith(".npy"):
+        return numpy.load(filename, mmap_mode="r")[start:stop]
+
+    if h5py is None:
+        raise ValueError("Reading HDF5 files requires h5py.")
+
+    with h5py.File(filename, "r") as input_file:
+        return input_file[dataset_name][start:stop]
+
+
+def get_n_images(filename, dataset_name):
+    if filename.endswith(".npy"):
+        return numpy.load(filename, mmap_mode="r").shape[0]
+
+    if h5py is None:
+        raise ValueError("Reading HDF5 files requires h5py.")
+
+    with h5py.File(filename, "r") as input_file:
+        return input_file[dataset_name].shape[0]
+
+
+def read_array(filename, dataset_name=None):
+    """
+    Read a small array (energy axis, background image, pulse ids) from a npy, text or HDF5 file.
+    """
+    if filename.endswith(".npy"):
+        return numpy.load(filename)
+
+    if filename.endswith(".txt") or filename.endswith(".dat"):
+        return numpy.loadtxt(filename)
+
+    if h5py is None:
+        raise ValueError("Reading HDF5 files requires h5py.")
+
+    with h5py.File(filename, "r") as input_file:
+        return input_file[dataset_name][()]
+
+
+def get_calibration_data(calibration_file=None, polynomial=None, n_rows=None):
+    """
+    Get the curvature calibration, as set with the /calibration endpoint of the live processing.
+
+    :param calibration_file: npy, text or HDF5 (/shift dataset) file with the x shift of each image row.
+    :param polynomial: Polynomial coefficients (highest degree first) of the x shift as a function of the row.
+    :param n_rows: Number of image rows, required with polynomial.
+    :return: Shift table of the calibration_data parameter, or None without calibration.
+    """
+    shift = read_array(calibration_file, "shift").tolist() if calibration_file else None
+
+    shift = get_calibration_shift(shift, polynomial, n_rows)
+    if shift is None:
+        return None
+
+    return functions.get_shift_table(shift)
+
+
+def process_chunk(filename, dataset_name, start, stop, axis, epics_pv_name_prefix, roi, parameters):
+    """
+    Process the images [start, stop) of the file with the same code as the live processing.
+
+    :return: Dictionary with the list of values of each output channel.
+    """
+    images = read_images(filename, dataset_name, start, stop)
+
+    results = {}
+    for image in images:
+        processed_data = process_image(numpy.asarray(image), axis, epics_pv_name_prefix, roi, parameters)
+
+        for name, value in processed_data.items():
+            results.setdefault(name, []).append(value)
+
+    return results
+
+
+def _init_worker(n_threads):
+    # Each process already runs on its own core, the numba kernels should not spawn more threads.
+    import numba
+    numba.set_num_threads(n_threads)
+
+
+def reprocess(input_file, output_file, axis, epics_pv_name_prefix, roi, parameters, dataset_name=None,
+              pulse_ids=None, n_workers=1, chunk_size=config.DEFAULT_REPROCESS_CHUNK_SIZE):
+    """
+    Reprocess a stack of recorded images and write the results in the channel layout of the output stream.
+
+    :param input_file: npy or HDF5 file with the images.
+    :param output_file: HDF5 file (or npz file, if the name ends with .npz) for the results.
+    :param axis: Energy axis.
+    :param epics_pv_name_prefix: Prefix of the channel names.
+    :param roi: [ymin, ymax] of the main ROI.
+    :param parameters: Processing parameters, as for the live processing.
+    :param dataset_name: Dataset with the images in the HDF5 file.
+    :param pulse_ids: Pulse ids of the images, written with each channel.
+    :param n_workers: Number of processes.
+    :param chunk_size: Number of images processed by a worker at once.
+    :return: Number of processed images per second.
+    """
+    if dataset_name is None:
+        dataset_name = get_dataset_name(epics_pv_name_prefix, config.EPICS_PV_SUFFIX_IMAGE)
+
+    n_images = get_n_images(input_file, dataset_name)
+    if pulse_ids is None:
+        pulse_ids = numpy.arange(n_images)
+
+    _logger.info("Reprocessing %d images from %s with %d workers.", n_images, input_file, n_workers)
+
+    start_time = time.time()
+
+    chunks = [(start, min(start + chunk_size, n_images)) for start in range(0, n_images, chunk_size)]
+
+    # With several workers, each process runs the numba kernels on a single thread.
+    if n_workers > 1:
+        pool_arguments = {"initializer": _init_worker, "initargs": (1,)}
+    else:
+        pool_arguments = {}
+
+    writer = ResultWriter(output_file, epics_pv_name_prefix)
+
+    # The numba thread pool does not survive a fork, the workers are started as new processes.
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"),
+                             **pool_arguments) as executor:
+
+        # Only a few chunks are submitted ahead, the results of a chunk are written as soon as it is processed.
+        pending_chunks = deque()
+        next_chunks = iter(chunks)
+
+        def submit_chunk():
+            for start, stop in next_chunks:
+                future = executor.submit(process_chunk, input_file, dataset_name, start, stop, axis,
+                                         epics_pv_name_prefix, roi, parameters)
+                pending_chunks.append((start, stop, future))
+                return
+
+        for _ in range(2 * n_workers):
+            submit_chunk()
+
+        n_processed = 0
+        while pending_chunks:
+            start, stop, future = pending_chunks.popleft()
+
+            writer.append(future.result(), pulse_ids[start:stop])
+            submit_chunk()
+
+            n_processed += stop - start
+            _logger.info("Processed %d/%d images (%.1f fps).", n_processed, n_images,
+                         n_processed / (time.time() - start_time))
+
+    writer.close()
+
+    duration = time.time() - start_time
+    fps = n_images / duration if duration > 0 else 0
+
+    _logger.info("Processed %d images in %.1f s (%.1f fps).", n_images, duration, fps)
+
+    return fps
+
+
+class ResultWriter(object):
+
+    def __init__(self, output_file, epics_pv_name_prefix):
+        """
+        Write the processed channels as /data/<channel>/data and /data/<channel>/pulse_id. The results are appended
+        chunk by chunk, so the results of long recordings do not have to fit in memory. The channels which are
+        the same for all images (energy axis, processing parameters) are written only once, without pulse ids.
+
+        :param output_file: HDF5 file, or npz file if the name ends with .npz (kept in memory until closed).
+        """
+        self.output_file = output_file
+        self.constant_channels = {epics_pv_name_prefix + suffix for suffix in CONSTANT_CHANNEL_SUFFIXES}
+
+        self.n_images = 0
+
+        if output_file.endswith(".npz"):
+            self.file = None
+            self.arrays = {}
+            return
+
+        if h5py is None:
+            raise ValueError("Writing HDF5 files requires h5py, use a .npz output file.")
+
+        self.file = h5py.File(output_file, "w")
+
+    def append(self, results, pulse_ids):
+        for name, values in results.items():
+            if name in self.constant_channels:
+                if self.n_images == 0:
+                    self._write_constant(name, values[0])
+                continue
+
+            if isinstance(values[0], str):
+                values = numpy.array(values, dtype=h5py.string_dtype() if self.file is not None else None)
+            else:
+                values = numpy.array(values)
+
+            self._append(name, values, pulse_ids)
+
+        if self.file is None:
+            self.arrays.setdefault("pulse_id", []).append(numpy.asarray(pulse_ids))
+
+        self.n_images += len(pulse_ids)
+
+    def _write_constant(self, name, value):
+        if self.file is None:
+            self.arrays[name] = [numpy.asarray(value)]
+        else:
+            self.file.create_dataset("data/%s/data" % name, data=value)
+
+    def _append(self, name, values, pulse_ids):
+        if self.file is None:
+            self.arrays.setdefault(name, []).append(values)
+            return
+
+        data_name = "data/%s/data" % name
+        pulse_id_name = "data/%s/pulse_id" % name
+
+        if data_name not in self.file:
+            self.file.create_dataset(data_name, shape=(0,) + values.shape[1:], maxshape=(None,) + values.shape[1:],
+                                     dtype=values.dtype, chunks=(len(values),) + values.shape[1:])
+            self.file.create_dataset(pulse_id_name, shape=(0,), maxshape=(None,), dtype=numpy.asarray(pulse_ids).dtype,
+                                     chunks=(len(values),))
+
+        for dataset, data in ((self.file[data_name], values), (self.file[pulse_id_name], pulse_ids)):
+            dataset.resize(self.n_images + len(data), axis=0)
+            dataset[self.n_images:] = data
+
+    def close(self):
+        if self.file is None:
+            arrays = {name: values[0] if name in self.constant_channels else numpy.concatenate(values)
+                      for name, values in self.arrays.items()}
+            numpy.savez(self.output_file, **arrays)
+        else:
+            self.file.close()
+
+        _logger.info("Results written to %s.", self.output_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reprocess recorded PSSS images offline.')
+    parser.add_argument('input_file', help="npy or HDF5 file with the image stack.")
+    parser.add_argument('output_file', help="HDF5 (or npz) file for the results.")
+    parser.add_argument('-a', '--axis', required=True, help="npy, text or HDF5 file with the energy axis.")
+    parser.add_argument("-i", '--prefix', default=config.DEFAULT_INPUT_PV, help="Epics PV prefix of the image.")
+    parser.add_argument('--dataset', default=None,
+                        help="Dataset of the images in the HDF5 input file (default data/<prefix>:FPICTURE/data).")
+    parser.add_argument('--roi', type=int, nargs=2, default=[0, 0], metavar=("YMIN", "YMAX"),
+                        help="Vertical ROI, by default the full image.")
+    parser.add_argument('--background', default="", help="npy or HDF5 (/image dataset) file with the background.")
+    parser.add_argument('--gain', default="", help="npy or HDF5 (/image dataset) file with the per pixel gain.")
+    parser.add_argument('--calibration', default="",
+                        help="npy, text or HDF5 (/shift dataset) file with the x shift of each image row.")
+    parser.add_argument('--calibration_polynomial', type=float, nargs="+", default=None,
+                        help="Polynomial coefficients (highest degree first) of the x shift of each image row, "
+                             "instead of a calibration file.")
+    parser.add_argument('--n_rows', type=int, default=None,
+                        help="Number of image rows of the calibration polynomial.")
+    parser.add_argument('--parameters', default="{}", help="Processing parameters as JSON string or JSON file.")
+    parser.add_argument('-n', '--n_workers', type=int, default=1, help="Number of worker processes.")
+    parser.add_argument('--chunk_size', type=int, default=config.DEFAULT_REPROCESS_CHUNK_SIZE,
+                        help="Number of images processed by a worker at once.")
+    parser.add_argument("--log_level", default=config.DEFAULT_LOGGING_LEVEL,
+                        choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
+                        help="Log level to use.")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=arguments.log_level)
+
+    if h5py is None and not (arguments.input_file.endswith(".npy") and arguments.output_file.endswith(".npz")):
+        parser.error("Reading or writing HDF5 files requires h5py, use npy input and npz output files.")
+
+    if arguments.parameters.endswith(".json"):
+        with open(arguments.parameters) as parameters_file:
+            parameters = json.load(parameters_file)
+    else:
+        parameters = json.loads(arguments.parameters)
+
+    parameters.setdefault("background", arguments.background)
+    if arguments.background:
+        parameters["background_data"] = read_array(arguments.background, "image")
+
+    parameters.setdefault("gain", arguments.gain)
+    if arguments.gain:
+        parameters["gain_data"] = functions.get_gain_table(read_array(arguments.gain, "image"))
+
+    parameters.setdefault("calibration", arguments.calibration)
+    try:
+        parameters["calibration_data"] = get_calibration_data(arguments.calibration,
+                                                              arguments.calibration_polynomial, arguments.n_rows)
+    except ValueError as e:
+        parser.error(str(e))
+
+    axis = read_array(arguments.axis, get_dataset_name(arguments.prefix, ":SPECTRUM_X"))
+    if axis.ndim > 1:
+        axis = axis[0]
+
+    pulse_ids = None
+    if not arguments.input_file.endswith(".npy"):
+        dataset_name = arguments.dataset or get_dataset_name(arguments.prefix, config.EPICS_PV_SUFFIX_IMAGE)
+        pulse_id_dataset = dataset_name.rsplit("/", 1)[0] + "/pulse_id"
+
+        with h5py.File(arguments.input_file, "r") as input_file:
+            if pulse_id_dataset in input_file:
+                pulse_ids = input_file[pulse_id_dataset][()]
+
+    reprocess(input_file=arguments.input_file,
+              output_file=arguments.output_file,
+              axis=axis,
+              epics_pv_name_prefix=arguments.prefix,
+              roi=arguments.roi,
+              parameters=parameters,
+              dataset_name=arguments.dataset,
+              pulse_ids=pulse_ids,
+              n_workers=arguments.n_workers,
+              chunk_size=arguments.chunk_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,10 @@
+import asyncio
+import functools
+import io
+from concurrent.futures import ThreadPoolExecutor
+from threading import local, Lock
+
+import numpy
 import requests
 
 from psss_processing import config
@@ -11,13 +18,44 @@ def validate_response(server_response):
 
 
 class PsssProcessingClient(object):
-    def __init__(self, address="http://sf-daqsync-02:12000/"):
+    def __init__(self, address="http://sf-daqsync-02:12000/", timeout=config.DEFAULT_CLIENT_TIMEOUT):
         """
         :param address: Address of the PSSS Processing service, e.g. http://localhost:12000
+        :param timeout: Timeout in seconds of each request.
         """
 
         self.api_address_format = address.rstrip("/") + config.API_PREFIX + "%s"
         self.address = address
+        self.timeout = timeout
+
+        self._local = local()
+        self._sessions = []
+        self._sessions_lock = Lock()
+
+    @property
+    def session(self):
+        """
+        Session of the calling thread, a requests.Session is not thread safe. The session keeps the connection open
+        between the requests.
+        """
+        session = getattr(self._local, "session", None)
+
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+
+            with self._sessions_lock:
+                self._sessions.append(session)
+
+        return session
+
+    def close(self):
+        """
+        Close the connections of the client, in all threads.
+        """
+        with self._sessions_lock:
+            for session in self._sessions:
+                session.close()
 
     def get_address(self):
         """
@@ -33,7 +71,7 @@ class PsssProcessingClient(object):
         """
         rest_endpoint = "/start"
 
-        server_response = requests.post(self.api_address_format % rest_endpoint).json()
+        server_response = self.session.post(self.api_address_format % rest_endpoint, timeout=self.timeout).json()
         return validate_response(server_response)["status"]
 
     def stop(self):
@@ -44,7 +82,7 @@ class PsssProcessingClient(object):
         """
         rest_endpoint = "/stop"
 
-        server_response = requests.post(self.api_address_format % rest_endpoint).json()
+        server_response = self.session.post(self.api_address_format % rest_endpoint, timeout=self.timeout).json()
         return validate_response(server_response)["status"]
 
     def get_status(self):
@@ -55,9 +93,32 @@ class PsssProcessingClient(object):
         """
         rest_endpoint = "/status"
 
-        server_response = requests.get(self.api_address_format % rest_endpoint).json()
+        server_response = self.session.get(self.api_address_format % rest_endpoint, timeout=self.timeout).json()
         return validate_response(server_response)["status"]
 
+    def get_pv_connections(self):
+        """
+        Get the connection state of the EPICS PVs used by the processing.
+
+        :return: Dictionary with the PV names and True if connected.
+        """
+        rest_endpoint = "/status"
+
+        server_response = self.session.get(self.api_address_format % rest_endpoint, timeout=self.timeout).json()
+        return validate_response(server_response)["pv_connections"]
+
+    def get_job(self, job_id):
+        """
+        Get the state of a background job, started with async requests.
+
+        :param job_id: Job id returned by the async request.
+        :return: Job state.
+        """
+        rest_endpoint = "/jobs/%s" % job_id
+
+        server_response = self.session.get(self.api_address_format % rest_endpoint, timeout=self.timeout).json()
+        return validate_response(server_response)["job"]
+
     def get_statistics(self):
         """
         Get the statistics of the processing.
@@ -66,7 +127,7 @@ class PsssProcessingClient(object):
         """
         rest_endpoint = "/statistics"
 
-        server_response = requests.get(self.api_address_format % rest_endpoint).json()
+        server_response = self.session.get(self.api_address_format % rest_endpoint, timeout=self.timeout).json()
         return validate_response(server_response)["statistics"]
 
     def get_parameters(self):
@@ -77,7 +138,7 @@ class PsssProcessingClient(object):
         """
         rest_endpoint = "/parameters"
 
-        server_response = requests.get(self.api_address_format % rest_endpoint).json()
+        server_response = self.session.get(self.api_address_format % rest_endpoint, timeout=self.timeout).json()
         return validate_response(server_response)["parameters"]
 
     def set_parameters(self, parameters):
@@ -89,7 +150,8 @@ class PsssProcessingClient(object):
         """
         rest_endpoint = "/parameters"
 
-        server_response = requests.post(self.api_address_format % rest_endpoint, json=parameters).json()
+        server_response = self.session.post(self.api_address_format % rest_endpoint, json=parameters,
+                                            timeout=self.timeout).json()
         return validate_response(server_response)["parameters"]
 
     def set_background(self, filename='', data=None):
@@ -109,5 +171,215 @@ class PsssProcessingClient(object):
             "filename": filename,
             "data": data
         }
-        server_response = requests.post(self.api_address_format % rest_endpoint, json=parameters).json()
+        server_response = self.session.post(self.api_address_format % rest_endpoint, json=parameters,
+                                            timeout=self.timeout).json()
         return validate_response(server_response)["state"]
+
+    def set_gain(self, filename='', data=None):
+        """
+        Set the per pixel gain (flat field). The background subtracted pixels are multiplied with the gain.
+        If no arguments are provided, the gain is cleared.
+
+        :param str filename: gain map filename. It is used merely to track where the gain map is loaded.
+        :param ndarray data: gain of each pixel (between 0 and 4), same shape as the image.
+        """
+        rest_endpoint = "/gain"
+
+        # The gain map is sent in binary, as npy file.
+        body = b""
+        if data is not None:
+            buffer = io.BytesIO()
+            numpy.save(buffer, numpy.asarray(data, dtype=numpy.float32))
+            body = buffer.getvalue()
+
+        server_response = self.session.post(self.api_address_format % rest_endpoint, params={"filename": filename},
+                                            data=body, headers={"Content-Type": "application/octet-stream"},
+                                            timeout=self.timeout).json()
+        return validate_response(server_response)["state"]
+
+    def set_calibration(self, filename='', shift=None, polynomial=None, n_rows=None):
+        """
+        Set the curvature and tilt calibration. The x position of the pixels in each image row is shifted by the
+        given number of pixels before collapsing the image. If no arguments are provided, the calibration is cleared.
+
+        :param str filename: calibration filename. It is used merely to track where the calibration is loaded.
+        :param shift: x shift in pixels for each image row.
+        :param polynomial: polynomial coefficients (highest degree first) of the x shift as a function of the row.
+        :param int n_rows: number of image rows, required with polynomial.
+        """
+        rest_endpoint = "/calibration"
+
+        if shift is not None:
+            shift = numpy.asarray(shift, dtype="float64").tolist()
+
+        if polynomial is not None:
+            polynomial = numpy.asarray(polynomial, dtype="float64").tolist()
+
+            if n_rows is None:
+                raise ValueError("n_rows is required to calculate the shift from the polynomial.")
+
+        parameters = {
+            "filename": filename,
+            "shift": shift,
+            "polynomial": polynomial,
+            "n_rows": n_rows
+        }
+        server_response = self.session.post(self.api_address_format % rest_endpoint, json=parameters,
+                                            timeout=self.timeout).json()
+        return validate_response(server_response)["state"]
+
+    def start_recording(self, **settings):
+        """
+        Start recording the processed spectra to disk.
+
+        :param settings: Optional recording settings: output_directory, file_prefix, recording_format ("h5" or "npy"),
+                         max_file_size_mb, max_file_duration_s, compression.
+        :return: Recording statistics.
+        """
+        rest_endpoint = "/recording/start"
+
+        server_response = self.session.post(self.api_address_format % rest_endpoint, json=settings,
+                                            timeout=self.timeout).json()
+        return validate_response(server_response)["recording"]
+
+    def stop_recording(self):
+        """
+        Stop the recording.
+
+        :return: Recording statistics.
+        """
+        rest_endpoint = "/recording/stop"
+
+        server_response = self.session.post(self.api_address_format % rest_endpoint, timeout=self.timeout).json()
+        return validate_response(server_response)["recording"]
+
+    def get_recording(self):
+        """
+        Get the status and statistics of the recording.
+
+        :return: Recording status and statistics.
+        """
+        rest_endpoint = "/recording"
+
+        server_response = self.session.get(self.api_address_format % rest_endpoint, timeout=self.timeout).json()
+        server_response = validate_response(server_response)
+        return server_response["status"], server_response["recording"]
+
+    def start_capture(self, **settings):
+        """
+        Start capturing the raw input images, with the ROI and energy axis, for a later replay.
+
+        :param settings: Optional capture settings: output_directory, file_prefix, max_images, compression.
+        :return: Capture statistics.
+        """
+        rest_endpoint = "/capture/start"
+
+        server_response = self.session.post(self.api_address_format % rest_endpoint, json=settings,
+                                            timeout=self.timeout).json()
+        return validate_response(server_response)["capture"]
+
+    def stop_capture(self):
+        """
+        Stop the capture.
+
+        :return: Capture statistics.
+        """
+        rest_endpoint = "/capture/stop"
+
+        server_response = self.session.post(self.api_address_format % rest_endpoint, timeout=self.timeout).json()
+        return validate_response(server_response)["capture"]
+
+    def get_capture(self):
+        """
+        Get the status and statistics of the capture.
+
+        :return: Capture status and statistics.
+        """
+        rest_endpoint = "/capture"
+
+        server_response = self.session.get(self.api_address_format % rest_endpoint, timeout=self.timeout).json()
+        server_response = validate_response(server_response)
+        return server_response["status"], server_response["capture"]
+
+    def profile(self, frames=config.DEFAULT_PROFILE_FRAMES, collapsed_stacks=False, timeout=config.PROFILE_TIMEOUT):
+        """
+        Profile the processing of the next frames. Blocks until the frames are processed.
+
+        :param frames: Number of frames to profile.
+        :param collapsed_stacks: Include the sampled stacks of the processing in the collapsed (flamegraph) format.
+        :param timeout: Maximum time in seconds to wait for the frames.
+        :return: Profiling report.
+        """
+        rest_endpoint = "/profile"
+
+        params = {"frames": frames,
+                  "collapsed": "true" if collapsed_stacks else "false",
+                  "timeout": timeout}
+
+        server_response = self.session.post(self.api_address_format % rest_endpoint, params=params,
+                                            timeout=self.timeout + timeout).json()
+        return validate_response(server_response)["profile"]
+
+
+class AsyncPsssProcessingClient(object):
+    def __init__(self, address="http://sf-daqsync-02:12000/", timeout=config.DEFAULT_CLIENT_TIMEOUT, executor=None):
+        """
+        Asyncio variant of the PsssProcessingClient: all the methods are coroutines, running the requests
+        in a thread pool. Each thread of the pool uses its own connection.
+
+        :param address: Address of the PSSS Processing service, e.g. http://localhost:12000
+        :param timeout: Timeout in seconds of each request.
+        :param executor: Executor running the requests, by default the executor of the event loop.
+        """
+        self.client = PsssProcessingClient(address, timeout)
+        self.executor = executor
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        if not callable(method):
+            return method
+
+        @functools.wraps(method)
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+
+        return call
+
+
+_clients = {}
+_executor = ThreadPoolExecutor(max_workers=config.QUERY_PROCESSORS_MAX_WORKERS)
+
+
+def query_processors(addresses, timeout=config.DEFAULT_CLIENT_TIMEOUT, statistics=True):
+    """
+    Query the status and statistics of many processing services in parallel. The clients are kept between the
+    calls, so the connections are reused when polling.
+
+    :param addresses: Addresses of the PSSS Processing services.
+    :param timeout: Timeout in seconds of each request.
+    :param statistics: Query the statistics as well as the status.
+    :return: Dictionary address -> {"status": ..., "statistics": ...}, or {"error": message} if the query failed.
+    """
+    # The statistics response contains the status as well, a single request per service.
+    rest_endpoint = "/statistics" if statistics else "/status"
+
+    def query(address):
+        client = _clients.get(address)
+        if client is None:
+            client = _clients.setdefault(address, PsssProcessingClient(address))
+
+        try:
+            server_response = client.session.get(client.api_address_format % rest_endpoint, timeout=timeout).json()
+            server_response = validate_response(server_response)
+
+            result = {"status": server_response["status"]}
+            if statistics:
+                result["statistics"] = server_response["statistics"]
+        except Exception as e:
+            result = {"error": str(e)}
+
+        return result
+
+    return dict(zip(addresses, _executor.map(query, addresses)))
@@ -1,78 +1,358 @@
+import io
 import json
 import logging
+import socket
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import ThreadingMixIn
+from threading import Lock
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler, make_server
 
 import bottle
 bottle.BaseRequest.MEMFILE_MAX = 30000000
 from bottle import request, response
 import numpy
 
-from psss_processing import config
+from psss_processing import config, functions
+from psss_processing.utils import validate_rois, validate_binning, validate_background_tracking, \
+    get_calibration_shift
 
 _logger = logging.getLogger(__name__)
 
 
-def register_rest_interface(app, instance_manager):
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class KeepAliveServerHandler(ServerHandler):
+    http_version = "1.1"
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+
+        # Without the content length, the client can only detect the end of the response by the closed connection.
+        if 'Content-Length' not in self.headers or self.request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+            self.request_handler.close_connection = True
+
+
+class RequestBody(object):
+
+    def __init__(self, rfile, length):
+        """
+        Body of a request on a keep-alive connection, limited to its content length. The part of the body that the
+        route did not read is discarded after the request, so the next request is read from its request line.
+        """
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.rfile.read(size) if size else b""
+        self.remaining -= len(data)
+
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.rfile.readline(size) if size else b""
+        self.remaining -= len(data)
+
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b""))
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def discard(self):
+        """
+        Read the rest of the body.
+
+        :return: False if the body could not be read completely.
+        """
+        while self.remaining > 0:
+            if not self.read(min(self.remaining, 65536)):
+                return False
+
+        return True
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """
+    The wsgiref request handler answers a single request per connection. This handler keeps the connection
+    open for the next requests of the client (HTTP/1.1 keep-alive), which saves the connection setup when polling.
+    """
+    protocol_version = "HTTP/1.1"
+    timeout = config.REST_API_KEEP_ALIVE_TIMEOUT
+    # The headers and the body are written separately, Nagle would delay the body until the headers are acked.
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        self.close_connection = True
+
+        try:
+            self.handle_one_request()
+            while not self.close_connection:
+                self.handle_one_request()
+        except (socket.timeout, ConnectionError):
+            pass
+
+    def handle_one_request(self):
+        self.raw_requestline = self.rfile.readline(65537)
+
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = True
+            return
+
+        if not self.parse_request():
+            return
+
+        # A chunked body, or a body too large to be discarded, ends the connection after the response.
+        try:
+            content_length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            content_length = -1
+
+        if content_length < 0 or content_length > bottle.BaseRequest.MEMFILE_MAX or \
+                "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            self.close_connection = True
+            body = self.rfile
+        else:
+            body = RequestBody(self.rfile, content_length)
+
+        handler = KeepAliveServerHandler(body, self.wfile, self.get_stderr(), self.get_environ(),
+                                         multithread=True)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+        # Not all the routes read the body (i.e. /stop, or the errors).
+        if not self.close_connection and not body.discard():
+            self.close_connection = True
+
+
+class ThreadingWSGIRefServer(bottle.ServerAdapter):
+    """
+    The bottle wsgiref server, handling each connection in its own thread: a slow request (i.e. stop waiting
+    for the processing thread) does not delay the other requests.
+    """
+
+    def run(self, app):
+        handler_class = KeepAliveRequestHandler
+
+        if self.quiet:
+            class QuietHandler(KeepAliveRequestHandler):
+                def log_request(*args, **kwargs):
+                    pass
+
+                def log_message(*args, **kwargs):
+                    pass
+
+            handler_class = QuietHandler
+
+        self.server = make_server(self.host, self.port, app, ThreadingWSGIServer, handler_class)
+        self.server.serve_forever()
+
+
+class AsyncJobs(object):
+
+    def __init__(self, max_jobs=config.REST_API_MAX_JOBS):
+        """
+        Run the long control operations in the background. The jobs are run one after the other, in the order
+        they were submitted.
+
+        :param max_jobs: Number of jobs to keep the status of.
+        """
+        self.max_jobs = max_jobs
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._jobs = OrderedDict()
+        self._lock = Lock()
+
+    def submit(self, name, function):
+        job = {"job_id": uuid.uuid4().hex,
+               "name": name,
+               "state": "pending",
+               "result": None}
+
+        with self._lock:
+            self._jobs[job["job_id"]] = job
+
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+
+        def run_job():
+            job["state"] = "running"
+
+            try:
+                job["result"] = function()
+                job["state"] = "done"
+            except Exception as e:
+                _logger.exception("Job %s failed.", name)
+                job["result"] = str(e)
+                job["state"] = "error"
+
+        self._executor.submit(run_job)
+
+        return dict(job)
+
+    def get_job(self, job_id):
+        with self._lock:
+            if job_id not in self._jobs:
+                raise ValueError("Job '%s' does not exist." % job_id)
+
+            return dict(self._jobs[job_id])
+
+
+def register_rest_interface(app, instance_manager, recorder=None, profiler=None, capture=None):
 
     api_root_address = config.API_PREFIX
 
-    @app.post(api_root_address + "/start")
-    def start():
+    async_jobs = AsyncJobs()
 
-        instance_manager.start()
+    def run(name, function):
+        """
+        Run the function in the request, or as a background job if the request has the async query parameter.
+        """
+        if request.query.get("async", "false").lower() in ("1", "true"):
+            return {"state": "ok",
+                    "status": instance_manager.get_status(),
+                    "job": async_jobs.submit(name, function)}
+
+        function()
 
         return {"state": "ok",
                 "status": instance_manager.get_status()}
 
+    @app.post(api_root_address + "/start")
+    def start():
+        return run("start", instance_manager.start)
+
     @app.post(api_root_address + "/stop")
     def stop():
+        return run("stop", instance_manager.stop)
 
-        instance_manager.stop()
-
+    @app.get(api_root_address + "/jobs/<job_id>")
+    def get_job(job_id):
         return {"state": "ok",
-                "status": instance_manager.get_status()}
+                "status": instance_manager.get_status(),
+                "job": async_jobs.get_job(job_id)}
 
     @app.get(api_root_address + "/status")
     def get_status():
         return {"state": "ok",
-                "status": instance_manager.get_status()}
+                "status": instance_manager.get_status(),
+                "pv_connections": dict(instance_manager.get_statistics().get("pv_connections", {}))}
 
     @app.post(api_root_address + "/background")
     def set_background():
         req = request.json
 
+        def set_background_data():
+            parameters = {
+                "background": req["filename"],
+                "background_data": None
+            }
+
+            if req['data'] is not None:
+                data = numpy.array(req['data'], dtype='uint16')
+                parameters["background_data"] = data
+
+            instance_manager.set_parameters(parameters)
+
+        return run("background", set_background_data)
+
+    @app.post(api_root_address + "/gain")
+    def set_gain():
+        # The gain map is uploaded in binary, as the content of a npy file. An empty body clears the gain.
+        filename = request.query.get("filename", "")
+        body = request.body.read()
+
+        def set_gain_data():
+            parameters = {
+                "gain": filename,
+                "gain_data": None
+            }
+
+            if body:
+                gain = numpy.load(io.BytesIO(body), allow_pickle=False)
+                parameters["gain_data"] = functions.get_gain_table(gain)
+
+            instance_manager.set_parameters(parameters)
+
+        return run("gain", set_gain_data)
+
+    @app.post(api_root_address + "/calibration")
+    def set_calibration():
+        req = request.json or {}
+
         parameters = {
-            "background": req["filename"],
-            "background_data": None
+            "calibration": req.get("filename", ""),
+            "calibration_data": None
         }
 
-        if req['data'] is not None:
-            data = numpy.array(req['data'], dtype='uint16')
-            parameters["background_data"] = data
+        shift = get_calibration_shift(req.get("shift"), req.get("polynomial"), req.get("n_rows"))
+
+        if shift is not None:
+            parameters["calibration_data"] = functions.get_shift_table(shift)
 
         instance_manager.set_parameters(parameters)
 
         return {"state": "ok",
                 "status": instance_manager.get_status()}
 
-    @app.get(api_root_address + "/parameters")
-    def get_parameters():
+    def get_serializable_parameters():
         parameters = {}
         for k,v in instance_manager.get_parameters().items():
-            if k not in ['background_data']:
+            if k not in ['background_data', 'calibration_data', 'gain_data']:
                 parameters[k] = v
 
+        return parameters
+
+    @app.get(api_root_address + "/parameters")
+    def get_parameters():
         return {"state": "ok",
                 "status": instance_manager.get_status(),
-                "parameters": parameters}
+                "parameters": get_serializable_parameters()}
 
     @app.post(api_root_address + "/parameters")
     def set_parameters():
         parameters = request.json
+
+        if "rois" in parameters:
+            validate_rois(parameters["rois"])
+
+        if "binning" in parameters or "binning_mode" in parameters:
+            validate_binning(parameters.get("binning", config.DEFAULT_BINNING),
+                             parameters.get("binning_mode", config.DEFAULT_BINNING_MODE))
+
+        if any(name in parameters for name in ("background_tracking", "background_tracking_alpha",
+                                               "background_tracking_step", "background_update_interval")):
+            validate_background_tracking(
+                parameters.get("background_tracking", config.DEFAULT_BACKGROUND_TRACKING),
+                parameters.get("background_tracking_alpha", config.DEFAULT_BACKGROUND_TRACKING_ALPHA),
+                parameters.get("background_tracking_step", config.DEFAULT_BACKGROUND_TRACKING_STEP),
+                parameters.get("background_update_interval", config.DEFAULT_BACKGROUND_UPDATE_INTERVAL))
+
         instance_manager.set_parameters(parameters)
 
         return {"state": "ok",
                 "status": instance_manager.get_status(),
-                "parameters": instance_manager.get_parameters()}
+                "parameters": get_serializable_parameters()}
 
     @app.get(api_root_address + "/statistics")
     def get_statistics():
@@ -81,6 +361,61 @@ def register_rest_interface(app, instance_manager):
                 "status": instance_manager.get_status(),
                 "statistics": instance_manager.get_statistics()}
 
+    def register_writer_interface(path, writer, name):
+        """
+        Start, stop and status endpoints of a background writer (recording or capture).
+        """
+
+        def get_writer():
+            if writer is None:
+                raise ValueError("%s is not available on this instance." % name)
+
+            return writer
+
+        def get_writer_status():
+            return {"state": "ok",
+                    "status": writer.get_status(),
+                    path: writer.get_statistics()}
+
+        @app.post(api_root_address + "/%s/start" % path)
+        def start_writer():
+            settings = request.json or {}
+
+            get_writer().start(**settings)
+
+            return get_writer_status()
+
+        @app.post(api_root_address + "/%s/stop" % path)
+        def stop_writer():
+            get_writer().stop()
+
+            return get_writer_status()
+
+        @app.get(api_root_address + "/%s" % path)
+        def get_writer_statistics():
+            get_writer()
+
+            return get_writer_status()
+
+    register_writer_interface("recording", recorder, "Recording")
+    register_writer_interface("capture", capture, "Capture")
+
+    @app.post(api_root_address + "/profile")
+    def profile():
+        if profiler is None:
+            raise ValueError("Profiling is not available on this instance.")
+
+        if instance_manager.get_status() != "processing":
+            raise ValueError("Processing is not running, nothing to profile.")
+
+        report = profiler.profile(n_frames=int(request.query.get("frames", config.DEFAULT_PROFILE_FRAMES)),
+                                  collapsed_stacks=request.query.get("collapsed", "false").lower() in ("1", "true"),
+                                  timeout=float(request.query.get("timeout", config.PROFILE_TIMEOUT)))
+
+        return {"state": "ok",
+                "status": instance_manager.get_status(),
+                "profile": report}
+
     @app.error(405)
     def method_not_allowed(res):
 
@@ -0,0 +1,231 @@
+import time
+from logging import getLogger
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy
+
+from psss_processing import config
+
+_logger = getLogger(__name__)
+
+SHM_RING_MAGIC = 0x50535353
+SHM_RING_VERSION = 2
+SHM_RING_HEADER_SIZE = 64
+
+_header_dtype = numpy.dtype([("magic", numpy.uint32),
+                             ("version", numpy.uint32),
+                             ("n_slots", numpy.uint32),
+                             ("max_width", numpy.uint32),
+                             ("last_sequence", numpy.uint64)])
+
+
+def _get_slot_dtype(max_width):
+    return numpy.dtype([("version", numpy.uint64),
+                        ("pulse_id", numpy.uint64),
+                        ("global_timestamp", numpy.int64),
+                        ("global_timestamp_offset", numpy.int64),
+                        ("width", numpy.uint32),
+                        ("noise_only", numpy.uint32),
+                        # Width of the spectrum before it was truncated to the slot size.
+                        ("spectrum_width", numpy.uint32),
+                        ("reserved", numpy.uint32),
+                        ("center", numpy.float64),
+                        ("fwhm", numpy.float64),
+                        ("spectrum", numpy.float64, (max_width,))])
+
+
+class _ShmRing(object):
+
+    def _map(self, n_slots, max_width):
+        buffer = self._shm.buf
+
+        self._header = numpy.ndarray((), dtype=_header_dtype, buffer=buffer)
+        slots = numpy.ndarray((n_slots,), dtype=_get_slot_dtype(max_width), buffer=buffer,
+                              offset=SHM_RING_HEADER_SIZE)
+
+        # Views on the single fields, every access is a plain aligned load or store.
+        self._version = slots["version"]
+        self._pulse_id = slots["pulse_id"]
+        self._global_timestamp = slots["global_timestamp"]
+        self._global_timestamp_offset = slots["global_timestamp_offset"]
+        self._width = slots["width"]
+        self._noise_only = slots["noise_only"]
+        self._spectrum_width = slots["spectrum_width"]
+        self._center = slots["center"]
+        self._fwhm = slots["fwhm"]
+        self._spectrum = slots["spectrum"]
+
+        self.n_slots = n_slots
+        self.max_width = max_width
+
+    def _unmap(self):
+        # The numpy views have to be released before the shared memory can be closed.
+        self._header = self._version = self._pulse_id = self._global_timestamp = None
+        self._global_timestamp_offset = self._width = self._noise_only = self._spectrum_width = self._center = None
+        self._fwhm = self._spectrum = None
+
+
+class ShmRingWriter(_ShmRing):
+
+    def __init__(self, name, n_slots=config.DEFAULT_SHM_N_SLOTS, max_width=config.DEFAULT_SHM_MAX_SPECTRUM_WIDTH):
+        """
+        Publish the processing results into a POSIX shared memory ring, for readers on the same node.
+
+        :param name: Name of the shared memory segment (/dev/shm/<name>).
+        :param n_slots: Number of results kept in the ring.
+        :param max_width: Maximum spectrum width. Longer spectra are truncated, with a warning, and the full
+                          width is written into the slot.
+        """
+        size = SHM_RING_HEADER_SIZE + n_slots * _get_slot_dtype(max_width).itemsize
+
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left over from a processing that was not shut down properly.
+            _logger.warning("Shared memory '%s' already exists, replacing it.", name)
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        self._map(n_slots, max_width)
+
+        self._version[:] = 0
+        self._header["last_sequence"] = 0
+        self._header["n_slots"] = n_slots
+        self._header["max_width"] = max_width
+        self._header["version"] = SHM_RING_VERSION
+        self._header["magic"] = SHM_RING_MAGIC
+
+        self.sequence = 0
+        self.n_truncated = 0
+
+        _logger.info("Publishing results to shared memory '%s' (%d slots).", name, n_slots)
+
+    def write(self, pulse_id, timestamp, spectrum, center, fwhm, noise_only=False):
+        """
+        Write a result into the next slot. The slot version is odd while the slot is written.
+        """
+        sequence = self.sequence + 1
+        index = sequence % self.n_slots
+        width = min(len(spectrum), self.max_width)
+
+        if width < len(spectrum):
+            if self.n_truncated == 0:
+                _logger.warning("Spectrum width %d is larger than the shared memory slots (%d), the spectra are "
+                                "truncated. Increase --shm_max_spectrum_width.", len(spectrum), self.max_width)
+            self.n_truncated += 1
+
+        self._version[index] = 2 * sequence - 1
+
+        self._pulse_id[index] = pulse_id
+        self._global_timestamp[index] = timestamp[0]
+        self._global_timestamp_offset[index] = timestamp[1]
+        self._width[index] = width
+        self._noise_only[index] = noise_only
+        self._spectrum_width[index] = len(spectrum)
+        self._center[index] = center
+        self._fwhm[index] = fwhm
+        self._spectrum[index, :width] = spectrum[:width]
+
+        self._version[index] = 2 * sequence
+        self._header["last_sequence"] = sequence
+
+        self.sequence = sequence
+
+    def publish(self, pulse_id, timestamp, processed_data, epics_pv_name_prefix):
+        self.write(pulse_id, timestamp,
+                   processed_data[epics_pv_name_prefix + ":SPECTRUM_Y"],
+                   processed_data[epics_pv_name_prefix + ":SPECTRUM_CENTER"],
+                   processed_data[epics_pv_name_prefix + ":SPECTRUM_FWHM"],
+                   processed_data.get(epics_pv_name_prefix + ":SPECTRUM_NOISE_ONLY", False))
+
+    def close(self):
+        self._unmap()
+        self._shm.close()
+        self._shm.unlink()
+
+
+class ShmRingReader(_ShmRing):
+
+    def __init__(self, name):
+        """
+        Read the results published by ShmRingWriter, without locks: a result is valid if the slot version
+        did not change while it was copied.
+
+        :param name: Name of the shared memory segment, as given to the processing with --shm_name.
+        """
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before python 3.13 the resource tracker would remove the segment when the reader exits.
+            self._shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+
+        header = numpy.ndarray((), dtype=_header_dtype, buffer=self._shm.buf)
+        if header["magic"] != SHM_RING_MAGIC or header["version"] != SHM_RING_VERSION:
+            del header
+            self._shm.close()
+            raise ValueError("Shared memory '%s' is not a PSSS result ring." % name)
+
+        n_slots, max_width = int(header["n_slots"]), int(header["max_width"])
+        del header
+
+        self._map(n_slots, max_width)
+
+    def get_last_sequence(self):
+        """
+        Sequence number of the last published result, 0 if nothing was published yet.
+        """
+        return int(self._header["last_sequence"])
+
+    def read(self, sequence):
+        """
+        Read the result with the given sequence number.
+
+        :return: Dictionary with the result, or None if the result was already overwritten, is not yet
+                 written, or was modified while reading.
+        """
+        index = sequence % self.n_slots
+        version = self._version[index]
+
+        if version != 2 * sequence:
+            return None
+
+        width = self._width[index]
+        result = {"sequence": sequence,
+                  "pulse_id": int(self._pulse_id[index]),
+                  "global_timestamp": int(self._global_timestamp[index]),
+                  "global_timestamp_offset": int(self._global_timestamp_offset[index]),
+                  "spectrum": self._spectrum[index, :width].copy(),
+                  "center": float(self._center[index]),
+                  "fwhm": float(self._fwhm[index]),
+                  "noise_only": bool(self._noise_only[index]),
+                  "truncated": bool(self._spectrum_width[index] > width)}
+
+        if self._version[index] != version:
+            return None
+
+        return result
+
+    def read_latest(self, timeout=config.SHM_READ_TIMEOUT):
+        """
+        Read the last published result.
+
+        :param timeout: Time in seconds to retry when the result is overwritten while reading.
+        :return: Dictionary with the result, None if nothing was published yet.
+        """
+        end_time = time.time() + timeout
+
+        while True:
+            sequence = self.get_last_sequence()
+            if sequence == 0:
+                return None
+
+            result = self.read(sequence)
+            if result is not None or time.time() > end_time:
+                return result
+
+    def close(self):
+        self._unmap()
+        self._shm.close()
@@ -0,0 +1,79 @@
+import argparse
+import logging
+
+import bottle
+
+from psss_processing import config
+from psss_processing.manager import ProcessingManager
+from psss_processing.merger import get_stream_merger
+from psss_processing.rest_api.server import register_rest_interface, ThreadingWSGIRefServer
+from psss_processing.utils import get_host_port_from_stream_address
+
+_logger = logging.getLogger(__name__)
+
+
+def start_merger(input_streams, output_stream_port, rest_api_interface, rest_api_port, window_ms, pulse_id_step,
+                 auto_start, input_stream_mode=config.DEFAULT_MERGER_INPUT_STREAM_MODE):
+
+    _logger.info("Merging data from %s and outputting ordered data on port %s.", input_streams, output_stream_port)
+
+    input_stream_addresses = [get_host_port_from_stream_address(input_stream) for input_stream in input_streams]
+
+    stream_merger = get_stream_merger(input_stream_addresses=input_stream_addresses,
+                                      output_stream_port=output_stream_port,
+                                      window_ms=window_ms,
+                                      pulse_id_step=pulse_id_step,
+                                      input_stream_mode=input_stream_mode)
+
+    _logger.info("Auto start set to %s.", auto_start)
+    manager = ProcessingManager(stream_processor=stream_merger,
+                                auto_start=auto_start)
+
+    app = bottle.Bottle()
+
+    register_rest_interface(app, manager)
+
+    try:
+        _logger.info("Starting REST interface on interface %s and port %s.", rest_api_interface, rest_api_port)
+        bottle.run(app=app, server=ThreadingWSGIRefServer, host=rest_api_interface, port=rest_api_port)
+    finally:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the data streams of several PSSS processing nodes.')
+    parser.add_argument('input_streams', nargs='+', help="Data output streams of the processing nodes to merge.")
+    parser.add_argument('--input_stream_mode', default=config.DEFAULT_MERGER_INPUT_STREAM_MODE,
+                        choices=['push', 'pub'], help="Data output stream mode of the processing nodes.")
+    parser.add_argument('-o', '--output_stream_port', type=int, default=config.DEFAULT_MERGER_OUTPUT_STREAM_PORT,
+                        help="Merged output bsread stream port.")
+    parser.add_argument('-w', '--window_ms', type=int, default=config.DEFAULT_MERGER_WINDOW_MS,
+                        help="Time in ms a message waits for lower pulse_ids before it is sent out.")
+    parser.add_argument('--pulse_id_step', type=int, default=1,
+                        help="Expected pulse_id difference between consecutive images, used for gap accounting.")
+    parser.add_argument('-r', '--rest_api_port', default=config.DEFAULT_MERGER_REST_API_PORT, help="REST Api port.")
+    parser.add_argument('--rest_api_interface', default=config.DEFAULT_REST_API_INTERFACE,
+                        help="Hostname interface to bind to")
+    parser.add_argument("--log_level", default=config.DEFAULT_LOGGING_LEVEL,
+                        choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
+                        help="Log level to use.")
+    parser.add_argument("--auto_start", action="store_true", help="Start the merging as soon as "
+                                                                  "the service is started.")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=arguments.log_level)
+
+    _logger.info("Using log level %s.", arguments.log_level)
+
+    start_merger(input_streams=arguments.input_streams,
+                 output_stream_port=arguments.output_stream_port,
+                 rest_api_interface=arguments.rest_api_interface,
+                 rest_api_port=arguments.rest_api_port,
+                 window_ms=arguments.window_ms,
+                 pulse_id_step=arguments.pulse_id_step,
+                 auto_start=arguments.auto_start,
+                 input_stream_mode=arguments.input_stream_mode)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,16 +4,29 @@ import logging
 import bottle
 
 from psss_processing import config
+from psss_processing.affinity import ThreadTopology
+from psss_processing.capture import StreamCapture
 from psss_processing.manager import ProcessingManager
 from psss_processing.processor import get_stream_processor
-from psss_processing.rest_api.server import register_rest_interface
+from psss_processing.profiler import FrameProfiler
+from psss_processing.recorder import SpectrumRecorder
+from psss_processing.rest_api.server import register_rest_interface, ThreadingWSGIRefServer
+from psss_processing.shm_ring import ShmRingWriter
 from psss_processing.utils import get_host_port_from_stream_address
 
 _logger = logging.getLogger(__name__)
 
 
 def start_processing(input_stream, data_output_stream_port, image_output_stream_port, rest_api_interface, rest_api_port,
-                     epics_pv_name_prefix, output_pv, center_pv, fwhm_pv, ymin_pv, ymax_pv, axis_pv, auto_start):
+                     epics_pv_name_prefix, output_pv, center_pv, fwhm_pv, ymin_pv, ymax_pv, axis_pv, auto_start,
+                     recording_directory=config.DEFAULT_RECORDING_DIRECTORY, shm_name=None,
+                     shm_max_spectrum_width=config.DEFAULT_SHM_MAX_SPECTRUM_WIDTH,
+                     data_output_stream_mode=config.DEFAULT_DATA_OUTPUT_STREAM_MODE,
+                     data_output_stream_queue_size=config.DEFAULT_DATA_OUTPUT_STREAM_QUEUE_SIZE,
+                     data_output_stream_conflate=False, processing_cpus=config.DEFAULT_PROCESSING_CPUS,
+                     numba_cpus=config.DEFAULT_NUMBA_CPUS, io_cpus=config.DEFAULT_IO_CPUS,
+                     numba_threads=config.DEFAULT_NUMBA_THREADS, blas_threads=config.DEFAULT_BLAS_THREADS,
+                     state_file=config.DEFAULT_STATE_FILE, capture_directory=config.DEFAULT_CAPTURE_DIRECTORY):
 
     _logger.info("Receiving data from %s and outputting processed data on port %s and images on port %s.",
                  input_stream, data_output_stream_port, image_output_stream_port)
@@ -22,6 +35,24 @@ def start_processing(input_stream, data_output_stream_port, image_output_stream_
 
     input_stream_host, input_stream_port = get_host_port_from_stream_address(input_stream)
 
+    # Applied before any other thread is started, all threads inherit the affinity of the main thread.
+    thread_topology = ThreadTopology(processing_cpus=processing_cpus,
+                                     numba_cpus=numba_cpus,
+                                     io_cpus=io_cpus,
+                                     numba_threads=numba_threads,
+                                     blas_threads=blas_threads)
+    thread_topology.apply()
+
+    recorder = SpectrumRecorder(output_directory=recording_directory)
+    profiler = FrameProfiler()
+    capture = StreamCapture(epics_pv_name_prefix, ymin_pv_name=ymin_pv, ymax_pv_name=ymax_pv, axis_pv_name=axis_pv,
+                            output_directory=capture_directory)
+
+    result_ring = None
+    if shm_name:
+        _logger.info("Publishing the results to the shared memory '%s'.", shm_name)
+        result_ring = ShmRingWriter(shm_name, max_width=shm_max_spectrum_width)
+
     stream_processor = get_stream_processor(input_stream_host=input_stream_host,
                                             input_stream_port=input_stream_port,
                                             data_output_stream_port=data_output_stream_port,
@@ -32,7 +63,16 @@ def start_processing(input_stream, data_output_stream_port, image_output_stream_
                                             fwhm_pv_name=fwhm_pv,
                                             ymin_pv_name=ymin_pv,
                                             ymax_pv_name=ymax_pv,
-                                            axis_pv_name=axis_pv)
+                                            axis_pv_name=axis_pv,
+                                            recorder=recorder,
+                                            result_ring=result_ring,
+                                            profiler=profiler,
+                                            thread_topology=thread_topology,
+                                            state_file=state_file,
+                                            capture=capture,
+                                            data_output_stream_mode=data_output_stream_mode,
+                                            data_output_stream_queue_size=data_output_stream_queue_size,
+                                            data_output_stream_conflate=data_output_stream_conflate)
 
     _logger.info("Auto start set to %s.", auto_start)
     manager = ProcessingManager(stream_processor=stream_processor,
@@ -40,13 +80,17 @@ def start_processing(input_stream, data_output_stream_port, image_output_stream_
 
     app = bottle.Bottle()
 
-    register_rest_interface(app, manager)
+    register_rest_interface(app, manager, recorder, profiler, capture)
 
     try:
         _logger.info("Starting REST interface on interface %s and port %s.", rest_api_interface, rest_api_port)
-        bottle.run(app=app, host=rest_api_interface, port=rest_api_port)
+        bottle.run(app=app, server=ThreadingWSGIRefServer, host=rest_api_interface, port=rest_api_port)
     finally:
-        pass
+        recorder.stop()
+        capture.stop()
+
+        if result_ring is not None:
+            result_ring.close()
 
 
 def main():
@@ -61,6 +105,15 @@ def main():
     parser.add_argument('--axis_pv', default=config.DEFAULT_AXIS_PV, help="Epics PV to get energy axis.")
     parser.add_argument('-o', '--data_output_stream_port', type=int, default=config.DEFAULT_DATA_OUTPUT_STREAM_PORT,
                         help="Data output bsread stream port.")
+    parser.add_argument('--data_output_stream_mode', default=config.DEFAULT_DATA_OUTPUT_STREAM_MODE,
+                        choices=['push', 'pub'], help="Data output stream mode: push to a single consumer, "
+                                                      "or publish to all subscribers.")
+    parser.add_argument('--data_output_stream_queue_size', type=int,
+                        default=config.DEFAULT_DATA_OUTPUT_STREAM_QUEUE_SIZE,
+                        help="Data output stream queue size (zmq high water mark, per subscriber in pub mode).")
+    parser.add_argument('--data_output_stream_conflate', action="store_true",
+                        help="Latest-only data output stream: slow consumers get the latest message, the "
+                             "older messages are dropped.")
     parser.add_argument('--image_output_stream_port', type=int, default=config.DEFAULT_IMAGE_OUTPUT_STREAM_PORT,
                         help="Image output bsread stream port.")
     parser.add_argument('-r', '--rest_api_port', default=config.DEFAULT_REST_API_PORT, help="REST Api port.")
@@ -69,6 +122,26 @@ def main():
     parser.add_argument("--log_level", default=config.DEFAULT_LOGGING_LEVEL,
                         choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'],
                         help="Log level to use.")
+    parser.add_argument("--recording_directory", default=config.DEFAULT_RECORDING_DIRECTORY,
+                        help="Default directory for the spectrum recording files.")
+    parser.add_argument("--capture_directory", default=config.DEFAULT_CAPTURE_DIRECTORY,
+                        help="Default directory for the input stream capture files.")
+    parser.add_argument("--shm_name", default=None,
+                        help="Publish the results to a shared memory ring with this name, for local readers.")
+    parser.add_argument("--shm_max_spectrum_width", type=int, default=config.DEFAULT_SHM_MAX_SPECTRUM_WIDTH,
+                        help="Spectrum width of the shared memory slots, longer spectra are truncated.")
+    parser.add_argument("--state_file", default=config.DEFAULT_STATE_FILE,
+                        help="File to save the last ROI and energy axis, used until the EPICS PVs are connected.")
+    parser.add_argument("--processing_cpus", default=config.DEFAULT_PROCESSING_CPUS,
+                        help="Cpus of the processing thread, i.e. '2'.")
+    parser.add_argument("--numba_cpus", default=config.DEFAULT_NUMBA_CPUS,
+                        help="Cpus of the numba worker threads, i.e. '3-7'.")
+    parser.add_argument("--io_cpus", default=config.DEFAULT_IO_CPUS,
+                        help="Cpus of the other threads (zmq, EPICS, REST api), i.e. '0-1'.")
+    parser.add_argument("--numba_threads", type=int, default=config.DEFAULT_NUMBA_THREADS,
+                        help="Number of numba threads, by default the number of numba cpus.")
+    parser.add_argument("--blas_threads", type=int, default=config.DEFAULT_BLAS_THREADS,
+                        help="Number of BLAS threads (requires threadpoolctl).")
     parser.add_argument("--auto_start", action="store_true", help="Start the processing as soon as "
                                                                   "the service is started.")
     arguments = parser.parse_args()
@@ -89,7 +162,20 @@ def main():
                      ymin_pv=arguments.ymin_pv,
                      ymax_pv=arguments.ymax_pv,
                      axis_pv=arguments.axis_pv,
-                     auto_start=arguments.auto_start)
+                     auto_start=arguments.auto_start,
+                     recording_directory=arguments.recording_directory,
+                     shm_name=arguments.shm_name,
+                     shm_max_spectrum_width=arguments.shm_max_spectrum_width,
+                     data_output_stream_mode=arguments.data_output_stream_mode,
+                     data_output_stream_queue_size=arguments.data_output_stream_queue_size,
+                     data_output_stream_conflate=arguments.data_output_stream_conflate,
+                     processing_cpus=arguments.processing_cpus,
+                     numba_cpus=arguments.numba_cpus,
+                     io_cpus=arguments.io_cpus,
+                     numba_threads=arguments.numba_threads,
+                     blas_threads=arguments.blas_threads,
+                     state_file=arguments.state_file,
+                     capture_directory=arguments.capture_directory)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,80 @@
+import json
+import os
+from logging import getLogger
+
+import numpy
+
+_logger = getLogger(__name__)
+
+
+class ProcessingState(object):
+
+    def __init__(self, filename=None):
+        """
+        Last ROI and energy axis read from the EPICS PVs. They are used while the PVs are not connected, and
+        saved to disk, so the processing can start with them before the PVs are connected.
+
+        :param filename: JSON file of the state. No file is written if not set.
+        """
+        self.filename = filename
+
+        self.roi = None
+        self.axis = None
+
+        self._axis_value = None
+
+    def load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return
+
+        try:
+            with open(self.filename) as state_file:
+                state = json.load(state_file)
+
+            self.roi = state.get("roi")
+            if state.get("axis") is not None:
+                self.axis = numpy.array(state["axis"], dtype=numpy.float64)
+
+            _logger.info("Loaded the last ROI %s and energy axis (%s points) from %s.", self.roi,
+                         len(self.axis) if self.axis is not None else 0, self.filename)
+
+        except (OSError, ValueError):
+            _logger.exception("Cannot load the processing state from %s.", self.filename)
+
+    def update(self, roi, axis):
+        """
+        Called for each image with the current values. The state is saved only when a value changed.
+        """
+        changed = False
+
+        if roi != self.roi:
+            self.roi = [int(value) for value in roi]
+            changed = True
+
+        # The PV returns the same array until a new value is received.
+        if axis is not None and axis is not self._axis_value:
+            self._axis_value = axis
+
+            if self.axis is None or not numpy.array_equal(axis, self.axis):
+                self.axis = numpy.array(axis, dtype=numpy.float64)
+                changed = True
+
+        if changed:
+            self.save()
+
+    def save(self):
+        if not self.filename:
+            return
+
+        state = {"roi": self.roi,
+                 "axis": self.axis.tolist() if self.axis is not None else None}
+
+        try:
+            temp_filename = self.filename + ".tmp"
+            with open(temp_filename, "w") as state_file:
+                json.dump(state, state_file)
+
+            os.replace(temp_filename, self.filename)
+
+        except OSError:
+            _logger.exception("Cannot save the processing state to %s.", self.filename)
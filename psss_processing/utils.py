@@ -1,3 +1,5 @@
+import numpy
+
 
 def validate_roi(roi):
     """
@@ -22,6 +24,110 @@ def validate_roi(roi):
         raise ValueError("ROI sizes (second and fourth elements) must be at least 1, but %s was given." % roi)
 
 
+def validate_rois(rois):
+    """
+    Check if the additional ROIs are valid: List of [min_y, max_y] elements, with 0 <= min_y < max_y.
+    :param rois: [[min_y, max_y], ...]
+    :raises ValueError: When one of the ROIs is not valid, it raises a ValueError.
+    """
+
+    if not isinstance(rois, list):
+        raise ValueError("ROIs must be an instance of a list, but %s was given as a %s." % (rois, type(rois)))
+
+    for roi in rois:
+        if not isinstance(roi, list) or len(roi) != 2:
+            raise ValueError("Each ROI must be a list with exactly 2 elements, but %s was given." % roi)
+
+        if roi[0] < 0 or roi[1] <= roi[0]:
+            raise ValueError("ROI must satisfy 0 <= min_y < max_y, but %s was given." % roi)
+
+
+def validate_binning(binning, binning_mode):
+    """
+    Check if the spectrum binning parameters are valid.
+    :param binning: Number of pixels per bin, at least 1.
+    :param binning_mode: "sum" or "mean".
+    :raises ValueError: When the binning is not valid, it raises a ValueError.
+    """
+
+    if not isinstance(binning, int) or binning < 1:
+        raise ValueError("Binning must be an integer of at least 1, but %s was given." % binning)
+
+    if binning_mode not in ("sum", "mean"):
+        raise ValueError("Binning mode must be 'sum' or 'mean', but %s was given." % binning_mode)
+
+
+def validate_background_tracking(mode, alpha, step, update_interval):
+    """
+    Check if the background tracking parameters are valid.
+    :param mode: "" (disabled), "ema" or "median".
+    :param alpha: Weight of the current image in the exponential moving average, 0 < alpha <= 1.
+    :param step: Maximum change of a pixel value per image of the running median, larger than 0.
+    :param update_interval: Number of dark images between the background updates, integer of at least 1.
+    :raises ValueError: When one of the parameters is not valid, it raises a ValueError.
+    """
+
+    if mode not in ("", None, "ema", "median"):
+        raise ValueError("Background tracking must be '', 'ema' or 'median', but %s was given." % mode)
+
+    if not isinstance(alpha, (int, float)) or not 0 < alpha <= 1:
+        raise ValueError("Background tracking alpha must be in (0, 1], but %s was given." % alpha)
+
+    if not isinstance(step, (int, float)) or step <= 0:
+        raise ValueError("Background tracking step must be larger than 0, but %s was given." % step)
+
+    if not isinstance(update_interval, int) or isinstance(update_interval, bool) or update_interval < 1:
+        raise ValueError("Background update interval must be an integer of at least 1, but %s was given." %
+                         update_interval)
+
+
+def get_calibration_shift(shift, polynomial, n_rows):
+    """
+    Check the curvature calibration and get the x shift of each row.
+    :param shift: x shift in pixels for each image row, or None.
+    :param polynomial: Polynomial coefficients (highest degree first) of the x shift as a function of the row, or None.
+    :param n_rows: Number of image rows, required with polynomial.
+    :return: Shift of each row, or None to clear the calibration.
+    :raises ValueError: When the calibration is not valid, it raises a ValueError.
+    """
+
+    if shift is not None and polynomial is not None:
+        raise ValueError("Calibration must have either a shift or a polynomial, but both were given.")
+
+    if polynomial is not None:
+        if not isinstance(n_rows, int) or isinstance(n_rows, bool) or n_rows < 1:
+            raise ValueError("Calibration with a polynomial requires n_rows as an integer of at least 1, "
+                             "but %s was given." % n_rows)
+
+        polynomial = _get_float_list(polynomial, "polynomial")
+        if not polynomial:
+            raise ValueError("Calibration polynomial must have at least 1 coefficient.")
+
+        return numpy.polyval(polynomial, numpy.arange(n_rows))
+
+    if shift is not None:
+        shift = _get_float_list(shift, "shift")
+        if not shift:
+            raise ValueError("Calibration shift must have at least 1 row.")
+
+    return shift
+
+
+def _get_float_list(values, name):
+    if not isinstance(values, list):
+        raise ValueError("Calibration %s must be a list, but %s was given as a %s." % (name, values, type(values)))
+
+    try:
+        values = numpy.asarray(values, dtype=numpy.float64)
+    except (TypeError, ValueError):
+        raise ValueError("Calibration %s must be a list of numbers, but %s was given." % (name, values))
+
+    if values.ndim != 1 or not numpy.all(numpy.isfinite(values)):
+        raise ValueError("Calibration %s must be a list of finite numbers, but %s was given." % (name, values))
+
+    return values.tolist()
+
+
 def get_host_port_from_stream_address(stream_address):
     """
     Convert hostname in format tcp://127.0.0.1:8080 to host (127.0.0.1) and port (8080)
@@ -0,0 +1,133 @@
+from logging import getLogger
+from queue import Queue, Empty, Full
+from threading import Thread, Event, Lock
+
+_logger = getLogger(__name__)
+
+
+class BackgroundWriter(object):
+
+    # Name in the errors and the log, and status while running. Set by the subclasses.
+    name = "Writer"
+    running_status = "running"
+
+    def __init__(self, queue_size, queue_timeout, batch_size=1):
+        """
+        Writer thread of the recording and the capture. The processing only puts the items into a queue and never
+        blocks, the writer thread takes them in batches and writes them to the file. The subclasses write the
+        batches (_write_batch) and close the file (_close).
+
+        :param queue_size: Maximum number of items waiting to be written. Items are dropped when the queue is full.
+        :param queue_timeout: Time in seconds the writer thread waits for an item before checking if it is stopped.
+        :param batch_size: Maximum number of items written at once.
+        """
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.batch_size = batch_size
+
+        self.settings = {}
+        self.statistics = {}
+
+        self._queue = None
+        self._writer_thread = None
+        self._running_flag = Event()
+        self._lock = Lock()
+
+    def _start(self, settings, statistics):
+        """
+        Start the writer thread with new settings and statistics. The statistics need the n_dropped counter.
+        """
+        with self._lock:
+            if self.is_running():
+                raise RuntimeError("%s already running, stop it first." % self.name)
+
+            # Stopped by itself, the writer thread has still to be joined.
+            if self._writer_thread is not None:
+                self._writer_thread.join()
+
+            self.settings = settings
+            self.statistics = statistics
+
+            self._queue = Queue(maxsize=self.queue_size)
+            self._running_flag.set()
+
+            self._writer_thread = Thread(target=self._write, args=(self._queue, dict(settings)))
+            self._writer_thread.start()
+
+    def stop(self):
+        """
+        Stop the writer thread. The items already in the queue are written before the file is closed.
+        """
+        with self._lock:
+            if self._writer_thread is None:
+                return
+
+            self._running_flag.clear()
+            self._writer_thread.join()
+            self._writer_thread = None
+
+            _logger.info("%s stopped: %s", self.name, self.statistics)
+
+    def is_running(self):
+        return self._running_flag.is_set()
+
+    def get_status(self):
+        return self.running_status if self.is_running() else "stopped"
+
+    def get_statistics(self):
+        statistics = dict(self.statistics)
+        statistics["queue_size"] = self._queue.qsize() if self._queue is not None else 0
+
+        return statistics
+
+    def _put(self, item):
+        """
+        Queue an item. Never blocks: when the writer is behind, the item is dropped.
+
+        :return: True if the item was queued.
+        """
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except Full:
+            self.statistics["n_dropped"] += 1
+            return False
+
+    def _write(self, queue, settings):
+        try:
+            while self._running_flag.is_set() or not queue.empty():
+                try:
+                    batch = [queue.get(timeout=self.queue_timeout)]
+                except Empty:
+                    continue
+
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(queue.get_nowait())
+                    except Empty:
+                        break
+
+                if not self._write_batch(batch, settings):
+                    self._running_flag.clear()
+                    break
+
+        except Exception:
+            _logger.exception("Error while writing the %s.", self.name.lower())
+            self._running_flag.clear()
+
+        finally:
+            self._close()
+
+    def _write_batch(self, batch, settings):
+        """
+        Write a batch of items, in the writer thread.
+
+        :return: False to end the writing.
+        """
+        raise NotImplementedError()
+
+    def _close(self):
+        """
+        Close the file, in the writer thread.
+        """
+        raise NotImplementedError()
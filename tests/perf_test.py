@@ -1,8 +1,26 @@
 import unittest
-from time import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process
+from threading import Thread
+from time import time, sleep
 
+import bottle
 import numpy
+import requests
+
 import psss_processing.processor as processor
+from psss_processing import query_processors
+from psss_processing.manager import ProcessingManager
+from psss_processing.rest_api.server import register_rest_interface, ThreadingWSGIRefServer
+
+
+def run_rest_api(port):
+    manager = ProcessingManager(lambda running_flag, parameters, statistics: running_flag.set(),
+                                parameters={"background": ""})
+    app = bottle.Bottle()
+    register_rest_interface(app, manager)
+
+    bottle.run(app=app, server=ThreadingWSGIRefServer, host="127.0.0.1", port=port, quiet=True)
 
 
 class ImageProcessingPerformance(unittest.TestCase):
@@ -62,5 +80,199 @@ class ImageProcessingPerformance(unittest.TestCase):
         profile.print_stats()
 
 
+    def test_multi_gauss_fit_performance(self):
+        # simulated two color spectrum, fitted on every second point as in process_image
+        axis = numpy.linspace(8980, 9020, 2560)[::2]
+        spectrum = 5000 * numpy.exp(-(axis - 8995) ** 2 / (2 * 1.5 ** 2)) + \
+            3000 * numpy.exp(-(axis - 9005) ** 2 / (2 * 2 ** 2))
+        spectrum += numpy.random.normal(scale=100, size=axis.shape)
+
+        n_peaks = 2
+
+        # Warm-up numba.
+        processor.functions.multi_gauss_fit(spectrum, axis, n_peaks, processor.config.MULTI_PEAK_MIN_DISTANCE,
+                                            processor.config.MULTI_PEAK_MAX_ITERATIONS, False)
+
+        n_iterations = 1000
+
+        start_time = time()
+
+        for i in range(n_iterations):
+            processor.functions.multi_gauss_fit(spectrum, axis, n_peaks, processor.config.MULTI_PEAK_MIN_DISTANCE,
+                                                processor.config.MULTI_PEAK_MAX_ITERATIONS, False)
+
+        end_time = time()
+
+        time_difference = end_time - start_time
+
+        print("Multi gauss fit time per frame [ms]: ", time_difference / n_iterations * 1000)
+        print("n_peaks: ", n_peaks)
+        print("n_iterations: ", n_iterations)
+
+    def test_process_images_performance(self):
+        # simulated stack of spectra with moving center
+        n_images = 100
+        width = 2560
+        height = 400
+
+        axis = numpy.linspace(8980, 9020, width)
+        stack = numpy.empty((n_images, height, width), dtype="uint16")
+        for i in range(n_images):
+            stack[i] = 20 * numpy.exp(-(axis - 8995 - i * 0.1) ** 2 / (2 * 2 ** 2)) + 5
+
+        roi = [0, height]
+        parameters = {"background": ""}
+
+        # Warm-up numba.
+        processor.process_images(stack[:2], axis, roi, parameters)
+        processor.process_image(stack[0], axis, "image", roi, parameters)
+
+        start_time = time()
+        processor.process_images(stack, axis, roi, parameters)
+        batch_time = time() - start_time
+
+        start_time = time()
+        for image in stack:
+            processor.process_image(image, axis, "image", roi, parameters)
+        single_time = time() - start_time
+
+        print("process_images time per frame [ms]: ", batch_time / n_images * 1000)
+        print("process_image time per frame [ms]: ", single_time / n_images * 1000)
+
+    def test_gain_correction_performance(self):
+        width = 2560
+        height = 2016
+
+        image = (numpy.random.rand(height, width) * 50).astype(dtype="uint16")
+        background_image = (numpy.random.rand(height, width) * 5).astype(dtype="uint16")
+        gain = 0.9 + 0.2 * numpy.random.rand(height, width)
+
+        roi = [900, 1600]
+        axis = numpy.linspace(8980, 9020, width)
+        bands = processor.get_bands(roi, [], height)
+        row_profile = numpy.empty(height, dtype=numpy.float64)
+        no_shift = numpy.empty(0, dtype=numpy.int64)
+        no_gain = numpy.empty((0, 0), dtype=numpy.uint16)
+        gain_table = processor.functions.get_gain_table(gain)
+
+        def get_spectra(gain_image):
+            spectra = numpy.zeros((1, width), dtype=numpy.uint32)
+            processor.functions.get_spectra(image, background_image, gain_image, no_shift,
+                                            no_shift.astype(numpy.float64), bands, 65535, False, spectra, row_profile)
+
+        def apply_gain_before():
+            # flat field applied in numpy before the processing, two full frame float passes
+            corrected_image = ((image.astype(numpy.float32) - background_image) * gain).astype(numpy.uint16)
+            processor.functions.get_spectra(corrected_image, no_gain, no_gain, no_shift,
+                                            no_shift.astype(numpy.float64), bands, 65535, False,
+                                            numpy.zeros((1, width), dtype=numpy.uint32), row_profile)
+
+        n_iterations = 200
+
+        for name, function in [("without gain", lambda: get_spectra(no_gain)),
+                               ("with gain", lambda: get_spectra(gain_table)),
+                               ("gain applied in numpy", apply_gain_before)]:
+            # Warm-up numba.
+            function()
+
+            start_time = time()
+            for i in range(n_iterations):
+                function()
+            kernel_time = (time() - start_time) / n_iterations * 1000
+
+            print("get_spectra %s [ms]: " % name, kernel_time)
+
+        parameters = {"background": "in_memory", "background_data": background_image}
+        processor.process_image(image, axis, "image", roi, parameters)
+
+        for name in ["without gain", "with gain"]:
+            if name == "with gain":
+                parameters["gain_data"] = gain_table
+
+            start_time = time()
+            for i in range(n_iterations):
+                processor.process_image(image, axis, "image", roi, parameters)
+
+            print("process_image %s [ms]: " % name, (time() - start_time) / n_iterations * 1000)
+
+    def test_rest_api_latency(self):
+        # control plane latency with concurrent pollers, while the processing loop is running
+        axis = numpy.linspace(8980, 9020, 2560)
+        image = (20 * numpy.exp(-(axis - 8995) ** 2 / (2 * 2 ** 2)) + numpy.zeros((1000, 1))).astype("uint16")
+
+        def stream_processor(running_flag, parameters, statistics):
+            running_flag.set()
+
+            while running_flag.is_set():
+                processed_data = processor.process_image(image, axis, "image", [0, 1000], parameters)
+                statistics["last_calculated_spectrum"] = processed_data["image:SPECTRUM_Y"]
+                statistics["n_processed_images"] = statistics.get("n_processed_images", 0) + 1
+
+        n_pollers = 8
+        n_requests = 50
+
+        # the default wsgiref server cannot be shut down, each server uses its own port
+        for port, server_name, server_adapter in [(10101, "wsgiref", bottle.WSGIRefServer),
+                                                  (10102, "threading", ThreadingWSGIRefServer)]:
+            manager = ProcessingManager(stream_processor, parameters={"background": ""}, auto_start=True)
+
+            app = bottle.Bottle()
+            register_rest_interface(app, manager)
+
+            server = server_adapter(host="127.0.0.1", port=port, quiet=True)
+            Thread(target=bottle.run, kwargs={"app": app, "server": server, "quiet": True}, daemon=True).start()
+            sleep(0.5)
+
+            def poll(_):
+                latencies = []
+                with requests.Session() as session:
+                    for _ in range(n_requests):
+                        start_time = time()
+                        session.get("http://127.0.0.1:%d/statistics" % port)
+                        latencies.append(time() - start_time)
+                return latencies
+
+            with ThreadPoolExecutor(n_pollers) as executor:
+                latencies = numpy.concatenate(list(executor.map(poll, range(n_pollers)))) * 1000
+
+            manager.stop()
+
+            print("%s server, %d pollers: median %.2f ms, 99th percentile %.2f ms" %
+                  (server_name, n_pollers, numpy.median(latencies), numpy.percentile(latencies, 99)))
+
+    def test_query_processors_performance(self):
+        # polling cost of many instances, new connection per request vs. query_processors
+        n_polls = 20
+
+        for n_instances in [4, 16, 32]:
+            ports = [10200 + n_instances + index for index in range(n_instances)]
+            addresses = ["http://127.0.0.1:%d" % port for port in ports]
+
+            server_processes = [Process(target=run_rest_api, args=(port,), daemon=True) for port in ports]
+            for server_process in server_processes:
+                server_process.start()
+            sleep(2)
+
+            def poll_sequential():
+                for address in addresses:
+                    requests.get(address + "/status")
+                    requests.get(address + "/statistics")
+
+            for name, poll in [("Sequential requests", poll_sequential),
+                               ("query_processors", lambda: query_processors(addresses, timeout=1))]:
+                poll()
+
+                latencies = []
+                for _ in range(n_polls):
+                    start_time = time()
+                    poll()
+                    latencies.append(time() - start_time)
+
+                print("%s, %d instances: median %.2f ms, max %.2f ms per poll" %
+                      (name, n_instances, numpy.median(latencies) * 1000, numpy.max(latencies) * 1000))
+
+            for server_process in server_processes:
+                server_process.terminate()
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,61 @@
+import os
+import unittest
+from threading import Thread
+
+from psss_processing.affinity import parse_cpu_list, get_thread_affinity, set_thread_affinity, ThreadTopology
+
+
+class TestAffinity(unittest.TestCase):
+
+    def setUp(self):
+        self.cpus = get_thread_affinity()
+
+    def tearDown(self):
+        set_thread_affinity(self.cpus)
+
+    def test_parse_cpu_list(self):
+        self.assertListEqual(parse_cpu_list("0-3,6"), [0, 1, 2, 3, 6])
+        self.assertListEqual(parse_cpu_list("5, 1"), [1, 5])
+        self.assertListEqual(parse_cpu_list([2, 1]), [1, 2])
+        self.assertIsNone(parse_cpu_list(""))
+        self.assertIsNone(parse_cpu_list(None))
+
+        with self.assertRaises(ValueError):
+            parse_cpu_list("0-a")
+
+    def test_unavailable_cpus(self):
+        with self.assertRaises(ValueError):
+            ThreadTopology(processing_cpus=[max(os.sched_getaffinity(0)) + 1])
+
+    def test_apply(self):
+        cpus = self.cpus
+        results = {}
+
+        # Like at the startup of the service: the threads started afterwards inherit the io cpus.
+        topology = ThreadTopology(processing_cpus=cpus[-1:], numba_cpus=cpus, io_cpus=cpus[:1], numba_threads=1)
+        topology.apply()
+
+        self.assertListEqual(get_thread_affinity(), cpus[:1])
+
+        def processing():
+            results["processing_before"] = get_thread_affinity()
+            topology.pin_processing_thread()
+            results["processing"] = get_thread_affinity()
+
+        processing_thread = Thread(target=processing)
+        processing_thread.start()
+        processing_thread.join()
+
+        self.assertListEqual(results["processing_before"], cpus[:1])
+        self.assertListEqual(results["processing"], cpus[-1:])
+
+        self.assertDictEqual(topology.get_topology(), {"processing_cpus": cpus[-1:],
+                                                       "numba_cpus": cpus,
+                                                       "io_cpus": cpus[:1],
+                                                       "numba_threads": 1,
+                                                       "blas_threads": None,
+                                                       "applied": True})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+import numpy
+
+from psss_processing.averaging import SpectrumAverager
+from psss_processing.processor import process_averages
+
+
+class TestAveraging(unittest.TestCase):
+
+    def test_moving_average(self):
+        averager = SpectrumAverager()
+
+        spectra = [numpy.full(10, value, dtype="uint32") for value in [1, 2, 3, 4, 5]]
+
+        moving_averages = [averager.update(spectrum, window=3, ema_alpha=0)[0] for spectrum in spectra]
+
+        self.assertListEqual([average[0] for average in moving_averages], [1, 1.5, 2, 3, 4])
+        self.assertEqual(averager.get_n_spectra(), 3)
+
+        # Changing the window restarts the average.
+        moving_average, ema = averager.update(spectra[0], window=2, ema_alpha=0)
+        self.assertListEqual(list(moving_average), [1] * 10)
+        self.assertIsNone(ema)
+
+    def test_exponential_moving_average(self):
+        averager = SpectrumAverager()
+
+        _, ema = averager.update(numpy.full(10, 10, dtype="uint32"), window=0, ema_alpha=0.5)
+        self.assertListEqual(list(ema), [10] * 10)
+
+        moving_average, ema = averager.update(numpy.full(10, 20, dtype="uint32"), window=0, ema_alpha=0.5)
+        self.assertListEqual(list(ema), [15] * 10)
+        self.assertIsNone(moving_average)
+
+    def test_process_averages(self):
+        pv_name_prefix = "JUST_TESTING"
+        axis = numpy.linspace(9100, 9200, 512)
+        spectrum = (10000 * numpy.exp(-(axis - 9150) ** 2 / (2 * 5 ** 2))).astype("uint32")
+
+        averager = SpectrumAverager()
+        parameters = {"average_window": 10, "ema_alpha": 0.1, "average_fit_interval": 5}
+
+        for _ in range(6):
+            processed_data = {pv_name_prefix + ":SPECTRUM_Y": spectrum, pv_name_prefix + ":SPECTRUM_X": axis}
+            process_averages(averager, processed_data, pv_name_prefix, 100, parameters)
+
+        self.assertEqual(len(processed_data[pv_name_prefix + ":SPECTRUM_Y_AVG"]), 512)
+        self.assertEqual(len(processed_data[pv_name_prefix + ":SPECTRUM_Y_EMA"]), 512)
+        self.assertAlmostEqual(processed_data[pv_name_prefix + ":SPECTRUM_CENTER_AVG"], 9150, delta=0.5)
+        self.assertIn(pv_name_prefix + ":SPECTRUM_FWHM_AVG", processed_data)
+
+        processed_data = {pv_name_prefix + ":SPECTRUM_Y": spectrum, pv_name_prefix + ":SPECTRUM_X": axis}
+        process_averages(averager, processed_data, pv_name_prefix, 100, {})
+        self.assertSetEqual(set(processed_data.keys()), {pv_name_prefix + ":SPECTRUM_Y",
+                                                         pv_name_prefix + ":SPECTRUM_X"})
+
+    def test_enable_fit_while_processing(self):
+        pv_name_prefix = "JUST_TESTING"
+        axis = numpy.linspace(9100, 9200, 512)
+        spectrum = (10000 * numpy.exp(-(axis - 9150) ** 2 / (2 * 5 ** 2))).astype("uint32")
+
+        averager = SpectrumAverager()
+        parameters = {"average_window": 10, "ema_alpha": 0, "average_fit_interval": 0}
+
+        for _ in range(2):
+            processed_data = {pv_name_prefix + ":SPECTRUM_Y": spectrum, pv_name_prefix + ":SPECTRUM_X": axis}
+            process_averages(averager, processed_data, pv_name_prefix, 100, parameters)
+
+        self.assertNotIn(pv_name_prefix + ":SPECTRUM_CENTER_AVG", processed_data)
+
+        # The fit interval is changed through the REST api while the processing is running.
+        parameters["average_fit_interval"] = 5
+
+        processed_data = {pv_name_prefix + ":SPECTRUM_Y": spectrum, pv_name_prefix + ":SPECTRUM_X": axis}
+        process_averages(averager, processed_data, pv_name_prefix, 100, parameters)
+        self.assertAlmostEqual(processed_data[pv_name_prefix + ":SPECTRUM_CENTER_AVG"], 9150, delta=0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+
+import numpy
+
+from psss_processing.background import BackgroundTracker
+from psss_processing.processor import process_image, track_background
+from psss_processing.utils import validate_background_tracking
+
+
+class FakeValue(object):
+    def __init__(self, value):
+        self.value = value
+
+
+class TestBackground(unittest.TestCase):
+
+    def test_background_tracker(self):
+        background_tracker = BackgroundTracker()
+
+        background_tracker.update(numpy.full((10, 20), 10, dtype="uint16"), "ema", 0.5)
+        background_tracker.update(numpy.full((10, 20), 20, dtype="uint16"), "ema", 0.5)
+
+        self.assertEqual(background_tracker.n_dark_images, 2)
+        self.assertTrue((background_tracker.get_background(numpy.uint16) == 15).all())
+
+        background_tracker.reset()
+
+        background_tracker.update(numpy.full((10, 20), 10, dtype="uint16"), "median", 2)
+        background_tracker.update(numpy.full((10, 20), 100, dtype="uint16"), "median", 2)
+        background_tracker.update(numpy.full((10, 20), 11, dtype="uint16"), "median", 2)
+
+        self.assertTrue((background_tracker.get_background(numpy.uint16) == 11).all())
+
+    def test_track_background(self):
+        pv_name_prefix = "JUST_TESTING"
+        axis = numpy.linspace(9100, 9200, 512)
+        roi = [0, 100]
+
+        dark_image = numpy.full((100, 512), 5, dtype="uint16")
+        parameters = {"background": "", "background_tracking": "ema", "background_update_interval": 3}
+        statistics = {}
+
+        background_tracker = BackgroundTracker()
+
+        for _ in range(3):
+            processed_data = process_image(dark_image, axis, pv_name_prefix, roi, parameters)
+            self.assertTrue(processed_data[pv_name_prefix + ":SPECTRUM_NOISE_ONLY"])
+
+            track_background(background_tracker, dark_image, {}, processed_data, pv_name_prefix, parameters,
+                             statistics)
+
+        self.assertEqual(statistics["n_dark_images"], 3)
+        self.assertEqual(parameters["background"], "tracked_ema")
+        self.assertTrue((parameters["background_data"] == 5).all())
+
+        processed_data = process_image(dark_image, axis, pv_name_prefix, roi, parameters)
+        self.assertListEqual(list(processed_data[pv_name_prefix + ":SPECTRUM_Y"]), [0] * 512)
+
+        # With a beam off channel, only marked images are used.
+        parameters["beam_off_channel"] = "EVENT_CODE"
+        parameters["beam_off_value"] = 0
+
+        track_background(background_tracker, dark_image, {"EVENT_CODE": FakeValue(1)}, processed_data,
+                         pv_name_prefix, parameters, statistics)
+        self.assertEqual(statistics["n_dark_images"], 3)
+
+        track_background(background_tracker, dark_image, {"EVENT_CODE": FakeValue(0)}, processed_data,
+                         pv_name_prefix, parameters, statistics)
+        self.assertEqual(statistics["n_dark_images"], 4)
+
+    def test_validate_background_tracking(self):
+        validate_background_tracking("median", 0.01, 1, 100)
+        validate_background_tracking("", 1, 0.5, 1)
+
+        for parameters in [("mean", 0.01, 1, 100), ("ema", 0, 1, 100), ("ema", 0.01, 0, 100),
+                           ("ema", 0.01, 1, 0), ("ema", 0.01, 1, 2.5)]:
+            with self.assertRaises(ValueError):
+                validate_background_tracking(*parameters)
+
+
+if __name__ == '__main__':
+    unittest.main()
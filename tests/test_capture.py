@@ -0,0 +1,90 @@
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy
+
+from psss_processing.capture import StreamCapture
+from psss_processing.replay import read_capture
+from psss_processing.reprocess import get_dataset_name, read_images, read_array
+
+
+class TestCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+        self.pv_name_prefix = "JUST_TESTING"
+        self.axis = numpy.linspace(9100, 9200, 512)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory)
+
+    def get_image(self, pulse_id):
+        return numpy.full((100, 512), pulse_id, dtype="uint16")
+
+    def test_capture(self):
+        capture = StreamCapture(self.pv_name_prefix, ymin_pv_name="TEST:YMIN", ymax_pv_name="TEST:YMAX",
+                                axis_pv_name=self.pv_name_prefix + ":SPECTRUM_X",
+                                output_directory=self.output_directory)
+
+        # Not capturing, nothing is queued.
+        capture.capture(0, (0, 0), self.get_image(0), [10, 90], self.axis)
+
+        capture.start(max_images=20)
+        self.assertEqual(capture.get_status(), "capturing")
+
+        for pulse_id in range(1, 31):
+            capture.capture(pulse_id, (1000, pulse_id * 10000000), self.get_image(pulse_id), [pulse_id, 90],
+                            self.axis)
+
+        # The capture stops by itself after max_images.
+        self.assertEqual(capture.get_status(), "stopped")
+        capture.stop()
+
+        statistics = capture.get_statistics()
+        self.assertEqual(statistics["n_captured"], 20)
+        self.assertEqual(statistics["n_dropped"], 0)
+
+        filename = statistics["filename"]
+        with h5py.File(filename, "r") as capture_file:
+            pulse_ids, global_timestamps, global_timestamp_offsets, channels = read_capture(capture_file)
+
+            self.assertListEqual(list(pulse_ids), list(range(1, 21)))
+            self.assertEqual(global_timestamp_offsets[4], 50000000)
+            self.assertSetEqual(set(channels), {self.pv_name_prefix + ":FPICTURE", "TEST:YMIN", "TEST:YMAX",
+                                                self.pv_name_prefix + ":SPECTRUM_X"})
+
+            self.assertEqual(channels[self.pv_name_prefix + ":FPICTURE"].shape, (20, 100, 512))
+            self.assertEqual(channels[self.pv_name_prefix + ":FPICTURE"][4, 0, 0], 5)
+            self.assertEqual(channels["TEST:YMIN"][4], 5)
+            self.assertEqual(channels["TEST:YMAX"][4], 90)
+            numpy.testing.assert_array_equal(channels[self.pv_name_prefix + ":SPECTRUM_X"][4], self.axis)
+
+        # The file can be reprocessed offline with psss_reprocess.
+        images = read_images(filename, get_dataset_name(self.pv_name_prefix, ":FPICTURE"), 2, 4)
+        self.assertEqual(images.shape, (2, 100, 512))
+        self.assertEqual(read_array(filename, get_dataset_name(self.pv_name_prefix, ":SPECTRUM_X")).shape, (20, 512))
+
+    def test_image_shape_change(self):
+        capture = StreamCapture(self.pv_name_prefix, output_directory=self.output_directory)
+
+        with self.assertRaises(ValueError):
+            capture.start(compression="zstd")
+
+        capture.start(max_images=0)
+        capture.capture(1, (1000, 0), self.get_image(1), [0, 0], self.axis)
+        capture.capture(2, (1000, 0), numpy.zeros((50, 512), dtype="uint16"), [0, 0], self.axis)
+        capture.capture(3, (1000, 0), self.get_image(3), [0, 0], self.axis)
+        capture.stop()
+
+        self.assertEqual(capture.get_statistics()["n_captured"], 1)
+
+        # Without PV names, only the image channel is captured.
+        with h5py.File(capture.get_statistics()["filename"], "r") as capture_file:
+            channels = read_capture(capture_file)[3]
+            self.assertListEqual(list(channels), [self.pv_name_prefix + ":FPICTURE"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+from threading import Event
+
+import zmq
+
+from psss_processing.latest import LatestSender
+
+
+class SlowStream(object):
+
+    def __init__(self):
+        self.is_open = False
+        self.sent = []
+        self.consumer_ready = Event()
+        self.n_timeouts = 0
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def send(self, pulse_id, timestamp, data):
+        # A blocking send, which waits for the consumer to take the message.
+        if not self.consumer_ready.wait(timeout=0.1):
+            self.n_timeouts += 1
+            raise zmq.Again()
+
+        self.consumer_ready.clear()
+        self.sent.append(pulse_id)
+
+
+class TestLatestSender(unittest.TestCase):
+
+    def test_latest_only(self):
+        stream = SlowStream()
+
+        with LatestSender(stream) as latest_sender:
+            self.assertTrue(stream.is_open)
+
+            # The consumer is not ready, the sender thread waits and the older results are replaced.
+            for pulse_id in range(10):
+                latest_sender.send(pulse_id, (0, 0), {"value": pulse_id})
+
+            # Resent after the send timeout, until the consumer takes it.
+            while stream.n_timeouts < 2:
+                pass
+
+            stream.consumer_ready.set()
+            while latest_sender.last_sent_pulse_id is None:
+                pass
+
+            self.assertListEqual(stream.sent, [9])
+            self.assertEqual(latest_sender.n_sent, 1)
+            self.assertEqual(latest_sender.n_dropped, 9)
+
+            latest_sender.send(10, (0, 0), {"value": 10})
+            stream.consumer_ready.set()
+
+        # The latest result is sent before stopping.
+        self.assertFalse(stream.is_open)
+        self.assertListEqual(stream.sent, [9, 10])
+
+    def test_stop_without_consumer(self):
+        stream = SlowStream()
+
+        with LatestSender(stream) as latest_sender:
+            latest_sender.send(1, (0, 0), {})
+
+        self.assertListEqual(stream.sent, [])
+        self.assertEqual(latest_sender.n_dropped, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+from psss_processing.merger import PulseReorderBuffer, get_stream_merger
+
+
+class TestMerger(unittest.TestCase):
+
+    def test_reorder_within_window(self):
+        reorder_buffer = PulseReorderBuffer(window=1)
+
+        for pulse_id in [3, 1, 2, 5, 4]:
+            self.assertTrue(reorder_buffer.add(pulse_id, "message_%d" % pulse_id, arrival_time=0))
+
+        self.assertListEqual(reorder_buffer.pop_ready(current_time=0.5), [])
+        self.assertEqual(len(reorder_buffer), 5)
+
+        released = reorder_buffer.pop_ready(current_time=1)
+        self.assertListEqual([pulse_id for pulse_id, _ in released], [1, 2, 3, 4, 5])
+        self.assertListEqual([message for _, message in released], ["message_%d" % x for x in range(1, 6)])
+
+        self.assertEqual(reorder_buffer.n_released, 5)
+        self.assertEqual(reorder_buffer.n_missing, 0)
+
+    def test_gap_accounting(self):
+        reorder_buffer = PulseReorderBuffer(window=0)
+
+        for pulse_id in [10, 11, 14, 20]:
+            reorder_buffer.add(pulse_id, None, arrival_time=0)
+        reorder_buffer.flush()
+
+        self.assertEqual(reorder_buffer.n_gaps, 2)
+        self.assertEqual(reorder_buffer.n_missing, 7)
+
+        # Pulse ids lower or equal than the last released are dropped.
+        self.assertFalse(reorder_buffer.add(15, None, arrival_time=0))
+        self.assertFalse(reorder_buffer.add(20, None, arrival_time=0))
+        self.assertEqual(reorder_buffer.n_late, 1)
+        self.assertEqual(reorder_buffer.n_duplicated, 1)
+
+        step_buffer = PulseReorderBuffer(window=0, pulse_id_step=2)
+        for pulse_id in [2, 4, 8]:
+            step_buffer.add(pulse_id, None, arrival_time=0)
+        step_buffer.flush()
+
+        self.assertEqual(step_buffer.n_missing, 1)
+
+    def test_buffer_overflow(self):
+        reorder_buffer = PulseReorderBuffer(window=10, max_size=2)
+
+        for pulse_id in [5, 3, 4]:
+            reorder_buffer.add(pulse_id, None, arrival_time=0)
+
+        released = reorder_buffer.pop_ready(current_time=0)
+        self.assertListEqual([pulse_id for pulse_id, _ in released], [3])
+        self.assertEqual(len(reorder_buffer), 2)
+
+    def test_invalid_input_stream_mode(self):
+        with self.assertRaises(ValueError):
+            get_stream_merger([("localhost", 10000)], 11000, input_stream_mode="pair")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+import numpy
+
+from psss_processing import overload
+from psss_processing.overload import LoadShedder
+from psss_processing.processor import process_image
+
+
+class TestOverload(unittest.TestCase):
+
+    def test_escalation_and_recovery(self):
+        load_shedder = LoadShedder(high_lag=0.2, low_lag=0.05, escalate_after=2, recover_after=3, decimation=2)
+
+        # Constant offset between the clocks is not considered a lag.
+        self.assertEqual(load_shedder.update(pulse_timestamp=0, current_time=10), overload.OVERLOAD_LEVEL_NORMAL)
+        self.assertEqual(load_shedder.update(pulse_timestamp=1, current_time=11), overload.OVERLOAD_LEVEL_NORMAL)
+
+        levels = [load_shedder.update(pulse_timestamp=1, current_time=12) for _ in range(8)]
+        self.assertListEqual(levels, [0, 1, 1, 2, 2, 3, 3, 3])
+        self.assertAlmostEqual(load_shedder.lag, 1)
+
+        self.assertListEqual([load_shedder.should_process() for _ in range(4)], [False, True, False, True])
+        self.assertEqual(load_shedder.n_shed_images, 2)
+
+        levels = [load_shedder.update(pulse_timestamp=2, current_time=12) for _ in range(9)]
+        self.assertListEqual(levels, [3, 3, 2, 2, 2, 1, 1, 1, 0])
+
+        self.assertTrue(all(load_shedder.should_process() for _ in range(4)))
+
+    def test_baseline_window(self):
+        load_shedder = LoadShedder(high_lag=0.2, low_lag=0.05, escalate_after=2, recover_after=3, baseline_window=10)
+
+        # A single early pulse with a low lag.
+        load_shedder.update(pulse_timestamp=0, current_time=0)
+
+        levels = [load_shedder.update(pulse_timestamp=time, current_time=time + 1) for time in range(1, 30)]
+        self.assertAlmostEqual(load_shedder.lag, 0)
+        self.assertEqual(levels[-1], overload.OVERLOAD_LEVEL_NORMAL)
+
+        load_shedder.update(pulse_timestamp=30, current_time=40)
+        load_shedder.update(pulse_timestamp=30, current_time=40)
+        self.assertEqual(load_shedder.level, overload.OVERLOAD_LEVEL_NO_FIT)
+
+        load_shedder.reset()
+        self.assertEqual(load_shedder.level, overload.OVERLOAD_LEVEL_NORMAL)
+        self.assertEqual(load_shedder.update(pulse_timestamp=30, current_time=40), overload.OVERLOAD_LEVEL_NORMAL)
+
+    def test_process_image_overload_levels(self):
+        axis = numpy.linspace(9100, 9200, 512)
+
+        spectrum = 1000 * numpy.exp(-(axis - 9130) ** 2 / (2 * 3 ** 2))
+        image = numpy.zeros(shape=(100, 512), dtype="uint16")
+        image[:] = spectrum / 100
+
+        pv_name_prefix = "JUST_TESTING"
+
+        roi = [0, 100]
+        parameters = {"background": ""}
+
+        for overload_level in [overload.OVERLOAD_LEVEL_NORMAL, overload.OVERLOAD_LEVEL_NO_FIT,
+                               overload.OVERLOAD_LEVEL_NO_SMOOTHING]:
+            processed_data = process_image(image, axis, pv_name_prefix, roi, parameters, overload_level)
+
+            self.assertEqual(len(processed_data[pv_name_prefix + ":SPECTRUM_Y"]), 512)
+            self.assertAlmostEqual(processed_data[pv_name_prefix + ":SPECTRUM_CENTER"], 9130, delta=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
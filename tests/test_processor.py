@@ -7,8 +7,9 @@ from multiprocessing import Process, Event
 from bsread import source, PULL, json
 from scipy import ndimage
 
-from psss_processing import config
-from psss_processing.processor import get_stream_processor, process_image
+from psss_processing import config, functions
+from psss_processing.processor import get_stream_processor, process_image, process_images, get_input_pv_value, \
+    check_calibration
 
 
 class TestProcessing(unittest.TestCase):
@@ -30,7 +31,14 @@ class TestProcessing(unittest.TestCase):
                                                          pv_name_prefix + ":SPECTRUM_X",
                                                          pv_name_prefix + ":SPECTRUM_CENTER",
                                                          pv_name_prefix + ":SPECTRUM_FWHM",
-                                                         pv_name_prefix + config.EPICS_PV_SUFFIX_IMAGE})
+                                                         pv_name_prefix + ":SPECTRUM_NOISE_ONLY",
+                                                         pv_name_prefix + ":SATURATED_PIXELS",
+                                                         pv_name_prefix + ":MAX_PIXEL_VALUE",
+                                                         pv_name_prefix + ":TOTAL_INTENSITY",
+                                                         pv_name_prefix + ":ROW_PROFILE"})
+
+        # The image is only sent out on the image stream.
+        self.assertNotIn(pv_name_prefix + config.EPICS_PV_SUFFIX_IMAGE, processed_data)
 
         # Original image should not be manipulated
         self.assertEqual(image.shape, (1024, 512))
@@ -39,6 +47,295 @@ class TestProcessing(unittest.TestCase):
 
         processing_parameters = json.loads(processed_data[pv_name_prefix + ":processing_parameters"])
 
+    def test_process_image_multiple_rois(self):
+        image = numpy.zeros(shape=(1024, 512), dtype="uint16")
+        image[100:200, :] = 2
+        image[500:600, :] = 3
+
+        pv_name_prefix = "JUST_TESTING"
+
+        axis = numpy.linspace(9100, 9200, 512)
+
+        roi = [0, 1024]
+        parameters = {"background": "", "rois": [[100, 200], [500, 550], [1000, 2000]]}
+
+        processed_data = process_image(image, axis, pv_name_prefix, roi, parameters)
+
+        for suffix in ["", "_ROI1", "_ROI2", "_ROI3"]:
+            self.assertIn(pv_name_prefix + ":SPECTRUM_Y" + suffix, processed_data)
+            self.assertIn(pv_name_prefix + ":SPECTRUM_CENTER" + suffix, processed_data)
+            self.assertIn(pv_name_prefix + ":SPECTRUM_FWHM" + suffix, processed_data)
+
+        self.assertListEqual(list(processed_data[pv_name_prefix + ":SPECTRUM_Y"]), [500] * 512)
+        self.assertListEqual(list(processed_data[pv_name_prefix + ":SPECTRUM_Y_ROI1"]), [200] * 512)
+        self.assertListEqual(list(processed_data[pv_name_prefix + ":SPECTRUM_Y_ROI2"]), [150] * 512)
+        # ROIs are clipped to the image size.
+        self.assertListEqual(list(processed_data[pv_name_prefix + ":SPECTRUM_Y_ROI3"]), [0] * 512)
+
+        processing_parameters = json.loads(processed_data[pv_name_prefix + ":processing_parameters"])
+        self.assertListEqual(processing_parameters["rois"], parameters["rois"])
+
+    def test_process_image_two_colors(self):
+        axis = numpy.linspace(9100, 9200, 512)
+
+        spectrum = 1000 * numpy.exp(-(axis - 9130) ** 2 / (2 * 3 ** 2)) + \
+            600 * numpy.exp(-(axis - 9170) ** 2 / (2 * 5 ** 2))
+        image = numpy.zeros(shape=(100, 512), dtype="uint16")
+        image[:] = spectrum / 100
+
+        pv_name_prefix = "JUST_TESTING"
+
+        roi = [0, 100]
+        parameters = {"background": "", "n_peaks": 2}
+
+        processed_data = process_image(image, axis, pv_name_prefix, roi, parameters)
+
+        centers = processed_data[pv_name_prefix + ":SPECTRUM_PEAK_CENTERS"]
+        fwhms = processed_data[pv_name_prefix + ":SPECTRUM_PEAK_FWHMS"]
+        amplitudes = processed_data[pv_name_prefix + ":SPECTRUM_PEAK_AMPLITUDES"]
+
+        self.assertEqual(len(centers), 2)
+        self.assertAlmostEqual(centers[0], 9130, delta=0.5)
+        self.assertAlmostEqual(centers[1], 9170, delta=0.5)
+        self.assertAlmostEqual(fwhms[0], 2.355 * 3, delta=1)
+        self.assertAlmostEqual(fwhms[1], 2.355 * 5, delta=1)
+        self.assertGreater(amplitudes[0], amplitudes[1])
+
+    def test_process_image_binning(self):
+        image = numpy.zeros(shape=(1024, 510), dtype="uint16")
+        image += 1
+
+        pv_name_prefix = "JUST_TESTING"
+
+        axis = numpy.linspace(9100, 9200, 510)
+
+        roi = [0, 1024]
+        parameters = {"background": "", "binning": 4, "publish_full_spectrum": False}
+
+        processed_data = process_image(image, axis, pv_name_prefix, roi, parameters)
+
+        spectrum = processed_data[pv_name_prefix + ":SPECTRUM_Y"]
+        binned_axis = processed_data[pv_name_prefix + ":SPECTRUM_X"]
+
+        # The last bin contains only the remaining 2 pixels.
+        self.assertEqual(len(spectrum), 128)
+        self.assertListEqual(list(spectrum), [4 * 1024] * 127 + [2 * 1024])
+        self.assertEqual(len(binned_axis), 128)
+        self.assertAlmostEqual(binned_axis[0], axis[:4].mean())
+        self.assertAlmostEqual(binned_axis[-1], axis[-2:].mean())
+
+        parameters["binning_mode"] = "mean"
+        processed_data = process_image(image, axis, pv_name_prefix, roi, parameters)
+        self.assertListEqual(list(processed_data[pv_name_prefix + ":SPECTRUM_Y"]), [1024] * 128)
+
+        parameters["publish_full_spectrum"] = True
+        processed_data = process_image(image, axis, pv_name_prefix, roi, parameters)
+        self.assertEqual(len(processed_data[pv_name_prefix + ":SPECTRUM_Y"]), 510)
+        self.assertEqual(len(processed_data[pv_name_prefix + ":SPECTRUM_X"]), 510)
+
+        # Large binnings leave fewer bins than the smoothing window: the window is reduced, or no smoothing.
+        for binning in (64, 128, 510):
+            parameters = {"background": "", "binning": binning, "publish_full_spectrum": False}
+            processed_data = process_image(image, axis, pv_name_prefix, roi, parameters)
+            self.assertEqual(len(processed_data[pv_name_prefix + ":SPECTRUM_Y"]), -(-510 // binning))
+            self.assertEqual(len(process_images(image[numpy.newaxis], axis, roi, parameters)["SPECTRUM_CENTER"]), 1)
+
+    def test_process_image_quality_metrics(self):
+        image = numpy.zeros(shape=(1024, 512), dtype="uint16")
+        image[10, :] = 3
+        image[20, 0:5] = 65535
+
+        background = numpy.ones(shape=(1024, 512), dtype="uint16")
+
+        pv_name_prefix = "JUST_TESTING"
+
+        axis = numpy.linspace(9100, 9200, 512)
+
+        roi = [100, 200]
+        parameters = {"background": "test", "background_data": background, "full_image_metrics": True}
+
+        processed_data = process_image(image, axis, pv_name_prefix, roi, parameters)
+
+        self.assertEqual(processed_data[pv_name_prefix + ":SATURATED_PIXELS"], 5)
+        self.assertEqual(processed_data[pv_name_prefix + ":MAX_PIXEL_VALUE"], 65535)
+        self.assertEqual(processed_data[pv_name_prefix + ":TOTAL_INTENSITY"], 512 * 2 + 5 * 65534)
+
+        row_profile = processed_data[pv_name_prefix + ":ROW_PROFILE"]
+        self.assertEqual(len(row_profile), 1024)
+        self.assertEqual(row_profile[10], 512 * 2)
+        self.assertEqual(row_profile[20], 5 * 65534)
+
+        parameters["saturation_level"] = 3
+        processed_data = process_image(image, axis, pv_name_prefix, roi, parameters)
+        self.assertEqual(processed_data[pv_name_prefix + ":SATURATED_PIXELS"], 512 + 5)
+
+        # By default only the rows inside the ROIs are considered.
+        parameters["full_image_metrics"] = False
+        parameters["rois"] = [[0, 15]]
+        processed_data = process_image(image, axis, pv_name_prefix, roi, parameters)
+        self.assertEqual(processed_data[pv_name_prefix + ":SATURATED_PIXELS"], 512)
+        self.assertEqual(processed_data[pv_name_prefix + ":MAX_PIXEL_VALUE"], 3)
+        self.assertEqual(processed_data[pv_name_prefix + ":TOTAL_INTENSITY"], 512 * 2)
+        self.assertEqual(processed_data[pv_name_prefix + ":ROW_PROFILE"][20], 0)
+
+    def test_process_image_curvature_correction(self):
+        image = numpy.zeros(shape=(100, 512), dtype="uint16")
+        line_position = (200 + 0.3 * numpy.arange(100)).astype(int)
+        image[numpy.arange(100), line_position] = 10
+
+        pv_name_prefix = "JUST_TESTING"
+
+        axis = numpy.linspace(9100, 9200, 512)
+
+        roi = [0, 100]
+        parameters = {"background": "", "calibration": "test",
+                      "calibration_data": functions.get_shift_table(200 - line_position)}
+
+        processed_data = process_image(image, axis, pv_name_prefix, roi, parameters)
+
+        spectrum = processed_data[pv_name_prefix + ":SPECTRUM_Y"]
+        self.assertEqual(spectrum[200], 1000)
+        self.assertEqual(spectrum.sum(), 1000)
+
+        # Fractional shifts split the counts between the neighbouring pixels.
+        parameters["calibration_data"] = functions.get_shift_table(200.25 - line_position)
+
+        processed_data = process_image(image, axis, pv_name_prefix, roi, parameters)
+
+        spectrum = processed_data[pv_name_prefix + ":SPECTRUM_Y"]
+        self.assertAlmostEqual(spectrum[200], 750)
+        self.assertAlmostEqual(spectrum[201], 250)
+
+        processing_parameters = json.loads(processed_data[pv_name_prefix + ":processing_parameters"])
+        self.assertEqual(processing_parameters["calibration"], "test")
+
+        # Calibration for a different image size is ignored.
+        parameters["calibration_data"] = functions.get_shift_table(numpy.zeros(50))
+
+        processed_data = process_image(image, axis, pv_name_prefix, roi, parameters)
+        self.assertEqual(processed_data[pv_name_prefix + ":SPECTRUM_Y"][200], 40)
+
+        # The stream processor reports it in the statistics.
+        statistics = {}
+        check_calibration(parameters, image.shape[0], statistics)
+        self.assertIn("50 rows", statistics["calibration_error"])
+
+        parameters["calibration_data"] = None
+        check_calibration(parameters, image.shape[0], statistics)
+        self.assertIsNone(statistics["calibration_error"])
+
+    def test_process_image_gain(self):
+        image = numpy.full((100, 512), 12, dtype="uint16")
+        background_image = numpy.full((100, 512), 2, dtype="uint16")
+
+        gain = numpy.ones((100, 512))
+        gain[:, 100] = 2
+        gain[:50, 200] = 0.5
+        gain[:, 300] = 1.25
+
+        pv_name_prefix = "JUST_TESTING"
+        axis = numpy.linspace(9100, 9200, 512)
+
+        roi = [0, 100]
+        parameters = {"background": "in_memory", "background_data": background_image, "gain": "test",
+                      "gain_data": functions.get_gain_table(gain)}
+
+        processed_data = process_image(image, axis, pv_name_prefix, roi, parameters)
+
+        spectrum = processed_data[pv_name_prefix + ":SPECTRUM_Y"]
+        self.assertEqual(spectrum.dtype, numpy.uint32)
+        self.assertEqual(spectrum[0], 1000)
+        self.assertEqual(spectrum[100], 2000)
+        self.assertEqual(spectrum[200], 750)
+        self.assertEqual(spectrum[300], 1300)
+
+        processing_parameters = json.loads(processed_data[pv_name_prefix + ":processing_parameters"])
+        self.assertEqual(processing_parameters["gain"], "test")
+
+        # The gain is applied before the curvature correction.
+        parameters["calibration_data"] = functions.get_shift_table(numpy.ones(100))
+
+        processed_data = process_image(image, axis, pv_name_prefix, roi, parameters)
+        self.assertAlmostEqual(processed_data[pv_name_prefix + ":SPECTRUM_Y"][101], 2000)
+
+        # The same gain is applied to image stacks.
+        del parameters["calibration_data"]
+        results = process_images(numpy.stack([image, image]), axis, roi, parameters)
+        self.assertListEqual(list(results["SPECTRUM_Y"][1]), list(spectrum))
+
+        # Gain for a different image size is ignored.
+        parameters["gain_data"] = functions.get_gain_table(numpy.ones((50, 512)) * 2)
+
+        processed_data = process_image(image, axis, pv_name_prefix, roi, parameters)
+        self.assertEqual(processed_data[pv_name_prefix + ":SPECTRUM_Y"][100], 1000)
+
+        with self.assertRaises(ValueError):
+            functions.get_gain_table(numpy.full((100, 512), 5.0))
+
+    def test_process_images(self):
+        pv_name_prefix = "JUST_TESTING"
+        axis = numpy.linspace(9100, 9200, 512)
+
+        stack = numpy.zeros(shape=(8, 100, 512), dtype="uint16")
+        for index in range(stack.shape[0]):
+            stack[index] = 1000 * numpy.exp(-(axis - 9120 - 8 * index) ** 2 / (2 * 3 ** 2)) / 100 + 2
+        stack[-1] = 2
+
+        background_image = numpy.full((100, 512), 2, dtype="uint16")
+
+        roi = [0, 100]
+        parameters = {"background": "in_memory", "background_data": background_image}
+
+        results = process_images(stack, axis, roi, parameters)
+
+        self.assertEqual(results["SPECTRUM_Y"].shape, (8, 512))
+        self.assertEqual(len(results["SPECTRUM_CENTER"]), 8)
+        self.assertListEqual(list(results["SPECTRUM_NOISE_ONLY"]), [False] * 7 + [True])
+
+        for index, image in enumerate(stack[:-1]):
+            processed_data = process_image(image, axis, pv_name_prefix, roi, parameters)
+
+            self.assertListEqual(list(results["SPECTRUM_Y"][index]),
+                                 list(processed_data[pv_name_prefix + ":SPECTRUM_Y"]))
+            self.assertAlmostEqual(results["SPECTRUM_CENTER"][index],
+                                   processed_data[pv_name_prefix + ":SPECTRUM_CENTER"], delta=0.01)
+            self.assertAlmostEqual(results["SPECTRUM_FWHM"][index],
+                                   processed_data[pv_name_prefix + ":SPECTRUM_FWHM"], delta=0.01)
+            self.assertAlmostEqual(results["SPECTRUM_CENTER"][index], 9120 + 8 * index, delta=0.5)
+
+        # The curvature correction is applied as in process_image.
+        parameters["calibration_data"] = functions.get_shift_table(numpy.full(100, 1.5))
+
+        results = process_images(stack[:2], axis, roi, parameters)
+        processed_data = process_image(stack[1], axis, pv_name_prefix, roi, parameters)
+        self.assertListEqual(list(results["SPECTRUM_Y"][1]), list(processed_data[pv_name_prefix + ":SPECTRUM_Y"]))
+
+    def test_stream_processor_invalid_output_mode(self):
+        with self.assertRaises(ValueError):
+            get_stream_processor(input_stream_host="localhost", input_stream_port=10000,
+                                 data_output_stream_port=11000, image_output_stream_port=11001,
+                                 epics_pv_name_prefix="JUST_TESTING", output_pv_name=None, center_pv_name=None,
+                                 fwhm_pv_name=None, ymin_pv_name=None, ymax_pv_name=None, axis_pv_name=None,
+                                 data_output_stream_mode="pair")
+
+    def test_input_pv_value(self):
+        class PV(object):
+            def __init__(self, connected, value):
+                self.connected = connected
+                self.value = value
+
+        class Channel(object):
+            def __init__(self, value):
+                self.value = value
+
+        message_channels = {"TEST:YMIN": Channel(20)}
+
+        self.assertEqual(get_input_pv_value(PV(True, 10), "TEST:YMIN", message_channels), 10)
+
+        # A replayed capture contains the values of the PVs as channels.
+        self.assertEqual(get_input_pv_value(PV(False, None), "TEST:YMIN", message_channels), 20)
+        self.assertIsNone(get_input_pv_value(PV(False, None), "TEST:YMAX", message_channels))
+
     def test_stream_processor(self):
         pv_name_prefix = "JUST_TESTING"
         n_images = 50
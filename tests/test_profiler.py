@@ -0,0 +1,75 @@
+import unittest
+from threading import Thread, Event
+
+import numba
+import numpy
+
+from psss_processing import functions
+from psss_processing.processor import process_image
+from psss_processing.profiler import FrameProfiler
+
+
+class TestProfiler(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # The numba thread pool is started by the main thread, as in the service. The tbb threading layer blocks
+        # at the exit if it was started by a thread which is not running anymore.
+        numba.get_num_threads()
+
+    def setUp(self):
+        axis = numpy.linspace(9100, 9200, 512)
+        spectrum = 1000 * numpy.exp(-(axis - 9130) ** 2 / (2 * 3 ** 2))
+
+        self.image = numpy.zeros(shape=(100, 512), dtype="uint16")
+        self.image[:] = spectrum / 100
+        self.axis = axis
+
+        self.profiler = FrameProfiler(sample_interval=0.0005)
+        self.running_flag = Event()
+
+    def tearDown(self):
+        self.running_flag.clear()
+
+    def start_processing(self):
+        def processing():
+            while self.running_flag.is_set():
+                self.profiler.frame_start()
+                process_image(self.image, self.axis, "JUST_TESTING", [0, 100], {"background": ""})
+                self.profiler.lap("process_image")
+                self.profiler.frame_end()
+
+        self.running_flag.set()
+        Thread(target=processing, daemon=True).start()
+
+    def test_profile(self):
+        get_spectra = functions.get_spectra
+
+        self.start_processing()
+        report = self.profiler.profile(n_frames=20, collapsed_stacks=True, timeout=30)
+
+        self.assertEqual(report["n_frames"], 20)
+        self.assertGreater(report["frame_rate"], 0)
+        self.assertListEqual(list(report["stages_ms_per_frame"]), ["process_image"])
+
+        self.assertEqual(report["kernels"]["get_spectra"]["calls"], 20)
+        self.assertIn("process_image", report["report"])
+        self.assertIn("process_image (processor.py", report["collapsed_stacks"])
+
+        # The original kernels are restored after the profiling.
+        self.assertIs(functions.get_spectra, get_spectra)
+
+    def test_profile_timeout(self):
+        with self.assertRaises(RuntimeError):
+            self.profiler.profile(n_frames=1, timeout=0.1)
+
+        with self.assertRaises(ValueError):
+            self.profiler.profile(n_frames=0)
+
+        # The profiling can be requested again after a timeout.
+        self.start_processing()
+        self.assertEqual(self.profiler.profile(n_frames=2, timeout=30)["n_frames"], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
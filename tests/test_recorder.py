@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy
+
+from psss_processing.recorder import SpectrumRecorder
+
+
+class TestRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+        self.pv_name_prefix = "JUST_TESTING"
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory)
+
+    def get_processed_data(self, pulse_id, width=512):
+        return {self.pv_name_prefix + ":SPECTRUM_X": numpy.linspace(9100, 9200, width),
+                self.pv_name_prefix + ":SPECTRUM_Y": numpy.full(width, pulse_id, dtype="uint32"),
+                self.pv_name_prefix + ":SPECTRUM_CENTER": 9150.0 + pulse_id,
+                self.pv_name_prefix + ":SPECTRUM_FWHM": 5.0}
+
+    def test_hdf5_recording(self):
+        recorder = SpectrumRecorder(output_directory=self.output_directory)
+
+        # Not recording, nothing is queued.
+        recorder.record(0, (0, 0), self.get_processed_data(0), self.pv_name_prefix)
+
+        recorder.start(recording_format="h5")
+        self.assertEqual(recorder.get_status(), "recording")
+
+        for pulse_id in range(1, 251):
+            recorder.record(pulse_id, (1000, pulse_id), self.get_processed_data(pulse_id), self.pv_name_prefix)
+
+        # A different spectrum width starts a new file.
+        recorder.record(251, (1000, 251), self.get_processed_data(251, width=256), self.pv_name_prefix)
+
+        recorder.stop()
+        self.assertEqual(recorder.get_status(), "stopped")
+
+        statistics = recorder.get_statistics()
+        self.assertEqual(statistics["n_recorded"], 251)
+        self.assertEqual(statistics["n_dropped"], 0)
+        self.assertEqual(len(statistics["files"]), 2)
+
+        with h5py.File(statistics["files"][0], "r") as recording_file:
+            self.assertListEqual(list(recording_file["pulse_id"][:]), list(range(1, 251)))
+            self.assertEqual(recording_file["spectrum_y"].shape, (250, 512))
+            self.assertEqual(recording_file["spectrum_y"][10, 0], 11)
+            self.assertEqual(recording_file["spectrum_center"][10], 9161)
+            self.assertEqual(recording_file["global_timestamp_offset"][10], 11)
+            self.assertEqual(len(recording_file["spectrum_x"]), 512)
+
+        with h5py.File(statistics["files"][1], "r") as recording_file:
+            self.assertEqual(recording_file["spectrum_y"].shape, (1, 256))
+
+    def test_npy_recording_rotation(self):
+        recorder = SpectrumRecorder(output_directory=self.output_directory, batch_size=10)
+
+        recorder.start(recording_format="npy", max_file_size_mb=0.05, compression=False)
+        for pulse_id in range(100):
+            recorder.record(pulse_id, (1000, pulse_id), self.get_processed_data(pulse_id), self.pv_name_prefix)
+        recorder.stop()
+
+        files = recorder.get_statistics()["files"]
+        self.assertGreater(len(files), 1)
+
+        pulse_ids = []
+        for filename in files:
+            self.assertTrue(os.path.isfile(filename))
+            segment = numpy.load(filename)
+            pulse_ids.extend(segment["pulse_id"])
+            self.assertEqual(segment["spectrum_y"].shape[1], 512)
+
+        self.assertListEqual(pulse_ids, list(range(100)))
+
+        with self.assertRaises(ValueError):
+            recorder.start(recording_format="tiff")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy
+
+from psss_processing.processor import process_image
+from psss_processing.reprocess import reprocess, get_calibration_data
+
+
+class TestReprocess(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+        self.pv_name_prefix = "JUST_TESTING"
+
+        self.axis = numpy.linspace(9100, 9200, 256)
+        self.images = numpy.zeros((12, 50, 256), dtype="uint16")
+        for index in range(self.images.shape[0]):
+            self.images[index] = 1000 * numpy.exp(-(self.axis - 9120 - 5 * index) ** 2 / (2 * 3 ** 2)) / 50
+
+        self.input_file = os.path.join(self.output_directory, "images.npy")
+        numpy.save(self.input_file, self.images)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory)
+
+    def test_reprocess(self):
+        parameters = {"background": ""}
+        roi = [0, 50]
+
+        output_file = os.path.join(self.output_directory, "results.h5")
+
+        fps = reprocess(self.input_file, output_file, self.axis, self.pv_name_prefix, roi, parameters,
+                        n_workers=2, chunk_size=5)
+        self.assertGreater(fps, 0)
+
+        with h5py.File(output_file, "r") as results:
+            centers = results["data/%s:SPECTRUM_CENTER/data" % self.pv_name_prefix][()]
+            spectra = results["data/%s:SPECTRUM_Y/data" % self.pv_name_prefix][()]
+            self.assertListEqual(list(results["data/%s:SPECTRUM_CENTER/pulse_id" % self.pv_name_prefix]),
+                                 list(range(12)))
+
+            # The energy axis is the same for all images and written once.
+            numpy.testing.assert_array_equal(results["data/%s:SPECTRUM_X/data" % self.pv_name_prefix], self.axis)
+
+        self.assertEqual(spectra.shape, (12, 256))
+
+        # The same processing as online.
+        for index, image in enumerate(self.images):
+            processed_data = process_image(image, self.axis, self.pv_name_prefix, roi, parameters)
+            self.assertEqual(centers[index], processed_data[self.pv_name_prefix + ":SPECTRUM_CENTER"])
+            self.assertListEqual(list(spectra[index]), list(processed_data[self.pv_name_prefix + ":SPECTRUM_Y"]))
+
+        self.assertAlmostEqual(centers[10], 9170, delta=1)
+
+        output_file = os.path.join(self.output_directory, "results.npz")
+        reprocess(self.input_file, output_file, self.axis, self.pv_name_prefix, roi, parameters, chunk_size=5)
+
+        results = numpy.load(output_file)
+        self.assertListEqual(list(results["pulse_id"]), list(range(12)))
+        numpy.testing.assert_array_equal(results[self.pv_name_prefix + ":SPECTRUM_CENTER"], centers)
+        self.assertEqual(results[self.pv_name_prefix + ":SPECTRUM_X"].shape, (256,))
+
+    def test_calibration(self):
+        self.assertIsNone(get_calibration_data())
+
+        shift = numpy.arange(50) * 0.1
+        calibration_file = os.path.join(self.output_directory, "shift.npy")
+        numpy.save(calibration_file, shift)
+
+        shift_index, shift_fraction = get_calibration_data(calibration_file)
+        numpy.testing.assert_array_almost_equal(shift_index + shift_fraction, shift)
+
+        shift_index, shift_fraction = get_calibration_data(polynomial=[0.1, 0], n_rows=50)
+        numpy.testing.assert_array_almost_equal(shift_index + shift_fraction, shift)
+
+        with self.assertRaises(ValueError):
+            get_calibration_data(polynomial=[0.1, 0])
+        with self.assertRaises(ValueError):
+            get_calibration_data(calibration_file, polynomial=[0.1, 0], n_rows=50)
+
+        parameters = {"background": "", "calibration": calibration_file,
+                      "calibration_data": get_calibration_data(calibration_file)}
+        roi = [0, 50]
+
+        output_file = os.path.join(self.output_directory, "results.npz")
+        reprocess(self.input_file, output_file, self.axis, self.pv_name_prefix, roi, parameters, chunk_size=5)
+
+        results = numpy.load(output_file)
+        for index, image in enumerate(self.images):
+            processed_data = process_image(image, self.axis, self.pv_name_prefix, roi, parameters)
+            numpy.testing.assert_array_equal(results[self.pv_name_prefix + ":SPECTRUM_Y"][index],
+                                             processed_data[self.pv_name_prefix + ":SPECTRUM_Y"])
+
+        # The corrected spectrum has fractional counts.
+        self.assertEqual(results[self.pv_name_prefix + ":SPECTRUM_Y"].dtype, numpy.float64)
+
+
+if __name__ == '__main__':
+    unittest.main()
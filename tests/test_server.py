@@ -0,0 +1,204 @@
+import asyncio
+import unittest
+from threading import Thread
+from time import sleep, time
+
+import bottle
+import numpy
+import requests
+
+from psss_processing import PsssProcessingClient, AsyncPsssProcessingClient, query_processors, functions
+from psss_processing.manager import ProcessingManager
+from psss_processing.rest_api.server import register_rest_interface, ThreadingWSGIRefServer
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        def processor(running_flag, parameters, statistics):
+            statistics["pv_connections"] = {"TEST:ROI_YMIN": False}
+            running_flag.set()
+
+            while running_flag.is_set():
+                statistics["counter"] = statistics.get("counter", 0) + 1
+                sleep(0.01)
+
+            # Slow shutdown of the processing.
+            sleep(1)
+
+        self.manager = ProcessingManager(processor, parameters={"background": ""})
+
+        app = bottle.Bottle()
+        register_rest_interface(app, self.manager)
+
+        self.server = ThreadingWSGIRefServer(host="127.0.0.1", port=10100, quiet=True)
+        self.server_thread = Thread(target=bottle.run, kwargs={"app": app, "server": self.server, "quiet": True},
+                                    daemon=True)
+        self.server_thread.start()
+
+        self.address = "http://127.0.0.1:10100"
+        sleep(0.5)
+
+    def tearDown(self):
+        self.manager.stop()
+        self.server.server.shutdown()
+        self.server.server.server_close()
+
+    def test_slow_stop_does_not_block(self):
+        requests.post(self.address + "/start")
+
+        stop_thread = Thread(target=requests.post, args=(self.address + "/stop",))
+        stop_thread.start()
+        sleep(0.2)
+
+        # The other requests are answered while the stop is waiting for the processing.
+        start_time = time()
+        response = requests.get(self.address + "/statistics").json()
+        self.assertLess(time() - start_time, 0.5)
+        self.assertEqual(response["state"], "ok")
+        self.assertGreater(response["statistics"]["counter"], 0)
+
+        stop_thread.join()
+        self.assertEqual(requests.get(self.address + "/status").json()["status"], "stopped")
+
+    def test_async_jobs(self):
+        response = requests.post(self.address + "/start?async=true").json()
+        self.assertEqual(response["state"], "ok")
+        self.assertIn(response["job"]["state"], ["pending", "running", "done"])
+
+        job_id = response["job"]["job_id"]
+        for _ in range(50):
+            job = requests.get(self.address + "/jobs/" + job_id).json()["job"]
+            if job["state"] == "done":
+                break
+            sleep(0.05)
+
+        self.assertEqual(job["name"], "start")
+        self.assertEqual(job["state"], "done")
+        self.assertEqual(requests.get(self.address + "/status").json()["status"], "processing")
+
+        start_time = time()
+        response = requests.post(self.address + "/stop?async=1").json()
+        self.assertLess(time() - start_time, 0.5)
+        self.assertEqual(response["job"]["name"], "stop")
+
+        response = requests.post(self.address + "/background?async=true", json={"filename": "test", "data": [[1]]})
+        background_job_id = response.json()["job"]["job_id"]
+
+        # Jobs run in the order they were submitted.
+        sleep(1.5)
+        self.assertEqual(requests.get(self.address + "/jobs/" + background_job_id).json()["job"]["state"], "done")
+        self.assertEqual(requests.get(self.address + "/status").json()["status"], "stopped")
+        self.assertEqual(requests.get(self.address + "/parameters").json()["parameters"]["background"], "test")
+
+        response = requests.get(self.address + "/jobs/not_existing").json()
+        self.assertEqual(response["state"], "error")
+
+    def test_keep_alive(self):
+        with requests.Session() as session:
+            for _ in range(3):
+                response = session.get(self.address + "/status")
+                self.assertEqual(response.raw.version, 11)
+                self.assertNotEqual(response.headers.get("Connection"), "close")
+
+            response = session.post(self.address + "/parameters", json={"binning": 4})
+            self.assertEqual(response.json()["parameters"]["binning"], 4)
+
+            # The body of a request is discarded if the route does not read it, or the route does not exist.
+            for method, path in [("post", "/stop"), ("post", "/not_existing"), ("get", "/status")]:
+                getattr(session, method)(self.address + path, json={"some": "body"})
+
+                response = session.get(self.address + "/status")
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json()["state"], "ok")
+
+    def test_pv_connections(self):
+        client = PsssProcessingClient(self.address, timeout=1)
+        self.assertDictEqual(client.get_pv_connections(), {})
+
+        client.start()
+        self.assertDictEqual(client.get_pv_connections(), {"TEST:ROI_YMIN": False})
+        client.close()
+
+    def test_gain(self):
+        client = PsssProcessingClient(self.address, timeout=1)
+
+        gain = numpy.full((100, 512), 1.5)
+        client.set_gain("gain.npy", gain)
+
+        parameters = self.manager.get_parameters()
+        self.assertEqual(parameters["gain"], "gain.npy")
+        self.assertEqual(parameters["gain_data"].dtype, numpy.uint16)
+        numpy.testing.assert_array_equal(parameters["gain_data"], functions.get_gain_table(gain))
+        self.assertEqual(client.get_parameters()["gain"], "gain.npy")
+
+        with self.assertRaises(ValueError):
+            client.set_gain("negative.npy", -gain)
+
+        client.set_gain()
+        self.assertIsNone(self.manager.get_parameters()["gain_data"])
+        client.close()
+
+    def test_writers_not_available(self):
+        for path, name in [("/recording", "Recording"), ("/capture", "Capture")]:
+            for method, endpoint in [("post", path + "/start"), ("post", path + "/stop"), ("get", path)]:
+                response = getattr(requests, method)(self.address + endpoint, json={}).json()
+                self.assertEqual(response["state"], "error")
+                self.assertEqual(response["status"], "%s is not available on this instance." % name)
+
+    def test_calibration(self):
+        client = PsssProcessingClient(self.address, timeout=1)
+
+        client.set_calibration("polynomial", polynomial=[0.01, 0], n_rows=100)
+        shift_index, shift_fraction = self.manager.get_parameters()["calibration_data"]
+        self.assertEqual(len(shift_index), 100)
+        self.assertAlmostEqual(shift_index[50] + shift_fraction[50], 0.5)
+
+        # Invalid calibrations are rejected with an error response.
+        for body in [{"polynomial": [0.01, 0]}, {"shift": "1, 2"}, {"shift": [1, 2], "polynomial": [1]},
+                     {"shift": [1, None]}, {"polynomial": [1], "n_rows": 0}]:
+            response = requests.post(self.address + "/calibration", json=body).json()
+            self.assertEqual(response["state"], "error")
+            self.assertIn("alibration", response["status"])
+
+        client.set_calibration()
+        self.assertIsNone(self.manager.get_parameters()["calibration_data"])
+        client.close()
+
+    def test_clients(self):
+        client = PsssProcessingClient(self.address, timeout=1)
+        self.assertEqual(client.get_status(), "stopped")
+        client.close()
+
+        async def get_status():
+            async_client = AsyncPsssProcessingClient(self.address, timeout=1)
+            return await asyncio.gather(async_client.get_status(), async_client.get_parameters())
+
+        status, parameters = asyncio.run(get_status())
+        self.assertEqual(status, "stopped")
+        self.assertEqual(parameters["background"], "")
+
+        not_running_address = "http://127.0.0.1:10199"
+        results = query_processors([self.address, not_running_address], timeout=1)
+
+        self.assertEqual(results[self.address]["status"], "stopped")
+        self.assertIn("statistics", results[self.address])
+        self.assertIn("error", results[not_running_address])
+
+        results = query_processors([self.address], timeout=1, statistics=False)
+        self.assertDictEqual(results[self.address], {"status": "stopped"})
+
+        # Each thread uses its own session.
+        client = PsssProcessingClient(self.address, timeout=1)
+        sessions = [client.session]
+        thread = Thread(target=lambda: sessions.append(client.session))
+        thread.start()
+        thread.join()
+
+        self.assertIs(client.session, sessions[0])
+        self.assertIsNot(sessions[0], sessions[1])
+        client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
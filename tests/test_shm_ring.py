@@ -0,0 +1,98 @@
+import unittest
+from multiprocessing import Process
+
+import numpy
+
+from psss_processing.shm_ring import ShmRingWriter, ShmRingReader
+
+
+def read_in_other_process(name, expected_pulse_id):
+    reader = ShmRingReader(name)
+    result = reader.read_latest()
+    reader.close()
+
+    if result is None or result["pulse_id"] != expected_pulse_id:
+        raise SystemExit(1)
+
+
+class TestShmRing(unittest.TestCase):
+
+    def setUp(self):
+        self.name = "psss_test_ring"
+        self.pv_name_prefix = "JUST_TESTING"
+        self.writer = ShmRingWriter(self.name, n_slots=4, max_width=512)
+
+    def tearDown(self):
+        self.writer.close()
+
+    def get_processed_data(self, pulse_id):
+        return {self.pv_name_prefix + ":SPECTRUM_Y": numpy.full(256, pulse_id, dtype="uint32"),
+                self.pv_name_prefix + ":SPECTRUM_CENTER": 9150.0 + pulse_id,
+                self.pv_name_prefix + ":SPECTRUM_FWHM": 5.0}
+
+    def test_read_latest(self):
+        reader = ShmRingReader(self.name)
+        self.assertIsNone(reader.read_latest())
+
+        for pulse_id in range(10, 16):
+            self.writer.publish(pulse_id, (1000, pulse_id), self.get_processed_data(pulse_id), self.pv_name_prefix)
+
+        result = reader.read_latest()
+        self.assertEqual(result["sequence"], 6)
+        self.assertEqual(result["pulse_id"], 15)
+        self.assertEqual(result["global_timestamp_offset"], 15)
+        self.assertEqual(result["center"], 9165)
+        self.assertListEqual(list(result["spectrum"]), [15] * 256)
+
+        # Older results are available until they are overwritten.
+        self.assertEqual(reader.read(3)["pulse_id"], 12)
+        self.assertIsNone(reader.read(2))
+        self.assertIsNone(reader.read(7))
+
+        reader.close()
+
+    def test_truncated_spectrum(self):
+        reader = ShmRingReader(self.name)
+
+        self.writer.write(1, (0, 0), numpy.arange(600), 9150.0, 5.0)
+        result = reader.read_latest()
+        self.assertEqual(len(result["spectrum"]), 512)
+        self.assertTrue(result["truncated"])
+        self.assertEqual(self.writer.n_truncated, 1)
+
+        self.writer.write(2, (0, 0), numpy.arange(512), 9150.0, 5.0)
+        self.assertFalse(reader.read_latest()["truncated"])
+
+        reader.close()
+
+    def test_torn_read(self):
+        reader = ShmRingReader(self.name)
+        self.writer.publish(1, (0, 0), self.get_processed_data(1), self.pv_name_prefix)
+
+        # A slot being written has an odd version.
+        self.writer._version[1] = 3
+        self.assertIsNone(reader.read(1))
+        self.assertIsNone(reader.read_latest(timeout=0))
+
+        reader.close()
+
+    def test_other_process(self):
+        self.writer.publish(42, (0, 0), self.get_processed_data(42), self.pv_name_prefix)
+
+        reader_process = Process(target=read_in_other_process, args=(self.name, 42))
+        reader_process.start()
+        reader_process.join()
+        self.assertEqual(reader_process.exitcode, 0)
+
+        # The segment is not removed when the reader exits.
+        reader = ShmRingReader(self.name)
+        self.assertEqual(reader.read_latest()["pulse_id"], 42)
+        reader.close()
+
+    def test_invalid_segment(self):
+        with self.assertRaises(FileNotFoundError):
+            ShmRingReader("psss_test_not_existing")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from psss_processing.state import ProcessingState
+
+
+class TestState(unittest.TestCase):
+
+    def setUp(self):
+        self.output_directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.output_directory, "state.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.output_directory)
+
+    def test_save_and_load(self):
+        state = ProcessingState(self.filename)
+        state.load()
+
+        self.assertIsNone(state.roi)
+        self.assertIsNone(state.axis)
+
+        axis = numpy.linspace(9100, 9200, 512)
+        state.update([10, 90], axis)
+
+        loaded_state = ProcessingState(self.filename)
+        loaded_state.load()
+        self.assertListEqual(loaded_state.roi, [10, 90])
+        numpy.testing.assert_array_equal(loaded_state.axis, axis)
+
+        # Without a connected axis PV, the last axis is kept.
+        loaded_state.update([20, 80], None)
+        numpy.testing.assert_array_equal(loaded_state.axis, axis)
+
+        state.load()
+        self.assertListEqual(state.roi, [20, 80])
+
+    def test_save_only_on_change(self):
+        state = ProcessingState(self.filename)
+
+        axis = numpy.linspace(9100, 9200, 512)
+        state.update([10, 90], axis)
+
+        os.remove(self.filename)
+
+        state.update([10, 90], axis)
+        state.update([10, 90], axis.copy())
+        self.assertFalse(os.path.exists(self.filename))
+
+        state.update([10, 90], axis + 1)
+        self.assertTrue(os.path.exists(self.filename))
+
+    def test_invalid_file(self):
+        with open(self.filename, "w") as state_file:
+            state_file.write("not json")
+
+        state = ProcessingState(self.filename)
+        state.load()
+
+        self.assertIsNone(state.roi)
+
+        # Without a file name, the state is only kept in memory.
+        state = ProcessingState()
+        state.update([10, 90], None)
+        self.assertListEqual(state.roi, [10, 90])
+
+
+if __name__ == '__main__':
+    unittest.main()